@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+'''
+Beacon watching the size of the Glance image cache
+
+Fires ``high`` when the bytes used by the cache directory reach
+``high_watermark`` of ``max_size``, and ``low`` once they dropped to
+``low_watermark`` of it again. A reactor can run the cache pruner on
+``high`` (see ``glanceng.image_cache_prune``) instead of waiting for the
+daily cron.
+
+The directory is not rescanned every interval. Cached images are moved
+into place and never change, so the cache directory is only listed again
+when its mtime changed, and only new files are stat'ed. Just the files
+being written in ``incomplete/`` are stat'ed every time. A full rescan is
+done every ``rescan`` seconds.
+
+.. code-block:: yaml
+
+    beacons:
+      glance_image_cache:
+        - directory: /var/lib/glance/image-cache/
+        - max_size: 10737418240
+        - high_watermark: 0.9   # fraction of max_size
+        - low_watermark: 0.75
+        - repeat: 3600   # fire high again while above, 0 to disable
+        - rescan: 3600
+        - interval: 60
+'''
+
+# Import Python libs
+from __future__ import absolute_import
+import logging
+import os
+import stat
+import time
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'glance_image_cache'
+
+_DEFAULT_DIRECTORY = '/var/lib/glance/image-cache/'
+# Subdirectories using space, and whether their files grow in place
+_SUBDIRS = (('incomplete', True), ('invalid', False))
+
+# Per cache directory: {'dirs': {path: {'mtime':, 'files': {name: size}}},
+# 'level': 'low' or 'high', 'fired': time, 'scanned': time}
+_STATE = {}
+
+
+def __virtual__():
+    return __virtualname__
+
+
+def _config(config):
+    '''
+    Beacon configuration is a dict up to 2016.11 and a list of dicts
+    since 2017.7.
+    '''
+    if isinstance(config, list):
+        merged = {}
+        for item in config:
+            merged.update(item)
+        return merged
+    return dict(config or {})
+
+
+def validate(config):
+    '''
+    Validate the beacon configuration
+    '''
+    if not isinstance(config, (dict, list)):
+        return False, 'Configuration for glance_image_cache beacon must be ' \
+            'a list or a dictionary.'
+    config = _config(config)
+    try:
+        max_size = int(config.get('max_size', 0))
+        high = float(config.get('high_watermark', 0.9))
+        low = float(config.get('low_watermark', 0.75))
+    except (TypeError, ValueError):
+        return False, 'max_size, high_watermark and low_watermark of the ' \
+            'glance_image_cache beacon must be numbers.'
+    if max_size <= 0:
+        return False, 'Configuration for glance_image_cache beacon ' \
+            'requires a positive max_size.'
+    if not 0 < low <= high:
+        return False, 'Configuration for glance_image_cache beacon ' \
+            'requires 0 < low_watermark <= high_watermark.'
+    return True, 'Valid beacon configuration'
+
+
+def _scan(path, entry, grows=False):
+    '''
+    Returns the bytes used by the regular files in path, updating entry
+    ({'mtime': ..., 'files': {name: size}}). An unchanged directory is not
+    listed again, unless its files grow in place.
+    '''
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        entry.clear()
+        return 0
+    if grows or mtime != entry.get('mtime'):
+        known = {} if grows else entry.get('files', {})
+        files = {}
+        for name in os.listdir(path):
+            if name in known:
+                files[name] = known[name]
+                continue
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[name] = st.st_size
+        entry.update({'mtime': mtime, 'files': files})
+    return sum(entry['files'].values())
+
+
+def _usage(directory, dirs):
+    usage = _scan(directory, dirs.setdefault(directory, {}))
+    for subdir, grows in _SUBDIRS:
+        path = os.path.join(directory, subdir)
+        usage += _scan(path, dirs.setdefault(path, {}), grows)
+    return usage
+
+
+def beacon(config):
+    '''
+    Check the size of the Glance image cache against its watermarks
+    '''
+    config = _config(config)
+    directory = config.get('directory', _DEFAULT_DIRECTORY)
+    max_size = int(config['max_size'])
+    high = int(max_size * float(config.get('high_watermark', 0.9)))
+    low = int(max_size * float(config.get('low_watermark', 0.75)))
+    repeat = int(config.get('repeat', 3600))
+    rescan = int(config.get('rescan', 3600))
+
+    state = _STATE.setdefault(directory, {'dirs': {}, 'level': 'low',
+                                          'fired': 0, 'scanned': 0})
+    now = time.time()
+    if now - state['scanned'] >= rescan:
+        state['dirs'] = {}
+        state['scanned'] = now
+    usage = _usage(directory, state['dirs'])
+    log.debug('Glance image cache %s uses %s of %s bytes', directory, usage,
+              max_size)
+
+    level = None
+    if usage >= high:
+        if state['level'] != 'high' or \
+                (repeat and now - state['fired'] >= repeat):
+            level = 'high'
+    elif usage <= low and state['level'] == 'high':
+        level = 'low'
+    if level is None:
+        return []
+    state['level'] = level
+    state['fired'] = now
+    return [{'tag': level,
+             'directory': directory,
+             'usage': usage,
+             'max_size': max_size,
+             'high_watermark': high,
+             'low_watermark': low}]
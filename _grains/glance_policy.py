@@ -1,15 +1,86 @@
 #!/usr/bin/env python
-import salt.config
-import salt.loader
+import json
+import os
 
+POLICY_PATH = "/etc/glance/policy.json"
+CACHE_NAME = "glance_policy_grain.json"
 
-def main():
-    path = "/etc/glance/policy.json"
+# Parsed policy of this process: {'key': [mtime, size, inode], 'rules': {}}
+_CACHE = {}
+
+
+def _cache_path():
+    try:
+        cachedir = __opts__.get('cachedir')
+    except NameError:
+        cachedir = None
+    return os.path.join(cachedir or '/var/cache/salt/minion', CACHE_NAME)
+
+
+def _file_key(path):
+    '''
+    Identifies a version of the policy file without reading it.
+    '''
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+
+def _load_cache():
+    try:
+        with open(_cache_path()) as fh_:
+            return json.load(fh_)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_cache(data):
+    path = _cache_path()
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as fh_:
+            json.dump(data, fh_)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def _rules_from_module(path):
+    '''
+    Falls back to keystone_policy.rule_list for policy files that are
+    not plain JSON. Only then is the Salt loader needed.
+    '''
+    import salt.config
+    import salt.loader
     __opts__ = salt.config.minion_config('/etc/salt/minion')
     keystone_policy_mod = salt.loader.raw_mod(__opts__, 'keystone_policy', None)
     if keystone_policy_mod:
         result = keystone_policy_mod['keystone_policy.rule_list'](path)
         if result and 'Error' not in result:
-            return {'glance_policy': result}
+            return result
     return {}
 
+
+def main():
+    path = POLICY_PATH
+    try:
+        key = _file_key(path)
+    except OSError:
+        return {}
+
+    if not _CACHE:
+        _CACHE.update(_load_cache())
+    if _CACHE.get('key') != key:
+        try:
+            with open(path) as fh_:
+                rules = json.load(fh_)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            rules = _rules_from_module(path)
+        _CACHE.clear()
+        _CACHE.update({'key': key, 'rules': rules})
+        _save_cache(_CACHE)
+
+    if _CACHE['rules']:
+        return {'glance_policy': _CACHE['rules']}
+    return {}
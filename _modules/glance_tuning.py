@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Sizing of Glance worker processes and their DB and RPC pools.
+
+Exposes:
+  - autotune
+
+Used by glance/map.jinja for the pillar keys set to ``auto``. Unlike
+glanceng, this module has no dependencies, so it is available before the
+Glance packages are installed.
+"""
+
+# Import Python libs
+from __future__ import absolute_import
+import logging
+
+log = logging.getLogger(__name__)
+
+# Template defaults used when there is no DB connection budget
+_DEFAULT_MAX_POOL_SIZE = 10
+_DEFAULT_MAX_OVERFLOW = 30
+# oslo.messaging defaults
+_MAX_EXECUTOR_THREAD_POOL_SIZE = 64
+_MAX_RPC_CONN_POOL_SIZE = 30
+
+
+def _auto(value):
+    return str(value).lower() == 'auto'
+
+
+def autotune(workers='auto', max_pool_size='auto', max_overflow='auto',
+             executor_thread_pool_size='auto', rpc_conn_pool_size='auto',
+             db_connection_budget=None, nodes=1, services=2,
+             mem_per_worker=300, reserved_mem=1024, cpus=None,
+             mem_total=None):
+    """
+    Compute worker counts and per worker pool sizes for this node
+
+    Every argument that is "auto" is computed, any other value is
+    returned unchanged.
+
+    - workers: one per CPU, as far as the memory left after reserved_mem
+      allows mem_per_worker MiB for each
+    - max_pool_size, max_overflow: the cluster wide db_connection_budget
+      divided by the processes that can open connections, that is nodes
+      times services (glance-api and glance-registry) times workers. A
+      third of a process' share is kept open, the rest is overflow.
+      Without a budget the previous fixed values (10 and 30) are used.
+    - executor_thread_pool_size: as many threads as a process has DB
+      connections, within 8 and 64; more threads would only queue for a
+      connection
+    - rpc_conn_pool_size: the executor pool size, at most 30
+
+    :param workers: Worker processes per service
+    :param max_pool_size: Pooled DB connections per process
+    :param max_overflow: DB connections per process beyond the pool
+    :param executor_thread_pool_size: RPC executor threads per process
+    :param rpc_conn_pool_size: RPC connections per process
+    :param db_connection_budget: DB connections Glance may use in total
+    :param nodes: Number of Glance nodes sharing the database
+    :param services: Glance services per node connecting to the database
+    :param mem_per_worker: MiB of memory to plan per worker process
+    :param reserved_mem: MiB of memory left to everything else
+    :param cpus: CPU count, the num_cpus grain by default
+    :param mem_total: Memory in MiB, the mem_total grain by default
+    :return: Dictionary with the five settings and the numbers they were
+             computed from
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glance_tuning.autotune db_connection_budget=2000 nodes=3
+    """
+    cpus = int(cpus or __grains__.get('num_cpus') or 1)
+    mem_total = int(mem_total or __grains__.get('mem_total') or 0)
+
+    if _auto(workers):
+        workers = cpus
+        if mem_total:
+            workers = min(workers, (mem_total - int(reserved_mem)) //
+                          int(mem_per_worker))
+        workers = max(1, workers)
+
+    # Glance starts one worker per CPU if workers isn't set
+    processes = int(nodes) * int(services) * int(workers or cpus)
+    if db_connection_budget:
+        per_process = max(2, int(db_connection_budget) // processes)
+        pool = max(1, per_process // 3)
+        overflow = per_process - pool
+    else:
+        pool, overflow = _DEFAULT_MAX_POOL_SIZE, _DEFAULT_MAX_OVERFLOW
+    if _auto(max_pool_size):
+        max_pool_size = pool
+    if _auto(max_overflow):
+        max_overflow = overflow
+
+    connections = int(max_pool_size or 0) + int(max_overflow or 0)
+    if _auto(executor_thread_pool_size):
+        executor_thread_pool_size = max(8, min(_MAX_EXECUTOR_THREAD_POOL_SIZE,
+                                               connections))
+    if _auto(rpc_conn_pool_size):
+        rpc_conn_pool_size = min(_MAX_RPC_CONN_POOL_SIZE,
+                                 int(executor_thread_pool_size or
+                                     _MAX_EXECUTOR_THREAD_POOL_SIZE))
+
+    ret = {'workers': workers,
+           'max_pool_size': max_pool_size,
+           'max_overflow': max_overflow,
+           'executor_thread_pool_size': executor_thread_pool_size,
+           'rpc_conn_pool_size': rpc_conn_pool_size,
+           'cpus': cpus,
+           'mem_total': mem_total,
+           'processes': processes,
+           'db_connections': processes * connections}
+    log.debug('Glance autotuning: %s', ret)
+    return ret
@@ -7,6 +7,23 @@ following functions:
   - task_create
   - task_show
   - task_list
+  - import_journal_get, import_journal_list, import_journal_add,
+    import_journal_remove
+  - get_image_owner_id
+  - get_image_owner_ids
+  - image_upload
+  - image_verified_hashes
+  - image_list
+  - image_update
+  - image_plan
+  - image_replicate
+  - images_in_use
+  - image_fetch
+  - image_cache_prefetch
+  - image_cache_prune
+  - image_cache_stats
+  - stats
+  - http_stats
 
 :optdepends:    - glanceclient Python adapter
 :configuration: This module is not usable until the following are specified
@@ -17,6 +34,26 @@ following functions:
         keystone.tenant: admin
         keystone.insecure: False   #(optional)
         keystone.auth_url: 'http://127.0.0.1:5000/v2.0/'
+        keystone.token_cache: memory   #(optional) memory, disk or off
+        keystone.schema_cache_ttl: 86400   #(optional) seconds, 0 disables
+        keystone.owner_cache_ttl: 60   #(optional) seconds
+        keystone.http_pool_size: 10   #(optional) 0 disables pooling
+        keystone.http_timeout: 600   #(optional) seconds
+        keystone.http_retries: 0   #(optional) on connection errors
+
+    Keystone tokens and the Glance endpoint are cached per profile until
+    shortly before the token expires, so that repeated calls don't
+    authenticate again. With ``token_cache: disk`` they are also kept in
+    the minion cachedir and reused by later salt-call runs. A token that
+    Glance rejects is dropped and the call retried once with a new one.
+
+    Glance clients of a profile share one pooled HTTP session per endpoint,
+    so keep-alive connections are reused across calls and threads, see
+    http_stats.
+
+    Glance schemas are cached per endpoint for ``schema_cache_ttl`` seconds,
+    in memory and in the minion cachedir. Cached schemas are discarded when
+    the endpoint starts serving a different Glance API version.
 
     If configuration for multiple openstack accounts is required, they can be
     set up as different configuration profiles:
@@ -43,9 +80,20 @@ following functions:
 
 # Import Python libs
 from __future__ import absolute_import
+import calendar
+import hashlib
+import itertools
+import json
 import logging
+import mmap
+import os
 import pprint
 import re
+import tempfile
+import threading
+import time
+import types
+from multiprocessing.util import Finalize
 
 # Import salt libs
 from salt.exceptions import SaltInvocationError
@@ -60,28 +108,72 @@ _version_ary = __version__.split('.')
 CUR_VER = SaltStackVersion(_version_ary[0], _version_ary[1])
 BORON = SaltStackVersion.from_name('Boron')
 
-# pylint: disable=import-error
-HAS_GLANCE = False
-try:
-    from glanceclient import client
-    from glanceclient import exc
-    HAS_GLANCE = True
-except ImportError:
-    pass
+
+def _find_module(name, path=None):
+    '''
+    Checks whether a module can be imported without importing it.
+    Returns the directories of a package, [] for plain modules and None
+    if the module is missing.
+    '''
+    try:
+        from importlib.machinery import PathFinder
+    except ImportError:
+        import imp
+        try:
+            fh_, pathname, description = imp.find_module(name, path)
+        except ImportError:
+            return None
+        if fh_:
+            fh_.close()
+        return [pathname] if description[2] == imp.PKG_DIRECTORY else []
+    spec = PathFinder.find_spec(name, path)
+    if spec is None:
+        return None
+    return list(spec.submodule_search_locations or [])
+
+
+# The client libraries are only imported on first use (see _glance and
+# _keystone), as loading them is expensive and most minions that load
+# this module never call it.
+HAS_GLANCE = _find_module('glanceclient') is not None
 
 # Workaround, as the Glance API v2 requires you to
 # already have a keystone session token
-HAS_KEYSTONE = False
-try:
-    from keystoneclient.v2_0 import client as kstone
-    HAS_KEYSTONE = True
-except ImportError:
-    pass
-
+_KEYSTONE_PATH = _find_module('keystoneclient')
+HAS_KEYSTONE = bool(_KEYSTONE_PATH) and \
+    _find_module('v2_0', _KEYSTONE_PATH) is not None
 
-logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+_LIBS = {}
+
+
+def _glance():
+    '''
+    Returns the glanceclient "client" and "exc" modules.
+    '''
+    if 'glance' not in _LIBS:
+        # pylint: disable=import-error
+        from glanceclient import client
+        from glanceclient import exc
+        _LIBS['glance'] = (client, exc)
+    return _LIBS['glance']
+
+
+def _glance_exc():
+    return _glance()[1]
+
+
+def _keystone():
+    '''
+    Returns the keystoneclient.v2_0.client module.
+    '''
+    if 'keystone' not in _LIBS:
+        # pylint: disable=import-error
+        from keystoneclient.v2_0 import client as kstone
+        _LIBS['keystone'] = kstone
+    return _LIBS['keystone']
+
 
 def __virtual__():
     '''
@@ -99,14 +191,182 @@ def __virtual__():
 
 __opts__ = {}
 
+# Keystone tokens and Glance endpoints, keyed by profile and then by a
+# digest of the credentials used to obtain them. Entries are dicts with
+# the keys 'token', 'expires' (epoch seconds) and 'endpoint'.
+_AUTH_CACHE = {}
+# Tokens closer than this many seconds to expiry are not handed out.
+_TOKEN_EXPIRY_MARGIN = 60
+# Used when keystone doesn't tell us when a token expires.
+_DEFAULT_TOKEN_TTL = 3600
 
-def _auth(profile=None, api_version=2, **connection_args):
+# Glance schemas keyed by (endpoint, schema name). Entries are dicts with
+# the keys 'properties', 'fetched' (epoch seconds) and 'api_version'.
+_SCHEMA_CACHE = {}
+# Schemas only change on Glance upgrades, so keep them for a day by default.
+_DEFAULT_SCHEMA_TTL = 86400
+# Current Glance API version per endpoint as [version, looked up at], looked
+# up again after _API_VERSION_TTL seconds, so that an upgrade is noticed by
+# long running processes too.
+_API_VERSIONS = {}
+_API_VERSION_TTL = 300
+
+# Image owners resolved by the mine functions, keyed by profile and name.
+# Entries are [owner, resolved at] lists. They are also kept in the
+# owners.json cache file, as the Mine runs every call in a new process.
+_OWNER_CACHE = {}
+_OWNER_LOCK = threading.Lock()
+_DEFAULT_OWNER_TTL = 60
+
+# Serializes read-modify-write cycles of the import journal between the
+# threads of batch states.
+_JOURNAL_LOCK = threading.Lock()
+
+# Call counters and latencies of remote operations, keyed by profile and
+# operation ('auth', 'endpoint_get' or a glanceclient call like
+# 'tasks.get'), that are not merged into the stats.json cache file yet.
+# See stats().
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+# Pending counters are merged into the cache file at most this often while
+# calls are made, and always by stats(), http_stats() and on process exit.
+_STATS_FLUSH_INTERVAL = 5
+_STATS_FLUSHED = {'at': 0.0, 'hooked': False}
+# Requests and connections of the pooled sessions already merged into the
+# cache file, keyed by (profile, endpoint)
+_HTTP_FLUSHED = {}
+
+# Pooled HTTP sessions shared by all glanceclient clients of a profile and
+# endpoint, keyed by (profile, endpoint). See _pooled().
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+_DEFAULT_HTTP_POOL_SIZE = 10
+
+# Bandwidth limits shared by all concurrent transfers to a profile, keyed
+# by profile. See _throttle().
+_THROTTLES = {}
+_THROTTLES_LOCK = threading.Lock()
+
+
+def _cache_file(name):
     '''
-    Set up glance credentials, returns
-    `glanceclient.client.Client`. Optional parameter
-    "api_version" defaults to 2.
+    Returns the path of a glanceng cache file in the minion cachedir.
+    '''
+    cachedir = __opts__.get('cachedir', '/var/cache/salt/minion')
+    return os.path.join(cachedir, 'glanceng', name)
 
-    Only intended to be used within glance-enabled modules
+
+def _read_cache_file(name):
+    '''
+    Loads a JSON cache file, returns {} if it is missing or unreadable.
+    '''
+    path = _cache_file(name)
+    try:
+        with open(path) as fh_:
+            data = json.load(fh_)
+    except (IOError, OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_cache_file(name, data):
+    '''
+    Atomically writes a JSON cache file readable only by its owner.
+    '''
+    path = _cache_file(name)
+    tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                        threading.current_thread().ident)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        fd_ = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd_, 'w') as fh_:
+            json.dump(data, fh_)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        log.warning('Unable to write glanceng cache file %s: %s', path, err)
+
+
+def _credentials_digest(*parts):
+    '''
+    Hashes everything that identifies a keystone session, so that
+    secrets never end up in cache keys or on disk.
+    '''
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _token_expires(keystone):
+    '''
+    Returns the expiry time of the keystone client's token as epoch seconds.
+    '''
+    try:
+        expires = keystone.auth_ref.expires
+        return calendar.timegm(expires.utctimetuple())
+    except (AttributeError, TypeError, ValueError):
+        return time.time() + _DEFAULT_TOKEN_TTL
+
+
+def _auth_cache_get(profile, digest, persist):
+    '''
+    Returns a cached auth entry that is still valid, or None.
+    '''
+    entries = _AUTH_CACHE.setdefault(profile or '', {})
+    entry = entries.get(digest)
+    if entry is None and persist:
+        entry = _read_cache_file('auth.json').get(profile or '', {}).get(digest)
+    if entry is None:
+        return None
+    if entry['expires'] - _TOKEN_EXPIRY_MARGIN <= time.time():
+        entries.pop(digest, None)
+        return None
+    entries[digest] = entry
+    return entry
+
+
+def _auth_cache_set(profile, digest, entry, persist):
+    _AUTH_CACHE.setdefault(profile or '', {})[digest] = entry
+    if persist:
+        data = _read_cache_file('auth.json')
+        now = time.time()
+        profile_entries = dict(
+            (key, value) for key, value
+            in data.get(profile or '', {}).items()
+            if value.get('expires', 0) > now)
+        profile_entries[digest] = entry
+        data[profile or ''] = profile_entries
+        _write_cache_file('auth.json', data)
+
+
+def _invalidate_auth(profile=None):
+    '''
+    Forgets cached tokens and endpoints for the given profile, both in
+    memory and in the minion cachedir.
+    '''
+    _AUTH_CACHE.pop(profile or '', None)
+    data = _read_cache_file('auth.json')
+    if (profile or '') in data:
+        data.pop(profile or '')
+        _write_cache_file('auth.json', data)
+
+
+def _config_get(profile, key, default=None):
+    '''
+    Returns a "keystone." option for the given profile from the
+    pillar or the minion config.
+    '''
+    prefix = profile + ":keystone." if profile else "keystone."
+    return __salt__['config.get'](prefix + key, default)
+
+
+def _auth_info(profile=None, api_version=2, **connection_args):
+    '''
+    Resolves the Glance endpoint and the keyword arguments (including a
+    token) needed to build a `glanceclient.client.Client`, using the
+    token cache where possible.
     '''
 
     if profile:
@@ -131,10 +391,9 @@ def _auth(profile=None, api_version=2, **connection_args):
     admin_token = get('token')
     region = get('region')
     ks_endpoint = get('endpoint', 'http://127.0.0.1:9292/')
-    g_endpoint_url = __salt__['keystone.endpoint_get']('glance', profile)
-    # The trailing 'v2' causes URLs like thise one:
-    # http://127.0.0.1:9292/v2/v1/images
-    g_endpoint_url = re.sub('/v2', '', g_endpoint_url['internalurl'])
+    # One of 'memory' (default), 'disk' (also reuse tokens across
+    # salt-call runs via the minion cachedir) or 'off'.
+    token_cache = get('token_cache', 'memory')
 
     if admin_token and api_version != 1 and not password:
         # If we had a password we could just
@@ -147,7 +406,6 @@ def _auth(profile=None, api_version=2, **connection_args):
                   'password': password,
                   'tenant_id': tenant_id,
                   'auth_url': auth_url,
-                  'endpoint_url': g_endpoint_url,
                   'region_name': region,
                   'tenant_name': tenant}
         # 'insecure' keyword not supported by all v2.0 keystone clients
@@ -156,30 +414,303 @@ def _auth(profile=None, api_version=2, **connection_args):
             kwargs['insecure'] = True
     elif api_version == 1 and admin_token:
         kwargs = {'token': admin_token,
-                  'auth_url': auth_url,
-                  'endpoint_url': g_endpoint_url}
+                  'auth_url': auth_url}
     else:
         raise SaltInvocationError('No credentials to authenticate with.')
 
-    if HAS_KEYSTONE:
-        log.debug('Calling keystoneclient.v2_0.client.Client(' +
-            '{0}, **{1})'.format(ks_endpoint, kwargs))
-        keystone = kstone.Client(**kwargs)
-        kwargs['token'] = keystone.get_token(keystone.session)
-        # This doesn't realy prevent the password to show up
-        # in the minion log as keystoneclient.session is
-        # logging it anyway when in debug-mode
-        kwargs.pop('password')
-        log.debug('Calling glanceclient.client.Client(' +
-            '{0}, {1}, **{2})'.format(api_version,
-                g_endpoint_url, kwargs))
-        # may raise exc.HTTPUnauthorized, exc.HTTPNotFound
-        # but we deal with those elsewhere
-        return client.Client(api_version, g_endpoint_url, **kwargs)
-    else:
+    if not HAS_KEYSTONE:
         raise NotImplementedError(
             "Can't retrieve a auth_token without keystone")
 
+    digest = _credentials_digest(user, password, admin_token, tenant,
+                                 tenant_id, auth_url, region, insecure)
+    persist = token_cache == 'disk'
+    entry = None
+    if token_cache != 'off':
+        entry = _auth_cache_get(profile, digest, persist)
+
+    if entry is None:
+        with _timed(profile, 'endpoint_get'):
+            g_endpoint_url = __salt__['keystone.endpoint_get']('glance',
+                                                               profile)
+        # The trailing 'v2' causes URLs like thise one:
+        # http://127.0.0.1:9292/v2/v1/images
+        g_endpoint_url = re.sub('/v2', '', g_endpoint_url['internalurl'])
+        kwargs['endpoint_url'] = g_endpoint_url
+        log.debug('Calling keystoneclient.v2_0.client.Client(%s, **%s)',
+                  ks_endpoint, kwargs)
+        with _timed(profile, 'auth'):
+            keystone = _keystone().Client(**kwargs)
+            token = keystone.get_token(keystone.session)
+        entry = {'token': token,
+                 'expires': _token_expires(keystone),
+                 'endpoint': g_endpoint_url}
+        if token_cache != 'off':
+            _auth_cache_set(profile, digest, entry, persist)
+    else:
+        log.debug('Using cached keystone token for profile %s', profile)
+
+    kwargs['endpoint_url'] = entry['endpoint']
+    kwargs['token'] = entry['token']
+    # This doesn't realy prevent the password to show up
+    # in the minion log as keystoneclient.session is
+    # logging it anyway when in debug-mode
+    kwargs.pop('password', None)
+    return entry['endpoint'], kwargs
+
+
+def _auth(profile=None, api_version=2, **connection_args):
+    '''
+    Set up glance credentials, returns
+    `glanceclient.client.Client`. Optional parameter
+    "api_version" defaults to 2.
+
+    Only intended to be used within glance-enabled modules
+    '''
+    endpoint, kwargs = _auth_info(profile, api_version, **connection_args)
+    log.debug('Calling glanceclient.client.Client(%s, %s, **%s)',
+              api_version, endpoint, kwargs)
+    # may raise exc.HTTPUnauthorized, exc.HTTPNotFound
+    # but we deal with those elsewhere
+    return _pooled(_glance()[0].Client(api_version, endpoint, **kwargs),
+                   profile, endpoint)
+
+
+def _pooled(client, profile, endpoint):
+    '''
+    Makes a glanceclient client use the pooled HTTP session of the profile
+    and endpoint instead of the one it created.
+
+    glanceclient's HTTPClient sends the token and all other per request
+    headers with each request, so one session can serve every client of
+    an endpoint. The session is only configured when it is created, and
+    stores no cookies, so that threads can share it.
+    '''
+    http_client = getattr(client, 'http_client', None)
+    own = getattr(http_client, 'session', None)
+    pool_size = int(_config_get(profile, 'http_pool_size',
+                                _DEFAULT_HTTP_POOL_SIZE))
+    if own is None or not pool_size:
+        return client
+    key = (profile, endpoint)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            import requests
+            try:
+                from http.cookiejar import DefaultCookiePolicy
+            except ImportError:
+                from cookielib import DefaultCookiePolicy
+            session = requests.Session()
+            session.headers.update(own.headers)
+            # Tokens are sent per request; one left in the shared headers
+            # would outlive _invalidate_auth and reach other callers
+            session.headers.pop('X-Auth-Token', None)
+            session.verify = own.verify
+            session.cert = own.cert
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size,
+                max_retries=int(_config_get(profile, 'http_retries', 0)))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSIONS[key] = session
+    http_client.session = session
+    own.close()
+    timeout = _config_get(profile, 'http_timeout')
+    if timeout:
+        http_client.timeout = float(timeout)
+    return client
+
+
+class _timed(object):
+    '''
+    Context manager recording the duration of a remote operation.
+    '''
+
+    def __init__(self, profile, operation):
+        self.profile = profile
+        self.operation = operation
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _record(self.profile, self.operation, time.time() - self.start,
+                error=exc_type is not None)
+        return False
+
+
+def _record(profile, operation, seconds, error=False):
+    '''
+    Adds one call of a remote operation to the statistics of a profile.
+    '''
+    with _STATS_LOCK:
+        ops = _STATS.setdefault(profile or 'default', {})
+        entry = ops.setdefault(operation, {'count': 0, 'errors': 0,
+                                           'seconds': 0.0, 'max': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['max'] = max(entry['max'], seconds)
+        if error:
+            entry['errors'] += 1
+        if not _STATS_FLUSHED['hooked']:
+            # Run when the job's process exits; multiprocessing also runs
+            # its finalizers from atexit in the main process
+            Finalize(None, _flush_stats, exitpriority=0)
+            _STATS_FLUSHED['hooked'] = True
+        due = time.time() - _STATS_FLUSHED['at'] >= _STATS_FLUSH_INTERVAL
+    if due:
+        _flush_stats()
+
+
+def _http_counts():
+    '''
+    Returns the requests sent and connections opened so far by the pooled
+    sessions of this process, keyed by (profile, endpoint).
+    '''
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.items())
+    counts = {}
+    for key, session in sessions:
+        entry = {'requests': 0, 'connections': 0, 'pool_size': 0}
+        for adapter in set(session.adapters.values()):
+            entry['pool_size'] = adapter.poolmanager.connection_pool_kw.get(
+                'maxsize', 0)
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                entry['requests'] += pool.num_requests
+                entry['connections'] += pool.num_connections
+        counts[key] = entry
+    return counts
+
+
+def _flush_stats():
+    '''
+    Merges the counters of this process into the stats.json cache file.
+    A minion runs every job in a process of its own by default, so the
+    counters only add up across jobs there.
+    '''
+    http = _http_counts()
+    with _STATS_LOCK:
+        _STATS_FLUSHED['at'] = time.time()
+        pending_http = {}
+        for key, entry in http.items():
+            flushed = _HTTP_FLUSHED.get(key, {})
+            delta = dict((counter, entry[counter] - flushed.get(counter, 0))
+                         for counter in ('requests', 'connections'))
+            if any(delta.values()) or key not in _HTTP_FLUSHED:
+                delta['pool_size'] = entry['pool_size']
+                pending_http[key] = delta
+            _HTTP_FLUSHED[key] = entry
+        if not _STATS and not pending_http:
+            return
+        data = _read_cache_file('stats.json')
+        calls = data.setdefault('calls', {})
+        for name, ops in _STATS.items():
+            for operation, entry in ops.items():
+                merged = calls.setdefault(name, {}).setdefault(
+                    operation, {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                'max': 0.0})
+                for counter in ('count', 'errors', 'seconds'):
+                    merged[counter] += entry[counter]
+                merged['max'] = max(merged['max'], entry['max'])
+        sessions = data.setdefault('http', {})
+        for (name, endpoint), delta in pending_http.items():
+            merged = sessions.setdefault(name or 'default', {}).setdefault(
+                endpoint, {'requests': 0, 'connections': 0})
+            merged['requests'] += delta['requests']
+            merged['connections'] += delta['connections']
+            merged['pool_size'] = delta['pool_size']
+        _write_cache_file('stats.json', data)
+        _STATS.clear()
+
+
+def _timed_iter(profile, operation, iterable, elapsed=0.0):
+    '''
+    Wraps a lazy listing so that the time spent fetching its pages is
+    recorded as one call once the listing is exhausted or dropped.
+    '''
+    error = False
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterable)
+            except StopIteration:
+                break
+            except Exception:
+                error = True
+                raise
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        _record(profile, operation, elapsed, error=error)
+
+
+def _prime(iterable):
+    '''
+    Fetches the first item of a lazy listing so that authentication
+    errors surface where they can still be retried.
+    '''
+    try:
+        first = next(iterable)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], iterable)
+
+
+def _api(profile, operation, *args, **kwargs):
+    '''
+    Calls ``operation`` (e.g. ``'tasks.get'``) on a Glance V2 client for
+    the given profile. If Glance rejects a cached token, the cache for
+    the profile is dropped and the call is retried once with a new token.
+    '''
+    return _call(profile, None, operation, args, kwargs)
+
+
+def _node_api(profile, endpoint, operation, *args, **kwargs):
+    '''
+    Like _api, but talks to the glance-api at endpoint instead of the one
+    from the Keystone catalog. Needed for node local resources like the
+    image cache, which a load balanced catalog endpoint can't address.
+    '''
+    return _call(profile, endpoint, operation, args, kwargs)
+
+
+def _call(profile, endpoint, operation, args, kwargs):
+    for attempt in (1, 2):
+        if endpoint is None:
+            func = _auth(profile, api_version=2)
+        else:
+            client_kwargs = _auth_info(profile, api_version=2)[1]
+            client_kwargs['endpoint_url'] = endpoint
+            func = _pooled(_glance()[0].Client(2, endpoint, **client_kwargs),
+                           profile, endpoint)
+        for attr in operation.split('.'):
+            func = getattr(func, attr)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return _timed_iter(profile, operation, _prime(result),
+                                   time.time() - start)
+            _record(profile, operation, time.time() - start)
+            return result
+        except _glance_exc().HTTPUnauthorized:
+            _record(profile, operation, time.time() - start, error=True)
+            if attempt == 2:
+                raise
+            log.debug('Glance rejected the token for profile %s, '
+                      're-authenticating', profile)
+            _invalidate_auth(profile)
+
 
 def _validate_image_params(visibility=None, container_format='bare',
                            disk_format='raw', tags=None, **kwargs):
@@ -255,12 +786,10 @@ def task_create(task_type, profile=None, input_params=None):
     :param input_params: Dictionary with input parameters for a task
     :return: Dictionary with created task's parameters
     """
-    g_client = _auth(profile, api_version=2)
-    log.debug(
-        'Task type: {}\nInput params: {}'.format(task_type, input_params)
-    )
-    task = g_client.tasks.create(type=task_type, input=input_params)
-    log.debug("Created task: {}".format(dict(task)))
+    log.debug('Task type: %s\nInput params: %s', task_type, input_params)
+    task = _api(profile, 'tasks.create', type=task_type, input=input_params)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Created task: %s", dict(task))
     created_task = task_show(task.id, profile=profile)
     return created_task
 
@@ -273,106 +802,1872 @@ def task_show(task_id, profile=None):
     :param profile: Authentication profile
     :return: Dictionary with created task's parameters
     """
-    g_client = _auth(profile)
     ret = {}
     try:
-        task = g_client.tasks.get(task_id)
-    except exc.HTTPNotFound:
+        task = _api(profile, 'tasks.get', task_id)
+    except _glance_exc().HTTPNotFound:
         return {
             'result': False,
             'comment': 'No task with ID {0}'.format(task_id)
         }
-    pformat = pprint.PrettyPrinter(indent=4).pformat
-    log.debug('Properties of task {0}:\n{1}'.format(
-        task_id, pformat(task)))
-
-    schema = image_schema(schema_type='task', profile=profile)
-    if len(schema.keys()) == 1:
-        schema = schema['task']
-    for key in schema.keys():
-        if key in task:
-            ret[key] = task[key]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Properties of task %s:\n%s', task_id,
+                  pprint.PrettyPrinter(indent=4).pformat(task))
+
+    keys = _schema_keys('task', profile)
+    for key, value in task.items():
+        if key in keys:
+            ret[key] = value
     return ret
 
 
-def task_list(profile=None):
+def _timestamp(value):
+    '''
+    Converts epoch seconds to the ISO 8601 format used by Glance, so that
+    timestamps can be compared as strings. Strings are returned unchanged.
+    '''
+    if isinstance(value, (int, float)):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+    return value
+
+
+def task_iter(profile=None, status=None, task_type=None, limit=None,
+              marker=None, sort_key=None, sort_dir=None, since=None,
+              page_size=None):
+    """
+    Iterate over Glance V2 tasks page by page
+
+    Generator used by other modules and states, it yields the tasks one
+    by one without building the whole listing in memory. Status, type,
+    marker and sorting are handled by the Glance API, limit here, as
+    glanceclient only pages through the tasks.
+
+    :param profile: Authentication profile
+    :param status: Only tasks with this status (pending, processing,
+                   success, failure)
+    :param task_type: Only tasks of this type (e.g. import)
+    :param limit: Maximum number of tasks to return
+    :param marker: ID of the last task of the previous page
+    :param sort_key: Attribute to sort by (created_at by default)
+    :param sort_dir: asc or desc (default)
+    :param since: Only tasks updated at or after this ISO 8601 timestamp
+                  or epoch time
+    :param page_size: Number of tasks requested per page
+    :return: Generator of dictionaries with task parameters
+    """
+    filters = {}
+    if status:
+        filters['status'] = status
+    if task_type:
+        filters['type'] = task_type
+    if marker:
+        filters['marker'] = marker
+    # glanceclient only accepts id, type and status as sort_key, while
+    # the API also sorts by created_at and updated_at; filters are passed
+    # on as they are
+    if sort_key:
+        filters['sort_key'] = sort_key
+    if sort_dir:
+        filters['sort_dir'] = sort_dir
+    kwargs = {'filters': filters}
+    if limit:
+        page_size = min(int(page_size or limit), int(limit))
+    if page_size:
+        kwargs['page_size'] = int(page_size)
+
+    since = _timestamp(since)
+    # When sorted by updated_at, newest first, no task after the first
+    # one older than "since" can match, so stop paging there.
+    stop_early = sort_key == 'updated_at' and sort_dir in (None, 'desc')
+    keys = _schema_keys('task', profile)
+
+    def matching():
+        for task in _api(profile, 'tasks.list', **kwargs):
+            if since and task.get('updated_at', '') < since:
+                if stop_early:
+                    return
+                continue
+            yield task
+    for task in itertools.islice(matching(), int(limit) if limit else None):
+        yield dict((key, value) for key, value in task.items()
+                   if key in keys)
+
+
+def task_list(profile=None, status=None, task_type=None, limit=None,
+              marker=None, sort_key=None, sort_dir=None, since=None,
+              page_size=None):
     """
     List Glance V2 tasks
 
     :param profile: Authentication profile
+    :param status: Only tasks with this status (pending, processing,
+                   success, failure)
+    :param task_type: Only tasks of this type (e.g. import)
+    :param limit: Maximum number of tasks to return
+    :param marker: ID of the last task of the previous page
+    :param sort_key: Attribute to sort by (created_at by default)
+    :param sort_dir: asc or desc (default)
+    :param since: Only tasks updated at or after this ISO 8601 timestamp
+                  or epoch time
+    :param page_size: Number of tasks requested per page
     :return: Dictionary with existing tasks
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.task_list status=processing limit=20
     """
-    g_client = _auth(profile)
     ret = {}
-    tasks = g_client.tasks.list()
-    schema = image_schema(schema_type='task', profile=profile)
-    if len(schema.keys()) == 1:
-        schema = schema['task']
-    for task in tasks:
-        task_dict = {}
-        for key in schema.keys():
-            if key in task:
-                task_dict[key] = task[key]
-        ret[task['id']] = task_dict
+    for task in task_iter(profile=profile, status=status,
+                          task_type=task_type, limit=limit, marker=marker,
+                          sort_key=sort_key, sort_dir=sort_dir, since=since,
+                          page_size=page_size):
+        ret[task['id']] = task
     return ret
 
 
+def import_journal_get(name, profile=None):
+    """
+    Returns the journal entry of an import task that was submitted for an
+    image by an earlier run and may still be in flight.
+
+    :param name: Name of the image
+    :param profile: Authentication profile
+    :return: Dictionary with the keys task_id, location, checksum and
+             created, or {} if there is no entry
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.import_journal_get cirros
+    """
+    journal = _read_cache_file('import_journal.json')
+    return journal.get(profile or '', {}).get(name, {})
+
+
+def import_journal_list(profile=None):
+    """
+    Lists the import tasks recorded in the journal for a profile
+
+    :param profile: Authentication profile
+    :return: Dictionary mapping image names to journal entries
+    """
+    return _read_cache_file('import_journal.json').get(profile or '', {})
+
+
+def import_journal_add(name, task_id, location=None, checksum=None,
+                       profile=None):
+    """
+    Records a submitted import task in the journal kept in the minion
+    cachedir, so that a later run can resume waiting for it instead of
+    importing the image again.
+
+    :param name: Name of the image
+    :param task_id: ID of the import task
+    :param location: URL the image is imported from
+    :param checksum: Expected checksum of the image
+    :param profile: Authentication profile
+    :return: The journal entry
+    """
+    entry = {'task_id': task_id,
+             'location': location,
+             'checksum': checksum,
+             'created': time.time()}
+    with _JOURNAL_LOCK:
+        journal = _read_cache_file('import_journal.json')
+        journal.setdefault(profile or '', {})[name] = entry
+        _write_cache_file('import_journal.json', journal)
+    return entry
+
+
+def import_journal_remove(name, profile=None):
+    """
+    Removes the journal entry of an image once its import task finished
+
+    :param name: Name of the image
+    :param profile: Authentication profile
+    :return: True if an entry was removed
+    """
+    with _JOURNAL_LOCK:
+        journal = _read_cache_file('import_journal.json')
+        if journal.get(profile or '', {}).pop(name, None) is None:
+            return False
+        _write_cache_file('import_journal.json', journal)
+    return True
+
+
+def _owner_cache_ttl(profile=None):
+    return _config_get(profile, 'owner_cache_ttl', _DEFAULT_OWNER_TTL)
+
+
+def _owner_cache_get(names, profile=None):
+    '''
+    Returns {name: owner} for the names resolved less than
+    owner_cache_ttl seconds ago, by this process or an earlier one.
+    '''
+    cutoff = time.time() - float(_owner_cache_ttl(profile))
+    entries = _OWNER_CACHE.setdefault(profile or '', {})
+    if any(entries.get(name, (None, 0))[1] <= cutoff for name in names):
+        stored = _read_cache_file('owners.json').get(profile or '', {})
+        for name, entry in stored.items():
+            if entry[1] > entries.get(name, (None, 0))[1]:
+                entries[name] = entry
+    return dict((name, entries[name][0]) for name in names
+                if entries.get(name, (None, 0))[1] > cutoff)
+
+
+def _owner_cache_set(owners, profile=None):
+    '''
+    Caches the owners of the image names in owners, {name: owner}.
+    '''
+    now = time.time()
+    cutoff = now - float(_owner_cache_ttl(profile))
+    entries = _OWNER_CACHE.setdefault(profile or '', {})
+    with _OWNER_LOCK:
+        data = _read_cache_file('owners.json')
+        stored = dict((name, entry) for name, entry
+                      in data.get(profile or '', {}).items()
+                      if entry[1] > cutoff)
+        for name, owner in owners.items():
+            entries[name] = stored[name] = [owner, now]
+        data[profile or ''] = stored
+        _write_cache_file('owners.json', data)
+
+
 def get_image_owner_id(name, profile=None):
     """
     Mine function to get image owner
 
+    Only images with the given name are requested from Glance and the
+    first match is used.
+
     :param name: Name of the image
     :param profile: Authentication profile
     :return: Image owner ID or [] if image is not found
     """
-    g_client = _auth(profile)
-    image_id = None
-    for image in g_client.images.list():
-        if image.name == name:
-            image_id = image.id
-            continue
-    if not image_id:
-        return []
-    try:
-        image = g_client.images.get(image_id)
-    except exc.HTTPNotFound:
-        return []
-    return image['owner']
+    cached = _owner_cache_get([name], profile)
+    if name in cached:
+        return cached[name]
+    owner = []
+    for image in _api(profile, 'images.list', filters={'name': name}):
+        if image.get('name') == name:
+            owner = image.get('owner') or []
+            break
+    _owner_cache_set({name: owner}, profile)
+    return owner
 
 
-def image_schema(schema_type='image', profile=None):
+def get_image_owner_ids(names, profile=None, page_size=100):
+    """
+    Mine function to get the owners of many images
+
+    Resolves all names in a single paginated image listing, which stops
+    as soon as every name has been found. Results are cached for
+    "keystone.owner_cache_ttl" seconds, also in the minion cachedir, so
+    that the next Mine run can use them.
+
+    :param names: List of image names
+    :param profile: Authentication profile
+    :param page_size: Number of images requested per page
+    :return: Dictionary mapping image names to owner IDs, [] for images
+             that were not found
+    """
+    if not isinstance(names, (list, tuple, set)):
+        names = [names]
+    ret = _owner_cache_get(names, profile)
+    wanted = set(names) - set(ret)
+    if wanted:
+        # Only the names resolved now are cached, entries served from the
+        # cache keep their age
+        resolved = set(wanted)
+        for image in _api(profile, 'images.list', page_size=page_size):
+            name = image.get('name')
+            if name in wanted:
+                ret[name] = image.get('owner') or []
+                wanted.discard(name)
+                if not wanted:
+                    break
+        for name in wanted:
+            ret[name] = []
+        _owner_cache_set(dict((name, ret[name]) for name in resolved),
+                         profile)
+    return ret
+
+
+_DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_HASH_TYPES = ('md5', 'sha256', 'sha512')
+# Image property recording a digest verified by image_upload
+_HASH_PROPERTY = 'glanceng_{0}'
+# Disk formats image_upload converts to raw, and the image properties
+# recording the format and the digests of the data before the conversion
+_CONVERTIBLE_FORMATS = ('qcow2', 'vmdk')
+_SOURCE_PROPERTY = 'glanceng_source_{0}'
+
+
+def _validate_hashes(hashes=None, checksum=None):
     '''
-    Returns names and descriptions of the schema "image"'s
-    properties for this profile's instance of glance
+    Returns the expected digests as {hash type: lower case hex digest}.
+    checksum is the expected MD5 digest, as in the older arguments.
+    '''
+    expected = dict((str(algo).lower(), str(digest).lower())
+                    for algo, digest in (hashes or {}).items() if digest)
+    unknown = set(expected) - set(_HASH_TYPES)
+    if unknown:
+        raise SaltInvocationError('"hashes" may only contain the following '
+                                  'hash types: {0}'.format(
+                                      ', '.join(_HASH_TYPES)))
+    if checksum:
+        if expected.setdefault('md5', checksum.lower()) != checksum.lower():
+            raise SaltInvocationError('"checksum" and the md5 entry of '
+                                      '"hashes" differ')
+    return expected
 
-    CLI Example:
 
-    .. code-block:: bash
+class _HashMismatch(Exception):
+    pass
 
-        salt '*' glance.image_schema
+
+class _ChunkReader(object):
+    '''
+    File-like view of an iterator of chunks, as expected by
+    glanceclient's images.upload. Every chunk passes through the given
+    hash objects on its way to Glance.
+
+    If expected digests are given, the reader keeps one chunk in hand
+    and compares them once the source is exhausted, before the last
+    chunk is passed on. A mismatch raises _HashMismatch, which aborts
+    the upload while Glance is still waiting for data.
     '''
-    return schema_get(schema_type, profile)
 
+    def __init__(self, chunks, digests=None, expected=None):
+        self.chunks = iter(chunks)
+        self.digests = digests or {}
+        self.expected = expected or {}
+        self.bytes_read = 0
+        self._next = None
 
-def schema_get(name, profile=None):
+    def _pull(self):
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            for digest in self.digests.values():
+                digest.update(chunk)
+            self.bytes_read += len(chunk)
+            return chunk
+        return b''
+
+    def _verify(self):
+        for algo, expected in sorted(self.expected.items()):
+            actual = self.digests[algo].hexdigest()
+            if actual != expected:
+                raise _HashMismatch('{0} of the data is {1}, should be '
+                                    '{2}'.format(algo, actual, expected))
+
+    def read(self, size=-1):
+        if self._next is None:
+            self._next = self._pull()
+        chunk = self._next
+        if chunk:
+            self._next = self._pull()
+        if not self._next:
+            self._verify()
+        return chunk
+
+    def __iter__(self):
+        chunk = self.read()
+        while chunk:
+            yield chunk
+            chunk = self.read()
+
+
+def _read_chunks(fh_, chunk_size):
+    chunk = fh_.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = fh_.read(chunk_size)
+
+
+def _sparse_chunks(fh_, size, chunk_size):
     '''
-    Known valid names of schemas are:
-      - image
-      - images
-      - member
-      - members
+    Reads a sparse file. Its holes are not read from disk, zeros are sent
+    for them right away.
+    '''
+    zeros = b'\0' * chunk_size
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fh_.fileno(), offset, os.SEEK_DATA)
+        except OSError:
+            # Only a hole is left
+            data = size
+        while offset < data:
+            length = min(chunk_size, data - offset)
+            yield zeros[:length]
+            offset += length
+        if offset >= size:
+            break
+        hole = os.lseek(fh_.fileno(), offset, os.SEEK_HOLE)
+        fh_.seek(offset)
+        while offset < hole:
+            chunk = fh_.read(min(chunk_size, hole - offset))
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
 
-    CLI Example:
 
-    .. code-block:: bash
+def _mmap_chunks(fh_, size, chunk_size):
+    mapped = mmap.mmap(fh_.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for offset in range(0, size, chunk_size):
+            yield mapped[offset:offset + chunk_size]
+    finally:
+        mapped.close()
 
-        salt '*' glance.schema_get name=f16-jeos
+
+def _open_source(source, chunk_size=_DEFAULT_CHUNK_SIZE, timeout=60):
     '''
-    g_client = _auth(profile)
-    pformat = pprint.PrettyPrinter(indent=4).pformat
-    schema_props = {}
-    for prop in g_client.schemas.get(name).properties:
-        schema_props[prop.name] = prop.description
-    log.debug('Properties of schema {0}:\n{1}'.format(
-        name, pformat(schema_props)))
-    return {name: schema_props}
+    Opens an http(s) URL or a local file (path or file:// URL) for
+    streaming. Returns an iterator of chunks of at most chunk_size bytes,
+    the size of the data if known and a function closing the source.
+    Local files are memory mapped rather than read.
+    '''
+    if source.startswith(('http://', 'https://')):
+        import requests
+        resp = requests.get(source, stream=True, timeout=timeout)
+        resp.raise_for_status()
+        size = resp.headers.get('Content-Length')
+        return (resp.iter_content(chunk_size),
+                int(size) if size else None,
+                resp.close)
+    if source.startswith('file://'):
+        source = source[len('file://'):]
+    fh_ = open(source, 'rb')
+    stat = os.fstat(fh_.fileno())
+    size = stat.st_size
+    if not size:
+        return _read_chunks(fh_, chunk_size), size, fh_.close
+    if hasattr(os, 'SEEK_HOLE') and \
+            getattr(stat, 'st_blocks', size) * 512 < size:
+        return _sparse_chunks(fh_, size, chunk_size), size, fh_.close
+    chunks = _mmap_chunks(fh_, size, chunk_size)
+
+    def close():
+        chunks.close()
+        fh_.close()
+    return chunks, size, close
+
+
+class _ConvertError(Exception):
+    pass
+
+
+def _convert_source(source, source_format, expected, timeout=60):
+    '''
+    Converts the image data at source to a sparse raw file with qemu-img,
+    which needs random access to its input: http(s) sources are first
+    downloaded with image_fetch, which resumes interrupted downloads and
+    computes the digests on the way; local files are read once for them.
+    The expected digests are verified on the source data. Returns the
+    path of the raw file, the digests of the source data and a function
+    removing the files made on the way.
+    '''
+    qemu_img = __salt__['cmd.which']('qemu-img')
+    if not qemu_img:
+        raise _ConvertError('qemu-img is not installed')
+    workdir = _cache_file('convert')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    raw = os.path.join(workdir, key + '.raw')
+    made = [raw]
+
+    def cleanup():
+        for path in made:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    try:
+        if source.startswith(('http://', 'https://')):
+            path = os.path.join(workdir, '{0}.{1}'.format(key, source_format))
+            fetched = image_fetch(source, path, timeout=timeout,
+                                  hashes=expected)
+            if fetched.get('result') is False:
+                raise _ConvertError(fetched['comment'])
+            made.append(path)
+            digests = fetched['hashes']
+        else:
+            path = source[len('file://'):] \
+                if source.startswith('file://') else source
+            hashes = dict((algo, hashlib.new(algo))
+                          for algo in set(expected) | set(['md5']))
+            chunks, _, close = _open_source(path)
+            try:
+                for _ in _ChunkReader(chunks, hashes, expected):
+                    pass
+            finally:
+                close()
+            digests = dict((algo, digest.hexdigest())
+                           for algo, digest in hashes.items())
+        out = __salt__['cmd.run_all']([qemu_img, 'convert', '-f',
+                                       source_format, '-O', 'raw', '-S',
+                                       '4k', path, raw], python_shell=False)
+        if out['retcode'] != 0:
+            raise _ConvertError('qemu-img failed: {0}'.format(
+                out.get('stderr', '').strip()))
+    except Exception:
+        cleanup()
+        raise
+    return raw, digests, cleanup
+
+
+def image_upload(name, source, profile=None, visibility='public',
+                 protected=False, disk_format='raw', container_format='bare',
+                 tags=None, checksum=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+                 timeout=60, hashes=None, source_format=None):
+    """
+    Create an image and stream its data into Glance
+
+    The data is read from an http(s) URL or a local file in chunks of
+    chunk_size bytes and sent straight to the Glance V2 upload API,
+    without being staged on local disk. The MD5 checksum and the digests
+    listed in hashes are all computed in the same pass over the data. If
+    one of them doesn't match, the upload is aborted before Glance
+    receives the last chunk and the image is deleted again. Verified
+    digests are recorded as glanceng_<hash type> image properties, see
+    image_verified_hashes.
+
+    :param name: Name of the image
+    :param source: http(s) URL, file:// URL or path of the image data
+    :param profile: Authentication profile
+    :param visibility: public, private, shared or community
+    :param protected: If true, image will not be deletable. It is set once
+                      the uploaded data is verified, so that a failed
+                      upload can still be deleted.
+    :param disk_format: Format of the disk
+    :param container_format: Format of the container
+    :param tags: List of strings related to the image
+    :param checksum: Expected MD5 checksum of the image data
+    :param chunk_size: Bytes read from the source and sent at a time
+    :param timeout: Timeout in seconds for connecting to an http source
+    :param hashes: Expected digests of the image data, keyed by hash type
+                   (md5, sha256 or sha512)
+    :param source_format: qcow2 or vmdk to convert the data from that
+                          format to raw with qemu-img before uploading it,
+                          e.g. for Ceph RBD stores, where only raw images
+                          can be cloned. disk_format is raw then; the
+                          checksum and hashes are those of the source
+                          data, and are recorded together with the format
+                          as glanceng_source_<hash type or "format">
+                          properties.
+    :return: Dictionary with the image's id, status, size, checksum and
+             computed digests, or with 'result': False and a 'comment'
+             on failure
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_upload cirros \\
+            http://download.cirros-cloud.net/0.3.5/cirros-0.3.5-x86_64-disk.img \\
+            disk_format=qcow2 \\
+            hashes='{sha256: 932890e4...}'
+    """
+    expected = _validate_hashes(hashes, checksum)
+    properties = {}
+    cleanup = None
+    if source_format:
+        if source_format not in _CONVERTIBLE_FORMATS:
+            raise SaltInvocationError('"source_format" needs to be one of '
+                                      'the following: {0}'.format(
+                                          ', '.join(_CONVERTIBLE_FORMATS)))
+        disk_format = 'raw'
+    _validate_image_params(visibility=visibility,
+                           container_format=container_format,
+                           disk_format=disk_format, tags=tags)
+    if source_format:
+        start = time.time()
+        try:
+            source, source_digests, cleanup = _convert_source(
+                source, source_format, expected, timeout)
+        except Exception as err:  # pylint: disable=broad-except
+            log.debug('Conversion of %s from %s failed: %s', name, source,
+                      err)
+            return {'result': False,
+                    'comment': 'Conversion of image {0} from {1} failed: '
+                               '{2}'.format(name, source, err)}
+        log.debug('Converted %s from %s in %.1fs', name, source_format,
+                  time.time() - start)
+        properties = dict((_SOURCE_PROPERTY.format(algo), digest)
+                          for algo, digest in source_digests.items())
+        properties[_SOURCE_PROPERTY.format('format')] = source_format
+        # The digests of the raw data are not known in advance
+        expected = {}
+    try:
+        # Made protected only once the data is verified, Glance refuses
+        # to delete a protected image if the upload fails
+        image = _api(profile, 'images.create', name=name,
+                     visibility=visibility, disk_format=disk_format,
+                     container_format=container_format, tags=tags or [],
+                     **properties)
+        image_id = image['id']
+        start = time.time()
+        digests = dict((algo, hashlib.new(algo))
+                       for algo in set(expected) | set(['md5']))
+        try:
+            chunks, size, close = _open_source(source, int(chunk_size),
+                                               timeout)
+            try:
+                reader = _ChunkReader(chunks, digests, expected)
+                g_client = _auth(profile, api_version=2)
+                # Not retried through _api, a consumed stream can't be
+                # resent
+                with _timed(profile, 'images.upload'):
+                    g_client.images.upload(image_id, reader,
+                                           image_size=size)
+            finally:
+                close()
+        except Exception as err:  # pylint: disable=broad-except
+            log.debug('Upload of %s from %s failed: %s', name, source, err)
+            _image_delete_quietly(image_id, profile)
+            return {'result': False,
+                    'comment': 'Upload of image {0} from {1} failed: '
+                               '{2}'.format(name, source, err)}
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    computed = dict((algo, digest.hexdigest())
+                    for algo, digest in digests.items())
+    md5 = computed['md5']
+    image = _api(profile, 'images.get', image_id)
+    ret = {'id': image_id,
+           'name': name,
+           'status': image.get('status'),
+           'size': reader.bytes_read,
+           'checksum': image.get('checksum'),
+           'md5': md5,
+           'hashes': computed,
+           'seconds': round(time.time() - start, 3)}
+    if source_format:
+        ret['source_format'] = source_format
+    if image.get('checksum') and image['checksum'] != md5:
+        comment = 'Glance reports checksum {0} for image {1}, but {2} was ' \
+            'uploaded'.format(image['checksum'], name, md5)
+    else:
+        properties = dict((_HASH_PROPERTY.format(algo), computed[algo])
+                          for algo in expected)
+        if protected:
+            properties['protected'] = True
+        if not properties:
+            return ret
+        try:
+            _api(profile, 'images.update', image_id, **properties)
+            return ret
+        except Exception as err:  # pylint: disable=broad-except
+            if not protected:
+                log.warning('Unable to record the digests of image %s: %s',
+                            image_id, err)
+                return ret
+            comment = 'Unable to protect image {0}: {1}'.format(name, err)
+    _image_delete_quietly(image_id, profile)
+    ret.update({'result': False, 'comment': comment})
+    return ret
+
+
+def image_verified_hashes(image_id, profile=None):
+    """
+    Return the digests image_upload verified for an image
+
+    They are read from the image's glanceng_<hash type> properties, so
+    that later runs can check the expected digests of an existing image
+    without reading its data again. For images converted to raw, the
+    digests of the source data (glanceng_source_<hash type>) are
+    returned, including its md5.
+
+    :param image_id: ID of the image
+    :param profile: Authentication profile
+    :return: Dictionary of hex digests keyed by hash type
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_verified_hashes 397f4ba1-...
+    """
+    image = _api(profile, 'images.get', image_id)
+    return _known_hashes(image)
+
+
+def _known_hashes(image):
+    '''
+    Returns the digests recorded for an image, those of the source data
+    for images image_upload converted to raw.
+    '''
+    prop = _SOURCE_PROPERTY if image.get(_SOURCE_PROPERTY.format('format')) \
+        else _HASH_PROPERTY
+    return dict((algo, image[prop.format(algo)]) for algo in _HASH_TYPES
+                if image.get(prop.format(algo)))
+
+
+def image_update(image_id, profile=None, visibility=None, protected=None,
+                 tags=None):
+    """
+    Update the visibility, protected flag or tags of an image
+
+    :param image_id: ID of the image
+    :param profile: Authentication profile
+    :param visibility: public, private, shared or community
+    :param protected: If true, image will not be deletable
+    :param tags: Complete list of tags of the image
+    :return: The updated image
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_update 397f4ba1-... visibility=private
+    """
+    _validate_image_params(visibility=visibility, tags=tags)
+    kwargs = {}
+    if visibility is not None:
+        kwargs['visibility'] = visibility
+    if protected is not None:
+        kwargs['protected'] = bool(protected)
+    if tags is not None:
+        kwargs['tags'] = list(tags)
+    return dict(_api(profile, 'images.update', image_id, **kwargs))
+
+
+def image_list(profile=None, page_size=100, **filters):
+    """
+    List images with all their properties
+
+    Unlike glance.image_list, custom properties such as the digests
+    recorded by image_upload are included.
+
+    :param profile: Authentication profile
+    :param page_size: Number of images requested per page
+    :param filters: Glance V2 listing filters, e.g. status=active
+    :return: List of images
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_list status=active
+    """
+    filters = dict((key, value) for key, value in filters.items()
+                   if not key.startswith('__'))
+    kwargs = {'page_size': page_size}
+    if filters:
+        kwargs['filters'] = filters
+    return [dict(image) for image in _api(profile, 'images.list', **kwargs)]
+
+
+def _plan_image(params, image):
+    '''
+    Compares an existing image with its pillar parameters. Returns the
+    changes to make to its visibility, protected flag and tags, and the
+    expected digests that differ from the ones known for the image. Only
+    parameters set in the pillar are compared; tags of the image that the
+    pillar doesn't list are kept.
+    '''
+    changes = {}
+    for attr in ('visibility', 'protected'):
+        if attr in params and params[attr] != image.get(attr):
+            changes[attr] = {'old': image.get(attr), 'new': params[attr]}
+    current = image.get('tags') or []
+    missing = [tag for tag in params.get('tags') or [] if tag not in current]
+    if missing:
+        changes['tags'] = {'old': sorted(current),
+                           'new': sorted(set(current) | set(missing))}
+    mismatch = {}
+    expected = _validate_hashes(params.get('hashes'), params.get('checksum'))
+    known_hashes = _known_hashes(image)
+    if not image.get(_SOURCE_PROPERTY.format('format')):
+        known_hashes['md5'] = image.get('checksum')
+    for algo, digest in expected.items():
+        known = known_hashes.get(algo)
+        if known and known != digest:
+            mismatch[algo] = {'old': known, 'new': digest}
+    return changes, mismatch
+
+
+def image_plan(profile=None, images=None, page_size=100):
+    """
+    Diff the images of the glance:client:identity pillar against Glance
+
+    Lists the images of every identity (a profile of the same name) once,
+    with a paginated listing, and compares them with the pillar in memory:
+
+    - create: images that don't exist yet, with their pillar parameters
+    - update: existing images whose visibility, protected flag or tags
+      differ, as {'id': ..., 'changes': {attribute: {'old':, 'new':}}}
+    - mismatch: existing images whose checksum, or digests recorded by
+      image_upload, differ from the pillar's checksum or hashes, as
+      {'id': ..., 'hashes': {hash type: {'old':, 'new':}}}
+    - duplicate: names used by more than one image, with their IDs
+    - unchanged: names of images that match the pillar
+
+    The listing is shared through __context__ with the glanceng states of
+    the same run as their image index, so a state run plans every image
+    with one listing per profile.
+
+    :param profile: Only plan this identity
+    :param images: Images to plan for profile instead of the pillar's, in
+                   the format of glance:client:identity:<profile>:image
+    :param page_size: Number of images requested per page
+    :return: Dictionary with the diff of each profile, or with
+             'result': False and a 'comment' for a profile whose images
+             could not be listed
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt -C 'I@glance:client' glanceng.image_plan
+        salt -C 'I@glance:client' glanceng.image_plan profile=admin_identity
+    """
+    if images is not None:
+        desired = {profile: {'image': images}}
+    else:
+        desired = __salt__['pillar.get']('glance:client:identity', {})
+        if profile is not None:
+            desired = {profile: desired.get(profile, {})}
+    indexes = __context__.setdefault('glanceng.image_index', {})
+    ret = {}
+    for name in sorted(desired, key=str):
+        wanted = (desired[name] or {}).get('image') or {}
+        try:
+            index = {}
+            for image in image_list(name, page_size=page_size):
+                index.setdefault(image.get('name'), []).append(image)
+        except Exception as err:  # pylint: disable=broad-except
+            log.debug('Unable to list the images of %s: %s', name, err)
+            ret[name] = {'result': False,
+                         'comment': 'Unable to list images: {0}'.format(err)}
+            continue
+        indexes[name] = index
+        plan = {'create': {}, 'update': {}, 'mismatch': {}, 'duplicate': {},
+                'unchanged': []}
+        for key in sorted(wanted, key=str):
+            params = wanted[key] or {}
+            image_name = params.get('name', key)
+            found = index.get(image_name, [])
+            if not found:
+                plan['create'][image_name] = params
+                continue
+            if len(found) > 1:
+                plan['duplicate'][image_name] = sorted(i['id'] for i in found)
+                continue
+            changes, mismatch = _plan_image(params, found[0])
+            if changes:
+                plan['update'][image_name] = {'id': found[0]['id'],
+                                              'changes': changes}
+            if mismatch:
+                plan['mismatch'][image_name] = {'id': found[0]['id'],
+                                                'hashes': mismatch}
+            if not changes and not mismatch:
+                plan['unchanged'].append(image_name)
+        log.debug('Image plan of %s: %s', name, plan)
+        ret[name] = plan
+    return ret
+
+
+def images_in_use(profile=None, page_size=1000):
+    """
+    Return the IDs of the images instances were booted from
+
+    The servers of all projects are listed through the Nova API found in
+    the Keystone catalog of the profile. This is the default "in use"
+    check of the glanceng.images_pruned state, which takes any function
+    with this signature. Images only used by volumes are not detected.
+
+    :param profile: Authentication profile
+    :param page_size: Number of servers requested per page
+    :return: Sorted list of image IDs
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.images_in_use
+    """
+    import requests
+    with _timed(profile, 'endpoint_get'):
+        endpoint = __salt__['keystone.endpoint_get']('nova', profile)
+    url = endpoint['internalurl'].rstrip('/') + '/servers/detail'
+    headers = {'X-Auth-Token': _auth_info(profile)[1]['token'],
+               'Accept': 'application/json'}
+    params = {'all_tenants': 1, 'limit': page_size}
+    used = set()
+    with _timed(profile, 'servers.list'):
+        while True:
+            resp = requests.get(url, params=params, headers=headers,
+                                timeout=60)
+            resp.raise_for_status()
+            body = resp.json()
+            servers = body.get('servers', [])
+            for server in servers:
+                # Volume backed servers have no image
+                image = server.get('image')
+                if isinstance(image, dict) and image.get('id'):
+                    used.add(image['id'])
+            # Nova caps pages at osapi_max_limit, which may be below
+            # page_size; only the absence of a next link ends the listing
+            if not servers or not any(
+                    link.get('rel') == 'next'
+                    for link in body.get('servers_links') or []):
+                break
+            params['marker'] = servers[-1]['id']
+    return sorted(used)
+
+
+class _Throttle(object):
+    '''
+    Token bucket limiting the bytes per second that the threads sharing
+    it send. A thread that overdraws the bucket sleeps until the debt is
+    paid, so concurrent transfers split the rate between them.
+    '''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance +
+                                 (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _throttle(profile, rate):
+    '''
+    Returns the throttle shared by all transfers to a profile, or None
+    without a rate.
+    '''
+    if not rate:
+        return None
+    with _THROTTLES_LOCK:
+        throttle = _THROTTLES.get(profile)
+        if throttle is None or throttle.rate != float(rate):
+            throttle = _THROTTLES[profile] = _Throttle(rate)
+    return throttle
+
+
+def _throttled(chunks, throttle):
+    for chunk in chunks:
+        throttle.consume(len(chunk))
+        yield chunk
+
+
+# Image attributes Glance sets itself, which are not copied to a replica
+_READ_ONLY_ATTRIBUTES = frozenset([
+    'id', 'status', 'checksum', 'size', 'virtual_size', 'created_at',
+    'updated_at', 'file', 'schema', 'self', 'owner', 'direct_url',
+    'locations', 'os_hash_algo', 'os_hash_value', 'stores'])
+# Image property naming the source of a replica, "<profile>:<image id>"
+_REPLICATED_FROM = 'glanceng_replicated_from'
+
+
+def image_replicate(image_id, source, profile=None, bandwidth=None):
+    """
+    Copy an image from one profile (region or cloud) to another
+
+    The image data is streamed from the source Glance straight into the
+    upload to the target, without being staged on local disk, and its
+    MD5 checksum is verified before the last chunk is sent. The replica
+    gets the attributes and properties of the source image, the verified
+    checksum as glanceng_md5 and "<source>:<image_id>" as
+    glanceng_replicated_from. It is only made protected once its data is
+    complete, and deleted again if the transfer fails.
+
+    :param image_id: ID of the image in the source profile
+    :param source: Authentication profile to copy the image from
+    :param profile: Authentication profile to copy the image to
+    :param bandwidth: Bytes per second all concurrent transfers to profile
+                      may use together
+    :return: Dictionary with the id, name, size and checksum of the
+             replica, or with 'result': False and a 'comment' on failure
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_replicate 397f4ba1-... region_one \
+            profile=region_two bandwidth=52428800
+    """
+    image = dict(_api(source, 'images.get', image_id))
+    if image.get('status') != 'active' or not image.get('checksum'):
+        return {'result': False,
+                'comment': 'Image {0} of {1} is not active'.format(
+                    image_id, source)}
+    properties = dict((key, value) for key, value in image.items()
+                      if key not in _READ_ONLY_ATTRIBUTES and
+                      value is not None)
+    protected = properties.pop('protected', False)
+    properties[_REPLICATED_FROM] = '{0}:{1}'.format(source, image_id)
+    replica = _api(profile, 'images.create', **properties)
+    replica_id = replica['id']
+    start = time.time()
+    digests = {'md5': hashlib.md5()}
+    try:
+        chunks = _api(source, 'images.data', image_id, do_checksum=False)
+        throttle = _throttle(profile, bandwidth)
+        if throttle is not None:
+            chunks = _throttled(chunks, throttle)
+        reader = _ChunkReader(chunks, digests, {'md5': image['checksum']})
+        g_client = _auth(profile, api_version=2)
+        # Not retried through _api, a consumed stream can't be resent
+        with _timed(profile, 'images.upload'):
+            g_client.images.upload(replica_id, reader,
+                                   image_size=image.get('size'))
+        update = {_HASH_PROPERTY.format('md5'): image['checksum']}
+        if protected:
+            update['protected'] = True
+        _api(profile, 'images.update', replica_id, **update)
+    except Exception as err:  # pylint: disable=broad-except
+        log.debug('Replication of %s from %s to %s failed: %s', image_id,
+                  source, profile, err)
+        _image_delete_quietly(replica_id, profile)
+        return {'result': False,
+                'comment': 'Replication of image {0} from {1} failed: '
+                           '{2}'.format(image.get('name'), source, err)}
+    return {'id': replica_id,
+            'name': image.get('name'),
+            'source_id': image_id,
+            'size': reader.bytes_read,
+            'checksum': digests['md5'].hexdigest(),
+            'seconds': round(time.time() - start, 3)}
+
+
+def _image_delete_quietly(image_id, profile=None):
+    try:
+        _api(profile, 'images.delete', image_id)
+    except Exception as err:  # pylint: disable=broad-except
+        log.warning('Unable to delete image %s: %s', image_id, err)
+
+
+class _FetchError(Exception):
+    pass
+
+
+class _NoRanges(_FetchError):
+    '''
+    The server answered a range request with the whole file.
+    '''
+
+
+def _fetch_plan(size, connections, segment_size=None,
+                chunk_size=_DEFAULT_CHUNK_SIZE):
+    '''
+    Splits size bytes into [start, end, next offset to write] segments.
+    '''
+    if not segment_size:
+        segment_size = min(64 * 1024 * 1024,
+                           -(-size // max(int(connections), 1)))
+    segment_size = max(int(segment_size), int(chunk_size), 1)
+    return [[start, min(start + segment_size, size) - 1, start]
+            for start in range(0, size, segment_size)]
+
+
+class _Fetch(object):
+    '''
+    State of one image_fetch call: the partial file, its resume map and
+    the hashes that follow the completed prefix of the file.
+    '''
+
+    def __init__(self, source, dest, hash_types, chunk_size, timeout):
+        self.source = source
+        self.dest = dest
+        self.part = dest + '.part'
+        self.resume_path = dest + '.resume'
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.hash_types = hash_types
+        self.digests = dict((algo, hashlib.new(algo)) for algo in hash_types)
+        self.hashed = 0
+        self.lock = threading.Lock()
+        self.resume = {}
+        self.unsaved = 0
+
+    def save_resume(self, force=False):
+        '''
+        Writes the resume map, at most every 64 chunks unless forced.
+        Must be called with the lock held.
+        '''
+        self.unsaved += 1
+        if not force and self.unsaved < 64:
+            return
+        self.unsaved = 0
+        tmp_path = '{0}.{1}.tmp'.format(self.resume_path,
+                                        threading.current_thread().ident)
+        with open(tmp_path, 'w') as fh_:
+            json.dump(self.resume, fh_)
+        os.rename(tmp_path, self.resume_path)
+
+    def advance_hash(self):
+        '''
+        Hashes the part of the file that has been written contiguously
+        from its start. Must be called with the lock held.
+        '''
+        done = self.hashed
+        for start, end, offset in sorted(self.resume['segments']):
+            if start > done:
+                break
+            done = max(done, offset)
+        if done <= self.hashed:
+            return
+        with open(self.part, 'rb') as fh_:
+            fh_.seek(self.hashed)
+            while self.hashed < done:
+                data = fh_.read(min(self.chunk_size, done - self.hashed))
+                if not data:
+                    raise _FetchError('{0} is shorter than expected'.format(
+                        self.part))
+                for digest in self.digests.values():
+                    digest.update(data)
+                self.hashed += len(data)
+
+    def fetch_segment(self, segment):
+        '''
+        Downloads the rest of one segment with a range request.
+        '''
+        import requests
+        start, end, offset = segment
+        if offset > end:
+            return
+        resp = requests.get(self.source, stream=True, timeout=self.timeout,
+                            headers={'Range': 'bytes={0}-{1}'.format(offset,
+                                                                     end)})
+        try:
+            if resp.status_code == 200:
+                raise _NoRanges()
+            resp.raise_for_status()
+            with open(self.part, 'r+b') as fh_:
+                fh_.seek(offset)
+                for chunk in resp.iter_content(self.chunk_size):
+                    chunk = chunk[:end + 1 - offset]
+                    if not chunk:
+                        break
+                    fh_.write(chunk)
+                    # Other threads hash and record what is on disk
+                    fh_.flush()
+                    offset += len(chunk)
+                    with self.lock:
+                        segment[2] = offset
+                        if offset > end:
+                            self.advance_hash()
+                        self.save_resume()
+                    if offset > end:
+                        break
+            if offset <= end:
+                raise _FetchError('Range {0}-{1} of {2} ended early at '
+                                  '{3}'.format(start, end, self.source,
+                                               offset))
+        finally:
+            resp.close()
+
+    def fetch_stream(self):
+        '''
+        Downloads the whole file with a single request.
+        '''
+        import requests
+        resp = requests.get(self.source, stream=True, timeout=self.timeout)
+        try:
+            resp.raise_for_status()
+            with open(self.part, 'wb') as fh_:
+                for chunk in resp.iter_content(self.chunk_size):
+                    fh_.write(chunk)
+                    for digest in self.digests.values():
+                        digest.update(chunk)
+                    self.hashed += len(chunk)
+        finally:
+            resp.close()
+
+
+def image_fetch(source, dest, checksum=None, hash_type='md5', connections=4,
+                segment_size=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+                timeout=60, resume=True, hashes=None):
+    """
+    Download an image source to a local file with parallel range requests
+
+    The file is preallocated as a sparse "<dest>.part" file and filled by
+    up to "connections" concurrent HTTP range requests. Progress is kept
+    in "<dest>.resume", so an interrupted download picks up where it
+    stopped when called again with the same source. The checksum and the
+    digests listed in hashes are computed while the contiguous beginning
+    of the file grows, and the file is only moved to dest if they match.
+    Servers that don't support ranges, or don't report a size, are
+    downloaded in a single stream.
+
+    :param source: http(s) URL of the image data
+    :param dest: Path of the local file
+    :param checksum: Expected hex digest of the data
+    :param hash_type: Hash algorithm of the checksum (md5, sha256, ...)
+    :param connections: Number of concurrent range requests
+    :param segment_size: Bytes per range request, by default the size
+                         divided by connections, at most 64 MiB
+    :param chunk_size: Bytes read and written at a time
+    :param timeout: Timeout in seconds for connecting and reading
+    :param resume: Continue an interrupted download of the same source
+    :param hashes: Expected md5, sha256 or sha512 digests of the data
+    :return: Dictionary with path, size, checksum, hash_type, the digests
+             of hash_type and hashes, whether ranges were used and how
+             many bytes were resumed, or with 'result': False and a
+             'comment' on failure
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_fetch \\
+            http://download.cirros-cloud.net/0.3.5/cirros-0.3.5-x86_64-disk.img \\
+            /srv/glance/cirros-0.3.5-x86_64-disk.img \\
+            checksum=f8ab98ff5e73ebab884d80c9dc9c7290
+    """
+    import requests
+    start_time = time.time()
+    chunk_size = int(chunk_size)
+    expected = _validate_hashes(hashes)
+    if checksum and expected.setdefault(hash_type, checksum.lower()) != \
+            checksum.lower():
+        raise SaltInvocationError('"checksum" and the {0} entry of '
+                                  '"hashes" differ'.format(hash_type))
+    fetch = _Fetch(source, dest, set(expected) | set([hash_type]),
+                   chunk_size, timeout)
+    ret = {'path': dest, 'hash_type': hash_type, 'ranged': False,
+           'resumed_bytes': 0}
+
+    try:
+        head = requests.head(source, allow_redirects=True, timeout=timeout)
+        head.raise_for_status()
+        size = head.headers.get('Content-Length')
+        size = int(size) if size else None
+        ranged = size is not None and size > 0 and \
+            head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        validator = head.headers.get('ETag') or \
+            head.headers.get('Last-Modified')
+
+        if ranged:
+            previous = {}
+            if resume and os.path.exists(fetch.part):
+                try:
+                    with open(fetch.resume_path) as fh_:
+                        previous = json.load(fh_)
+                except (IOError, OSError, ValueError):
+                    previous = {}
+            if previous.get('source') == source and \
+                    previous.get('size') == size and \
+                    previous.get('validator') == validator and \
+                    os.path.getsize(fetch.part) == size:
+                fetch.resume = previous
+                ret['resumed_bytes'] = sum(
+                    offset - start
+                    for start, end, offset in previous['segments'])
+            else:
+                fetch.resume = {'source': source, 'size': size,
+                                'validator': validator,
+                                'segments': _fetch_plan(size, connections,
+                                                        segment_size,
+                                                        chunk_size)}
+                with open(fetch.part, 'wb') as fh_:
+                    fh_.truncate(size)
+            with fetch.lock:
+                fetch.save_resume(force=True)
+                fetch.advance_hash()
+
+            from multiprocessing.pool import ThreadPool
+            pending = [seg for seg in fetch.resume['segments']
+                       if seg[2] <= seg[1]]
+            pool = ThreadPool(max(1, min(int(connections), len(pending) or 1)))
+            try:
+                pool.map(fetch.fetch_segment, pending)
+                ret['ranged'] = True
+            except _NoRanges:
+                log.debug('%s ignores range requests, downloading it in '
+                          'one stream', source)
+                ranged = False
+            finally:
+                pool.close()
+                pool.join()
+                with fetch.lock:
+                    fetch.save_resume(force=True)
+
+        if ranged:
+            with fetch.lock:
+                fetch.advance_hash()
+            if fetch.hashed != size:
+                raise _FetchError('Only {0} of {1} bytes of {2} were '
+                                  'downloaded'.format(fetch.hashed, size,
+                                                      source))
+        else:
+            fetch.digests = dict((algo, hashlib.new(algo))
+                                 for algo in fetch.hash_types)
+            fetch.hashed = 0
+            fetch.fetch_stream()
+    except Exception as err:  # pylint: disable=broad-except
+        log.debug('Download of %s failed: %s', source, err)
+        ret.update({'result': False,
+                    'comment': 'Download of {0} failed: {1}'.format(source,
+                                                                   err)})
+        return ret
+
+    computed = dict((algo, digest.hexdigest())
+                    for algo, digest in fetch.digests.items())
+    ret.update({'size': fetch.hashed, 'checksum': computed[hash_type],
+                'hashes': computed,
+                'seconds': round(time.time() - start_time, 3)})
+    if os.path.exists(fetch.resume_path):
+        os.unlink(fetch.resume_path)
+    for algo, digest in sorted(expected.items()):
+        if computed[algo] != digest:
+            os.unlink(fetch.part)
+            ret.update({'result': False,
+                        'comment': '{0} checksum of {1} is {2}, should be '
+                                   '{3}'.format(algo, source, computed[algo],
+                                                digest)})
+            return ret
+    os.rename(fetch.part, dest)
+    return ret
+
+
+def _cache_state(endpoint, profile=None):
+    '''
+    Returns the images cached ({id: entry}) and queued (set of ids) on the
+    glance-api at endpoint, through the cache management API.
+    '''
+    cached = _node_api(profile, endpoint, 'http_client.get',
+                       '/v1/cached_images')[1].get('cached_images', [])
+    queued = _node_api(profile, endpoint, 'http_client.get',
+                       '/v1/queued_images')[1].get('queued_images', [])
+    return dict((entry['image_id'], entry) for entry in cached), set(queued)
+
+
+def _hot_images(images=None, tags=None, profile=None):
+    '''
+    Resolves image names and tags to the active images they select.
+    Returns ({id: name}, names that matched no image).
+    '''
+    names = set(images or [])
+    tags = set(tags or [])
+    selected = {}
+    found = set()
+    for image in _api(profile, 'images.list',
+                      filters={'status': 'active'}):
+        if image.get('name') in names or tags & set(image.get('tags') or []):
+            selected[image['id']] = image.get('name') or image['id']
+            found.add(image.get('name'))
+    return selected, sorted(names - found)
+
+
+def _read_through(image_id, endpoint, profile=None):
+    '''
+    Reads an image through the glance-api at endpoint and discards the
+    data. The cache middleware of that node stores it on the way.
+    '''
+    size = 0
+    for chunk in _node_api(profile, endpoint, 'images.data', image_id):
+        size += len(chunk)
+    return size
+
+
+def image_cache_prefetch(images=None, tags=None,
+                         endpoint='http://127.0.0.1:9292', profile=None,
+                         concurrency=2, queue=True, prefetch=True):
+    """
+    Warm the image cache of one glance-api node with a list of hot images
+
+    The images, selected by name or by tag, are queued for caching on the
+    node at endpoint through the cache management API (the
+    "keystone+cachemanagement" flavor) unless they are cached or queued
+    already. With prefetch, the queued images are then read through the
+    node at most "concurrency" at a time, which stores them in its cache,
+    instead of leaving them to glance-cache-prefetcher, which fetches
+    every queued image at once. Run it on every API node, as the cache is
+    local to each of them.
+
+    :param images: List of image names
+    :param tags: List of image tags; images with any of them are selected
+    :param endpoint: URL of this node's glance-api, not the load balancer
+    :param profile: Authentication profile
+    :param concurrency: Number of images read into the cache at a time
+    :param queue: Queue uncached images; if false only report on them
+    :param prefetch: Read the queued images into the cache
+    :return: Dictionary with the node id and endpoint and the names of the
+             images that are cached, queued, prefetched, uncached (not
+             queued) or failed ({name: error}), and of the requested
+             names that match no active image as missing
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt -C 'I@glance:server' glanceng.image_cache_prefetch \\
+            images='[cirros]' tags='[hot]' concurrency=2
+    """
+    hot, missing = _hot_images(images, tags, profile)
+    cached, queued = _cache_state(endpoint, profile)
+    ret = {'node': __opts__.get('id'),
+           'endpoint': endpoint,
+           'cached': sorted(hot[i] for i in hot if i in cached),
+           'queued': [],
+           'prefetched': [],
+           'uncached': [],
+           'failed': {},
+           'missing': missing}
+    pending = [i for i in hot if i not in cached]
+    for image_id in pending:
+        if image_id in queued:
+            continue
+        if not queue:
+            ret['uncached'].append(hot[image_id])
+            continue
+        try:
+            _node_api(profile, endpoint, 'http_client.put',
+                      '/v1/queued_images/{0}'.format(image_id))
+            queued.add(image_id)
+        except Exception as err:  # pylint: disable=broad-except
+            ret['failed'][hot[image_id]] = str(err)
+    pending = [i for i in pending if i in queued]
+
+    if prefetch and pending:
+        def _fetch(image_id):
+            start = time.time()
+            try:
+                size = _read_through(image_id, endpoint, profile)
+            except Exception as err:  # pylint: disable=broad-except
+                return image_id, err
+            log.debug('Prefetched image %s (%s bytes) on %s in %.1fs',
+                      image_id, size, endpoint, time.time() - start)
+            return image_id, None
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(int(concurrency), len(pending))))
+        try:
+            results = pool.map(_fetch, pending)
+        finally:
+            pool.close()
+            pool.join()
+        for image_id, err in results:
+            if err is not None:
+                ret['failed'][hot[image_id]] = str(err)
+        cached, queued = _cache_state(endpoint, profile)
+        ret['prefetched'] = sorted(hot[i] for i in pending if i in cached)
+    ret['queued'] = sorted(hot[i] for i in pending if i in queued and
+                           i not in cached and
+                           hot[i] not in ret['failed'])
+    ret['uncached'].sort()
+    return ret
+
+
+def image_cache_prune(runas='glance', conf='/etc/glance/glance-cache.conf',
+                      max_size=None):
+    """
+    Run the Glance image cache pruner on this node
+
+    Meant to be called by a reactor on the "high" event of the
+    glance_image_cache beacon, so the cache is pruned when it grows past
+    its watermark rather than once a day. glance-cache-pruner only evicts
+    images while the cache is larger than image_cache_max_size, so the
+    reactor passes the low watermark as max_size.
+
+    :param runas: User to run glance-cache-pruner as
+    :param conf: Configuration file of the pruner
+    :param max_size: Bytes to prune the cache down to, instead of the
+                     image_cache_max_size of conf. It is set in a second
+                     configuration file, which overrides conf.
+    :return: Dictionary with result, retcode, stdout, stderr and the
+             seconds the pruner ran
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.image_cache_prune
+        salt '*' glanceng.image_cache_prune max_size=16106127360
+    """
+    cmd = ['glance-cache-pruner', '--config-file', conf]
+    override = None
+    if max_size is not None:
+        fd_, override = tempfile.mkstemp(prefix='glance-cache-pruner.',
+                                         suffix='.conf')
+        with os.fdopen(fd_, 'w') as fh_:
+            fh_.write('[DEFAULT]\nimage_cache_max_size = {0}\n'.format(
+                int(max_size)))
+        # Readable by runas
+        os.chmod(override, 0o644)
+        cmd += ['--config-file', override]
+    start = time.time()
+    try:
+        out = __salt__['cmd.run_all'](cmd, runas=runas, python_shell=False)
+    finally:
+        if override is not None:
+            os.unlink(override)
+    return {'result': out['retcode'] == 0,
+            'retcode': out['retcode'],
+            'stdout': out.get('stdout', ''),
+            'stderr': out.get('stderr', ''),
+            'seconds': round(time.time() - start, 3)}
+
+
+def _open_cache_db(path):
+    '''
+    Opens the image cache SQLite database without write access, so that
+    it can't interfere with glance-api using it.
+    '''
+    import sqlite3
+    if not os.path.exists(path):
+        raise SaltInvocationError('Image cache database {0} does not '
+                                  'exist'.format(path))
+    try:
+        conn = sqlite3.connect('file:{0}?mode=ro'.format(path), uri=True)
+    except TypeError:
+        # No URI filenames before python 3.4
+        conn = sqlite3.connect(path)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def _hit_rate(curve, size):
+    '''
+    Fraction of hits served by a cache of size bytes, from a curve of
+    (cumulative size, cumulative hit fraction) points in eviction order.
+    '''
+    rate = 0.0
+    for used, hits in curve:
+        if used > size:
+            break
+        rate = hits
+    return rate
+
+
+def image_cache_stats(directory='/var/lib/glance/image-cache/',
+                      db='cache.db', window=86400, sizes=None, points=20,
+                      images=True):
+    """
+    Report on the image cache of this glance-api node
+
+    Reads the cache's SQLite database (image_cache_sqlite_db under
+    image_cache_dir) read-only and returns per image size, hits, last
+    access and age, along with:
+
+    - working_set: bytes of the images accessed within window seconds
+    - lru_curve: points of cumulative size against the cumulative share
+      of hits when images are kept most recently used first, the order
+      in which the pruner keeps them
+    - projected_hit_rate: share of the recorded hits a cache of each of
+      the candidate sizes would have served, using that order
+
+    The result is small enough to be published through the Salt Mine.
+
+    :param directory: image_cache_dir of glance-api
+    :param db: image_cache_sqlite_db, relative to directory
+    :param window: Seconds an image counts as part of the working set
+                   after it was last accessed
+    :param sizes: Candidate cache sizes in bytes, by default 25%, 50%,
+                  75% and 100% of the current cache size
+    :param points: Maximum number of points of the LRU curve
+    :param images: Include the per image details
+    :return: Dictionary with the summary and, if requested, the images
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt -C 'I@glance:server' glanceng.image_cache_stats \\
+            sizes='[10737418240, 21474836480]'
+    """
+    now = time.time()
+    conn = _open_cache_db(os.path.join(directory, db))
+    try:
+        rows = conn.execute('SELECT image_id, size, hits, last_accessed, '
+                            'last_modified FROM cached_images').fetchall()
+    finally:
+        conn.close()
+
+    entries = []
+    for image_id, size, hits, last_accessed, last_modified in rows:
+        entries.append({'id': image_id,
+                        'size': int(size or 0),
+                        'hits': int(hits or 0),
+                        'last_accessed': _timestamp(float(last_accessed or 0)),
+                        'idle': int(now - float(last_accessed or 0)),
+                        'age': int(now - float(last_modified or 0))})
+    entries.sort(key=lambda entry: entry['idle'])
+
+    total_size = sum(entry['size'] for entry in entries)
+    total_hits = sum(entry['hits'] for entry in entries)
+    curve = []
+    used = hits = 0
+    for entry in entries:
+        used += entry['size']
+        hits += entry['hits']
+        curve.append((used, float(hits) / total_hits if total_hits else 0.0))
+    step = max(1, -(-len(curve) // max(int(points), 1)))
+    sampled = curve[step - 1::step]
+    if curve and sampled[-1] != curve[-1]:
+        sampled.append(curve[-1])
+
+    if sizes is None:
+        sizes = [int(total_size * fraction)
+                 for fraction in (0.25, 0.5, 0.75, 1.0)]
+    ret = {'node': __opts__.get('id'),
+           'directory': directory,
+           'count': len(entries),
+           'size': total_size,
+           'hits': total_hits,
+           'working_set': sum(entry['size'] for entry in entries
+                              if entry['idle'] <= window),
+           'lru_curve': [{'size': used, 'hit_rate': round(rate, 4)}
+                         for used, rate in sampled],
+           'projected_hit_rate': dict(
+               (str(int(size)), round(_hit_rate(curve, int(size)), 4))
+               for size in sizes)}
+    if images:
+        ret['images'] = entries
+    return ret
+
+
+def _current_api_version(profile, endpoint):
+    '''
+    Returns the id of the CURRENT Glance API version (e.g. 'v2.5') served
+    at the endpoint, or None if it can't be determined.
+    '''
+    now = time.time()
+    known = _API_VERSIONS.get(endpoint)
+    if known is None or known[1] + _API_VERSION_TTL <= now:
+        version = None
+        try:
+            body = _api(profile, 'http_client.get', '/versions')[1]
+            ids = [v['id'] for v in body.get('versions', [])
+                   if v.get('status') == 'CURRENT']
+            version = max(ids) if ids else None
+        except Exception as err:  # pylint: disable=broad-except
+            log.debug('Unable to get the Glance API version of %s: %s',
+                      endpoint, err)
+        known = _API_VERSIONS[endpoint] = [version, now]
+    return known[0]
+
+
+def _cached_schema(name, profile=None):
+    '''
+    Returns the {property: description} map of a Glance schema.
+
+    Schemas are kept in memory and in the minion cachedir for
+    "keystone.schema_cache_ttl" seconds (a ttl of 0 disables caching).
+    Cached schemas, in memory or on disk, are only used if the endpoint
+    still serves the Glance API version they were fetched from.
+    '''
+    ttl = _config_get(profile, 'schema_cache_ttl', _DEFAULT_SCHEMA_TTL)
+    endpoint = _auth_info(profile)[0]
+    now = time.time()
+
+    if ttl:
+        entry = _SCHEMA_CACHE.get((endpoint, name))
+        if entry and entry['fetched'] + ttl > now and \
+                entry['api_version'] == _current_api_version(profile,
+                                                             endpoint):
+            return entry['properties']
+        entry = _read_cache_file('schemas.json').get(endpoint, {}).get(name)
+        if entry and entry['fetched'] + ttl > now and \
+                entry['api_version'] == _current_api_version(profile,
+                                                             endpoint):
+            _SCHEMA_CACHE[(endpoint, name)] = entry
+            return entry['properties']
+
+    properties = {}
+    for prop in _api(profile, 'schemas.get', name).properties:
+        properties[prop.name] = prop.description
+    if ttl:
+        entry = {'properties': properties,
+                 'fetched': now,
+                 'api_version': _current_api_version(profile, endpoint)}
+        _SCHEMA_CACHE[(endpoint, name)] = entry
+        data = _read_cache_file('schemas.json')
+        data.setdefault(endpoint, {})[name] = entry
+        _write_cache_file('schemas.json', data)
+    return properties
+
+
+def _schema_keys(name, profile=None):
+    '''
+    Returns the property names of a Glance schema as a frozenset.
+    '''
+    return frozenset(_cached_schema(name, profile))
+
+
+def image_schema(schema_type='image', profile=None):
+    '''
+    Returns names and descriptions of the schema "image"'s
+    properties for this profile's instance of glance
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glance.image_schema
+    '''
+    return schema_get(schema_type, profile)
+
+
+def schema_get(name, profile=None):
+    '''
+    Known valid names of schemas are:
+      - image
+      - images
+      - member
+      - members
+      - task
+      - tasks
+
+    Schemas are cached, see "keystone.schema_cache_ttl".
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glance.schema_get name=f16-jeos
+    '''
+    schema_props = _cached_schema(name, profile)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Properties of schema %s:\n%s', name,
+                  pprint.PrettyPrinter(indent=4).pformat(schema_props))
+    return {name: schema_props}
+
+
+def http_stats(profile=None):
+    '''
+    Returns, per profile and endpoint, how many HTTP requests the pooled
+    sessions sent and how many connections they had to open for them.
+    'reused' counts the requests sent over a kept-alive connection. The
+    counts add up over all jobs of the minion, like those of stats.
+
+    :param profile: Only return the statistics of this profile
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.http_stats
+    '''
+    _flush_stats()
+    with _STATS_LOCK:
+        sessions = _read_cache_file('stats.json').get('http', {})
+    data = {}
+    for name, endpoints in sessions.items():
+        if profile and name != profile:
+            continue
+        for endpoint, entry in endpoints.items():
+            entry['reused'] = max(0, entry['requests'] -
+                                  entry['connections'])
+            data.setdefault(name, {})[endpoint] = entry
+    return data
+
+
+def _prometheus_textfile(path, data, http=None):
+    '''
+    Writes statistics in the Prometheus text format, e.g. for the
+    textfile collector of node_exporter.
+    '''
+    metrics = [
+        ('glanceng_api_calls_total', 'count',
+         'Number of remote calls made by glanceng.'),
+        ('glanceng_api_errors_total', 'errors',
+         'Number of remote calls made by glanceng that failed.'),
+        ('glanceng_api_seconds_total', 'seconds',
+         'Time spent in remote calls made by glanceng.'),
+    ]
+    lines = []
+    for metric, key, help_text in metrics:
+        lines.append('# HELP {0} {1}'.format(metric, help_text))
+        lines.append('# TYPE {0} counter'.format(metric))
+        for profile in sorted(data):
+            for operation in sorted(data[profile]):
+                lines.append('{0}{{profile="{1}",operation="{2}"}} '
+                             '{3}'.format(metric, profile, operation,
+                                          data[profile][operation][key]))
+    http_metrics = [
+        ('glanceng_http_requests_total', 'requests',
+         'Number of HTTP requests sent by the pooled sessions.'),
+        ('glanceng_http_connections_total', 'connections',
+         'Number of HTTP connections opened by the pooled sessions.'),
+    ]
+    for metric, key, help_text in http_metrics:
+        if not http:
+            break
+        lines.append('# HELP {0} {1}'.format(metric, help_text))
+        lines.append('# TYPE {0} counter'.format(metric))
+        for profile in sorted(http):
+            for endpoint in sorted(http[profile]):
+                lines.append('{0}{{profile="{1}",endpoint="{2}"}} '
+                             '{3}'.format(metric, profile, endpoint,
+                                          http[profile][endpoint][key]))
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh_:
+        fh_.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, path)
+
+
+def stats(profile=None, reset=False, event=False, textfile=None):
+    '''
+    Returns call counts and latencies of the remote operations glanceng
+    made on this minion, keyed by profile and operation: keystone
+    authentication ('auth'), endpoint lookups ('endpoint_get') and
+    Glance calls such as 'schemas.get', 'tasks.get', 'tasks.list',
+    'images.list' or 'images.get'. Listings count once per listing,
+    including all of their pages.
+
+    Every job merges its counters into glanceng/stats.json in the minion
+    cachedir, so they add up over jobs until they are reset.
+
+    :param profile: Only return the statistics of this profile
+    :param reset: Clear the statistics after reading them
+    :param event: Also fire the statistics as a "glanceng/stats" event
+    :param textfile: Also write the statistics to this file in the
+                     Prometheus text format
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' glanceng.stats
+        salt '*' glanceng.stats textfile=/var/lib/node_exporter/glanceng.prom
+    '''
+    # Read before a reset clears them
+    http = http_stats(profile) if textfile else None
+    _flush_stats()
+    with _STATS_LOCK:
+        cached = _read_cache_file('stats.json')
+        data = dict((name, dict((op, dict(entry))
+                                for op, entry in ops.items()))
+                    for name, ops in cached.get('calls', {}).items())
+        if reset:
+            if profile:
+                for section in ('calls', 'http'):
+                    cached.get(section, {}).pop(profile, None)
+            else:
+                cached = {}
+            _write_cache_file('stats.json', cached)
+    if profile:
+        data = {profile: data.get(profile, {})}
+    for ops in data.values():
+        for entry in ops.values():
+            entry['avg'] = entry['seconds'] / entry['count'] \
+                if entry['count'] else 0.0
+    if event:
+        __salt__['event.send']('glanceng/stats', {'stats': data})
+    if textfile:
+        _prometheus_textfile(textfile, data, http)
+    return data
@@ -5,8 +5,12 @@ Managing Images in OpenStack Glance
 '''
 # Import python libs
 from __future__ import absolute_import
+import fnmatch
 import logging
+import random
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 # Import OpenStack libs
 try:
@@ -30,6 +34,24 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Task polling backoff: the first wait is at most _POLL_INITIAL_DELAY
+# seconds, doubling after each poll up to _POLL_MAX_DELAY. Every wait
+# is jittered to between half and all of the current delay.
+_POLL_INITIAL_DELAY = 1
+_POLL_MAX_DELAY = 30
+_TASK_FINAL_STATES = ('success', 'failure')
+# Engine republishing Glance notifications as glance/<image|task>/<id>/
+# events, which end the waits between polls early
+_NOTIFICATIONS_ENGINE = 'glance_notifications'
+# Disk formats converted to raw for images imported with convert set
+_CONVERTIBLE_FORMATS = ('qcow2', 'vmdk')
+# Image statuses images_pruned deletes; queued, saving and importing
+# images may still be written by an import
+_PRUNABLE_STATUSES = ('active', 'killed')
+# Guards the image index in __context__, which the ThreadPool workers of
+# the batch states update
+_INDEX_LOCK = threading.Lock()
+
 
 def __virtual__():
     '''
@@ -38,25 +60,114 @@ def __virtual__():
     return HAS_KEYSTONE and HAS_GLANCE
 
 
-def _find_image(name, profile=None):
+def _timing_start(profile=None):
+    '''
+    Marks the start of a state for _timing.
+    '''
+    return time.time(), __salt__['glanceng.stats'](profile=profile)
+
+
+def _timing(ret, profile, started):
+    '''
+    Adds the time spent in the state and a per operation breakdown of the
+    glanceng remote calls it made to ret['timing']. Calls made through
+    salt.modules.glance (image listings) are accounted as 'other'.
+    Returns ret.
+    '''
+    start, before = started
+    after = __salt__['glanceng.stats'](profile=profile)
+    calls = {}
+    api_seconds = 0.0
+    for name, ops in after.items():
+        for operation, entry in ops.items():
+            prev = before.get(name, {}).get(operation, {})
+            count = entry['count'] - prev.get('count', 0)
+            if count:
+                seconds = entry['seconds'] - prev.get('seconds', 0.0)
+                api_seconds += seconds
+                # Summed over the profiles timed, e.g. the targets of
+                # images_replicated
+                call = calls.setdefault(operation, {'count': 0,
+                                                    'seconds': 0.0})
+                call['count'] += count
+                call['seconds'] += seconds
+    for call in calls.values():
+        call['seconds'] = round(call['seconds'], 3)
+    total = time.time() - start
+    ret['timing'] = {'total': round(total, 3),
+                     'api': round(api_seconds, 3),
+                     'other': round(max(total - api_seconds, 0.0), 3),
+                     'calls': calls}
+    return ret
+
+
+def _image_snapshot(profile=None):
+    '''
+    Lists all images of a profile once, returns a dict mapping
+    image names to lists of images.
+    '''
+    images = __salt__['glance.image_list'](profile=profile)
+    if type(images) is dict and len(images) == 1 and 'images' in images:
+        images = images['images']
+    images_list = images.values() if type(images) is dict else images
+    snapshot = {}
+    for image in images_list:
+        snapshot.setdefault(image['name'], []).append(image)
+    return snapshot
+
+
+def _image_index(profile=None, refresh=False):
+    '''
+    Returns the name -> [images] index of a profile. The index is built
+    from one listing and shared through __context__ by all states of the
+    run; it is only rebuilt when refresh is set.
+    '''
+    with _INDEX_LOCK:
+        indexes = __context__.setdefault('glanceng.image_index', {})
+        if not refresh and profile in indexes:
+            return indexes[profile]
+    snapshot = _image_snapshot(profile)
+    with _INDEX_LOCK:
+        indexes[profile] = snapshot
+    return snapshot
+
+
+def _index_update(image, profile=None):
+    '''
+    Adds an image created or changed by this run to the image index, or
+    replaces the indexed copy of it. Returns True if the index was updated.
+    '''
+    if not image or 'id' not in image or 'name' not in image:
+        return False
+    with _INDEX_LOCK:
+        indexes = __context__.setdefault('glanceng.image_index', {})
+        if profile not in indexes:
+            return False
+        for images in indexes[profile].values():
+            images[:] = [i for i in images if i.get('id') != image['id']]
+        indexes[profile].setdefault(image['name'], []).append(image)
+    return True
+
+
+def _find_image(name, profile=None, refresh=False):
     '''
     Tries to find image with given name, returns
         - image, 'Found image <name>'
         - None, 'No such image found'
         - False, 'Found more than one image with given name'
+
+    Lookups use the image index of the run; set refresh when the indexed
+    copy may be stale, e.g. while waiting for an image status to change.
     '''
     try:
-        images = __salt__['glance.image_list'](name=name, profile=profile)
+        index = _image_index(profile, refresh)
+        with _INDEX_LOCK:
+            images_list = list(index.get(name, []))
     except kstone_Unauthorized:
         return False, 'keystoneclient: Unauthorized'
     except glance_Unauthorized:
         return False, 'glanceclient: Unauthorized'
-    log.debug('Got images: {0}'.format(images))
-
-    if type(images) is dict and len(images) == 1 and 'images' in images:
-        images = images['images']
-
-    images_list = images.values() if type(images) is dict else images
+    log.debug('Got images: {0}'.format(images_list))
 
     if len(images_list) == 0:
         return None, 'No image with name "{0}"'.format(name)
@@ -68,9 +179,176 @@ def _find_image(name, profile=None):
         raise NotImplementedError
 
 
+def _plan(profile=None):
+    '''
+    Returns the glanceng.image_plan of the profile's images in the
+    glance:client:identity pillar. It is computed once per run and shared
+    through __context__; its listing also becomes the image index.
+
+    Without a profile there is no identity to plan (glanceng.image_plan
+    would plan all of them), so {} is returned and the states look up
+    their images one by one.
+    '''
+    if profile is None:
+        return {}
+    plans = __context__.setdefault('glanceng.image_plan', {})
+    if profile not in plans:
+        plans[profile] = __salt__['glanceng.image_plan'](
+            profile=profile).get(profile, {})
+    return plans[profile]
+
+
+def _apply_update(ret, name, image, profile=None, visibility=None,
+                  protected=None, tags=None):
+    '''
+    Updates the visibility, protected flag and tags of an existing image
+    to the ones of the state, or only reports the changes in test mode.
+    Arguments that are None are not compared, and tags of the image that
+    aren't listed are kept. Updates ret.
+    '''
+    changes = {}
+    for attr, value in (('visibility', visibility),
+                        ('protected', protected)):
+        if value is not None and value != image.get(attr):
+            changes[attr] = {'old': image.get(attr), 'new': value}
+    current = image.get('tags') or []
+    missing = [tag for tag in tags or [] if tag not in current]
+    if missing:
+        changes['tags'] = {'old': sorted(current),
+                           'new': sorted(set(current) | set(missing))}
+    if not changes:
+        return ret
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] += '\nglanceng would update {0} of the ' \
+            'image.'.format(', '.join(sorted(changes)))
+        return ret
+    try:
+        image = __salt__['glanceng.image_update'](
+            image['id'], profile=profile,
+            **dict((attr, change['new']) for attr, change in changes.items()))
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['comment'] += '\nUnable to update the image: {0}'.format(err)
+    else:
+        _index_update(image, profile)
+        ret['changes'][name] = changes
+        ret['comment'] += '\nUpdated {0} of the image.'.format(
+            ', '.join(sorted(changes)))
+    return ret
+
+
+def _check_hashes(ret, image, hashes, profile=None, checksum=None):
+    '''
+    Compares the expected digests of an existing image, and its expected
+    checksum as md5, with the ones glanceng.image_upload recorded for it
+    and md5 with the checksum Glance reports. The image data is not read
+    again; digests that were never recorded are only mentioned in the
+    comment. Updates ret.
+    '''
+    expected_hashes = dict((str(algo).lower(), str(digest).lower())
+                           for algo, digest in (hashes or {}).items()
+                           if digest)
+    if checksum:
+        expected_hashes.setdefault('md5', str(checksum).lower())
+    recorded = __salt__['glanceng.image_verified_hashes'](image['id'],
+                                                         profile=profile)
+    if image.get('checksum'):
+        recorded.setdefault('md5', image['checksum'])
+    for algo, expected in sorted(expected_hashes.items()):
+        if algo not in recorded:
+            ret['comment'] += '"{0}" of the image was never verified.\n' \
+                .format(algo)
+        elif recorded[algo] != expected:
+            ret['result'] = None if __opts__['test'] else False
+            ret['comment'] += '"{0}" is {1}, should be {2}.\n'.format(
+                algo, recorded[algo], expected)
+        else:
+            ret['comment'] += '"{0}" is correct ({1}).\n'.format(
+                algo, expected)
+    return ret
+
+
+def _listen():
+    '''
+    Returns a listener on the minion event bus if the glance_notifications
+    engine is configured on this minion, None otherwise.
+    '''
+    engines = __opts__.get('engines') or []
+    if not any(engine == _NOTIFICATIONS_ENGINE or
+               (isinstance(engine, dict) and _NOTIFICATIONS_ENGINE in engine)
+               for engine in engines):
+        return None
+    try:
+        import salt.utils.event
+        return salt.utils.event.get_event('minion', opts=__opts__,
+                                          listen=True)
+    except Exception as exc:
+        log.debug('Not waiting for Glance notifications: {0}'.format(exc))
+        return None
+
+
+def _wait(listener, tag, seconds):
+    '''
+    Waits up to seconds for an event whose tag starts with tag and returns
+    its data, or None if there was none. Without a listener this just
+    sleeps.
+    '''
+    if listener is None:
+        time.sleep(seconds)
+        return None
+    event = listener.get_event(wait=seconds, tag=tag, full=True)
+    if not event:
+        return None
+    return event.get('data') or {}
+
+
+def _wait_for_task(task, profile=None, timeout=30):
+    '''
+    Polls a single task by ID with exponential backoff until it reaches
+    a final state, vanishes or the timeout expires. Returns a tuple of
+    the last known task, the number of polls made and the seconds waited.
+    A vanished task is returned as the error dict of glanceng.task_show.
+
+    With the glance_notifications engine the waits between polls end as
+    soon as the task's notifications arrive, and the task is only polled
+    again once one of them reports a final state.
+    '''
+    task_id = task['id']
+    tag = 'glance/task/{0}/'.format(task_id)
+    start = time.time()
+    deadline = start + timeout
+    delay = _POLL_INITIAL_DELAY
+    polls = 0
+    listener = _listen()
+    try:
+        if listener is not None and \
+                task.get('status') not in _TASK_FINAL_STATES:
+            # The task may have finished before the listener subscribed
+            task = __salt__['glanceng.task_show'](task_id, profile=profile)
+            polls += 1
+        while 'id' in task and task.get('status') not in _TASK_FINAL_STATES:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            event = _wait(listener, tag, min(
+                remaining, random.uniform(delay / 2.0, delay)))
+            if event is None:
+                delay = min(delay * 2, _POLL_MAX_DELAY)
+            elif event.get('payload', {}).get('status') not in \
+                    _TASK_FINAL_STATES:
+                continue
+            task = __salt__['glanceng.task_show'](task_id, profile=profile)
+            polls += 1
+    finally:
+        if listener is not None:
+            listener.destroy()
+    return task, polls, time.time() - start
+
+
 def image_present(name, profile=None, visibility='public', protected=None,
         checksum=None, location=None, disk_format='raw', wait_for=None,
-        timeout=30):
+        timeout=30, hashes=None):
     '''
     Checks if given image is present with properties
     set as specified.
@@ -90,16 +368,19 @@ def image_present(name, profile=None, visibility='public', protected=None,
       - location (URL, to copy from)
       - disk_format ('raw' (default), 'vhd', 'vhdx', 'vmdk', 'vdi', 'iso',
         'qcow2', 'aki', 'ari' or 'ami')
+      - hashes (dict, md5/sha256/sha512 digests, compared with the ones
+        recorded by glanceng.image_upload)
     '''
+    started = _timing_start(profile)
     ret = {'name': name,
             'changes': {},
             'result': True,
             'comment': '',
             }
     acceptable = ['queued', 'saving', 'active']
-    if wait_for is None and checksum is None:
+    if wait_for is None and checksum is None and not hashes:
         wait_for = 'saving'
-    elif wait_for is None and checksum is not None:
+    elif wait_for is None:
         wait_for = 'active'
 
     # Just pop states until we reach the
@@ -117,7 +398,7 @@ def image_present(name, profile=None, visibility='public', protected=None,
         else:
             ret['result'] = False
         ret['comment'] = msg
-        return ret
+        return _timing(ret, profile, started)
     log.debug(msg)
     # No image yet and we know where to get one
     if image is None and location is not None:
@@ -125,11 +406,12 @@ def image_present(name, profile=None, visibility='public', protected=None,
             ret['result'] = None
             ret['comment'] = 'glance.image_present would ' \
                 'create an image from {0}'.format(location)
-            return ret
+            return _timing(ret, profile, started)
         image = __salt__['glance.image_create'](name=name, profile=profile,
             protected=protected, visibility=visibility,
             location=location, disk_format=disk_format)
         log.debug('Created new image:\n{0}'.format(image))
+        _index_update(image, profile)
         ret['changes'] = {
             name:
                 {
@@ -141,23 +423,30 @@ def image_present(name, profile=None, visibility='public', protected=None,
                 }
             }
         timer = timeout
-        # Kinda busy-loopy but I don't think the Glance
-        # API has events we can listen for
-        while timer > 0:
-            if 'status' in image and \
-                    image['status'] in acceptable:
-                log.debug('Image {0} has reached status {1}'.format(
-                    image['name'], image['status']))
-                break
-            else:
-                timer -= 5
-                time.sleep(5)
-                image, msg = _find_image(name, profile)
-                if not image:
-                    ret['result'] = False
-                    ret['comment'] += 'Created image {0} '.format(
-                        name) + ' vanished:\n' + msg
-                    return ret
+        # Polls every 5 seconds, or as soon as a notification of the
+        # image arrives if the glance_notifications engine runs
+        tag = 'glance/image/{0}/'.format(image['id'])
+        listener = _listen()
+        try:
+            while timer > 0:
+                if 'status' in image and \
+                        image['status'] in acceptable:
+                    log.debug('Image {0} has reached status {1}'.format(
+                        image['name'], image['status']))
+                    break
+                else:
+                    waited = time.time()
+                    _wait(listener, tag, 5)
+                    timer -= time.time() - waited
+                    image, msg = _find_image(name, profile, refresh=True)
+                    if not image:
+                        ret['result'] = False
+                        ret['comment'] += 'Created image {0} '.format(
+                            name) + ' vanished:\n' + msg
+                        return _timing(ret, profile, started)
+        finally:
+            if listener is not None:
+                listener.destroy()
         if timer <= 0 and image['status'] not in acceptable:
             ret['result'] = False
             ret['comment'] += 'Image didn\'t reach an acceptable '+\
@@ -174,7 +463,7 @@ def image_present(name, profile=None, visibility='public', protected=None,
             ret['result'] = False
             ret['comment'] = 'No location to copy image from specified,\n' +\
                          'not creating a new image.'
-        return ret
+        return _timing(ret, profile, started)
 
     # If we've created a new image also return its last status:
     if name in ret['changes']:
@@ -186,6 +475,7 @@ def image_present(name, profile=None, visibility='public', protected=None,
             if not __opts__['test']:
                 image = __salt__['glance.image_update'](
                     id=image['id'], visibility=visibility)
+                _index_update(image, profile)
             # Check if image_update() worked:
             if image['visibility'] != visibility:
                 if not __opts__['test']:
@@ -243,22 +533,190 @@ def image_present(name, profile=None, visibility='public', protected=None,
         elif image['status'] in ['saving', 'queued']:
             ret['comment'] += 'Checksum won\'t be verified as image ' +\
                 'hasn\'t reached\n\t "status=active" yet.\n'
+    if hashes and image.get('status') == 'active':
+        _check_hashes(ret, image, hashes, profile)
     log.debug('glance.image_present will return: {0}'.format(ret))
+    return _timing(ret, profile, started)
+
+
+def _resume_import(ret, name, profile=None, location=None, checksum=None):
+    '''
+    Looks up the import journal for a task an earlier run submitted for
+    this image. Returns the task if it is still worth waiting for and
+    records it in ret['changes'], otherwise drops the journal entry and
+    returns None.
+    '''
+    entry = __salt__['glanceng.import_journal_get'](name, profile=profile)
+    if not entry:
+        return None
+    if entry.get('location') != location or \
+            entry.get('checksum') != checksum:
+        log.debug('Import parameters of {0} changed, not resuming task '
+                  '{1}'.format(name, entry['task_id']))
+        __salt__['glanceng.import_journal_remove'](name, profile=profile)
+        return None
+    task = __salt__['glanceng.task_show'](entry['task_id'], profile=profile)
+    if task.get('status') not in ('pending', 'processing', 'success'):
+        log.debug('Journaled task {0} of {1} is gone or failed, '
+                  'forgetting it'.format(entry['task_id'], name))
+        __salt__['glanceng.import_journal_remove'](name, profile=profile)
+        return None
+    log.debug('Resuming wait for import task {0} of {1}'.format(
+        task['id'], name))
+    ret['changes'] = {
+        name:
+            {
+                'new':
+                    {
+                        'task_id': task['id'],
+                        'resumed': True
+                    },
+                'old': None
+            }
+        }
+    return task
+
+
+def _submit_import(ret, name, profile=None, visibility='public',
+                   protected=False, location=None, import_from_format='raw',
+                   disk_format='raw', container_format='bare', tags=None,
+                   checksum=None):
+    '''
+    Creates the import task for an image, records it in the import journal
+    and in ret['changes']. Returns the task.
+    '''
+    image_properties = {"container_format": container_format,
+                        "disk_format": disk_format,
+                        "name": name,
+                        "protected": protected,
+                        "tags": tags or [],
+                        "visibility": visibility
+                        }
+    task_params = {"import_from": location,
+                   "import_from_format": import_from_format,
+                   "image_properties": image_properties
+                   }
+
+    task = __salt__['glanceng.task_create'](
+        task_type='import', profile=profile,
+        input_params=task_params)
+    task_id = task['id']
+    log.debug('Created new task:\n{0}'.format(task))
+    __salt__['glanceng.import_journal_add'](
+        name, task_id, location=location, checksum=checksum, profile=profile)
+    ret['changes'] = {
+        name:
+            {
+                'new':
+                    {
+                        'task_id': task_id
+                    },
+                'old': None
+            }
+        }
+    return task
+
+
+def _finish_import(ret, name, task, profile=None, checksum=None,
+                   timeout=30):
+    '''
+    Waits for an import task created by _submit_import, then checks the
+    resulting image and its checksum. Updates and returns ret.
+    The journal entry of the task is kept only while it is in flight.
+    '''
+    task_id = task['id']
+    # Wait for the task to complete
+    task, polls, waited = _wait_for_task(task, profile, timeout)
+    if task.get('status') in _TASK_FINAL_STATES or 'id' not in task:
+        __salt__['glanceng.import_journal_remove'](name, profile=profile)
+    ret['changes'][name]['new']['task_polls'] = polls
+    ret['changes'][name]['new']['task_wait_time'] = round(waited, 3)
+    log.debug('Waited {0:.1f}s for task {1} ({2} polls)'.format(
+        waited, task_id, polls))
+    if 'id' not in task:
+        ret['result'] = False
+        ret['comment'] = 'Created task {0} vanished:\n{1}'.format(
+            task_id, task.get('comment', ''))
+        return ret
+    elif task['status'] == 'failure':
+        ret['result'] = False
+        ret['comment'] = "Task {0} has failed".format(task_id)
+        if task.get('message'):
+            ret['comment'] += ': {0}'.format(task['message'])
+        return ret
+    elif task['status'] != 'success':
+        ret['result'] = False
+        ret['comment'] = ('Task {0} did not reach state success before '
+                          'the timeout:\nLast status was '
+                          '"{1}".\n'.format(task_id, task['status']))
+        return ret
+    log.debug('Task {0} has successfully completed'.format(task_id))
+
+    # The import task has successfully completed. Now, let's check that it
+    # created the image. The task result names the image, so fetch just
+    # that one rather than listing all images again.
+    refresh = True
+    image_id = (task.get('result') or {}).get('image_id')
+    if image_id:
+        image = __salt__['glance.image_show'](id=image_id, profile=profile)
+        refresh = not _index_update(image, profile)
+    image, msg = _find_image(name, profile, refresh=refresh)
+    if not image:
+        ret['result'] = False
+        ret['comment'] = msg
+    else:
+        ret['changes'][name]['new']['image_id'] = image['id']
+        ret['changes'][name]['new']['image_status'] = image['status']
+        ret['comment'] = ("Image {0} was successfully created by task "
+                          "{1}".format(image['id'], task_id))
+        if checksum:
+            if image['status'] == 'active':
+                if 'checksum' not in image:
+                    # Refresh our info about the image
+                    image = __salt__['glance.image_show'](image['id'])
+                if 'checksum' not in image:
+                    if not __opts__['test']:
+                        ret['result'] = False
+                    else:
+                        ret['result'] = None
+                    ret['comment'] += (
+                        "No checksum available for this image:\n"
+                        "Image has status '{0}'.".format(image['status']))
+                elif image['checksum'] != checksum:
+                    if not __opts__['test']:
+                        ret['result'] = False
+                    else:
+                        ret['result'] = None
+                    ret['comment'] += ("'checksum' is {0}, should be "
+                                       "{1}.\n".format(image['checksum'],
+                                                       checksum))
+                else:
+                    ret['comment'] += (
+                        "'checksum' is correct ({0}).\n".format(checksum))
+            elif image['status'] in ['saving', 'queued']:
+                ret['comment'] += (
+                    "Checksum will not be verified as image has not "
+                    "reached 'status=active' yet.\n")
     return ret
 
 
-def image_import(name, profile=None, visibility='public', protected=False,
+def image_import(name, profile=None, visibility=None, protected=None,
                  location=None, import_from_format='raw', disk_format='raw',
                  container_format='bare', tags=None,
-                 checksum=None, timeout=30):
+                 checksum=None, timeout=30, hashes=None, convert=False):
     """
     Creates a task to import an image
 
     This state checks if an image is present and, if not, creates a task
     with import_type that would download an image from a remote location and
     upload it to Glance.
+    Submitted tasks are recorded in a journal in the minion cachedir. If a
+    run times out while the task is still in flight, the next run resumes
+    waiting for that task instead of importing the image again.
     After the task is created, its status is monitored. On success the state
     would check that an image is present and return its ID.
+    An existing image gets the visibility, protected flag and tags given,
+    and its checksum and hashes are checked against the recorded digests.
 
     *Important*: This state is supposed to work only with Glance V2 API as
                  opposed to the image_present state that is compatible only
@@ -266,7 +724,8 @@ def image_import(name, profile=None, visibility='public', protected=False,
 
     :param name: Name of an image
     :param profile: Authentication profile
-    :param visibility: Scope of image accessibility.
+    :param visibility: Scope of image accessibility, public for new images
+                       by default.
                        Valid values: public, private, community, shared
     :param protected: If true, image will not be deletable.
     :param location: a URL where Glance can get the image data
@@ -276,129 +735,780 @@ def image_import(name, profile=None, visibility='public', protected=False,
     :param tags: List of strings related to the image
     :param checksum: Checksum of the image to import, it would be used to
                      validate the checksum of a newly created image
-    :param timeout: Time to wait for an import task to succeed
+    :param timeout: Time to wait for an import task to succeed. The task
+                    is polled with exponential backoff; the number of polls
+                    and the time waited are returned in the changes.
+    :param hashes: Expected md5, sha256 or sha512 digests of the image
+                   data. A missing image is then streamed from location
+                   through glanceng.image_upload instead of an import
+                   task, so that the digests are verified before the
+                   image becomes active. import_from_format is ignored
+                   in that case.
+    :param convert: Convert qcow2 and vmdk images to raw with qemu-img on
+                    the minion and upload them with disk_format raw, for
+                    Ceph RBD stores, where Nova and Cinder clone raw
+                    images instead of downloading them. The image is then
+                    streamed through glanceng.image_upload as well; its
+                    checksum and hashes are those of the original data.
     """
 
+    started = _timing_start(profile)
     ret = {'name': name,
            'changes': {},
            'result': True,
            'comment': 'Image "{0}" already exists'.format(name)}
-    tags = tags or []
 
+    # The listing of the run's plan is the image index
+    _plan(profile)
     image, msg = _find_image(name, profile)
     log.debug(msg)
     if image:
-        return ret
+        if not __opts__['test']:
+            __salt__['glanceng.import_journal_remove'](name, profile=profile)
+        _apply_update(ret, name, image, profile, visibility=visibility,
+                      protected=protected, tags=tags)
+        if hashes or checksum:
+            ret['comment'] += '\n'
+            _check_hashes(ret, image, hashes, profile, checksum)
+        return _timing(ret, profile, started)
     elif image is False:
         if __opts__['test']:
             ret['result'] = None
         else:
             ret['result'] = False
         ret['comment'] = msg
-        return ret
+        return _timing(ret, profile, started)
+    visibility = visibility or 'public'
+    protected = bool(protected)
+    source_format = _source_format(convert, import_from_format, disk_format)
+    if hashes or source_format:
+        ret = _upload(name, location, profile=profile, visibility=visibility,
+                      protected=protected, disk_format=disk_format,
+                      container_format=container_format, tags=tags,
+                      checksum=checksum, hashes=hashes,
+                      source_format=source_format)
+        return _timing(ret, profile, started)
     else:
         if __opts__['test']:
             ret['result'] = None
-            ret['comment'] = ("glanceng.image_import would create an image "
-                              "from {0}".format(location))
-            return ret
-
-        image_properties = {"container_format": container_format,
-                            "disk_format": disk_format,
-                            "name": name,
-                            "protected": protected,
-                            "tags": tags,
-                            "visibility": visibility
-                            }
-        task_params = {"import_from": location,
-                       "import_from_format": import_from_format,
-                       "image_properties": image_properties
-                       }
-
-        task = __salt__['glanceng.task_create'](
-            task_type='import', profile=profile,
-            input_params=task_params)
-        task_id = task['id']
-        log.debug('Created new task:\n{0}'.format(task))
-        ret['changes'] = {
-            name:
-                {
-                    'new':
-                        {
-                            'task_id': task_id
-                        },
-                    'old': None
-                }
-            }
+            entry = __salt__['glanceng.import_journal_get'](name,
+                                                             profile=profile)
+            if entry:
+                ret['comment'] = ("glanceng.image_import would resume "
+                                  "waiting for task {0}".format(
+                                      entry['task_id']))
+            else:
+                ret['comment'] = ("glanceng.image_import would create an "
+                                  "image from {0}".format(location))
+            return _timing(ret, profile, started)
 
-        # Wait for the task to complete
-        timer = timeout
-        while timer > 0:
-            if 'status' in task and task['status'] == 'success':
-                log.debug('Task {0} has successfully completed'.format(
-                    task_id))
-                break
-            elif 'status' in task and task['status'] == 'failure':
-                msg = "Task {0} has failed".format(task_id)
-                ret['result'] = False
-                ret['comment'] = msg
-                return ret
+        task = _resume_import(ret, name, profile=profile, location=location,
+                              checksum=checksum)
+        if task is None:
+            task = _submit_import(ret, name, profile=profile,
+                                  visibility=visibility, protected=protected,
+                                  location=location,
+                                  import_from_format=import_from_format,
+                                  disk_format=disk_format,
+                                  container_format=container_format,
+                                  tags=tags, checksum=checksum)
+        ret = _finish_import(ret, name, task, profile=profile,
+                             checksum=checksum, timeout=timeout)
+        log.debug('glance.image_present will return: {0}'.format(ret))
+        return _timing(ret, profile, started)
+
+
+def images_imported(name, images, profile=None, concurrency=4, timeout=30,
+                    convert=False):
+    """
+    Imports many images at once
+
+    This is the batch version of image_import. All images of a profile are
+    listed once, by glanceng.image_plan. Existing images get the
+    visibility, protected flag and tags given in images and their checksum
+    and hashes are checked, then the import tasks for the missing ones are
+    created up front and waited on concurrently.
+
+    :param name: Name of the state
+    :param images: Dictionary of images as in the
+                   glance:client:identity:<profile>:image pillar. Every
+                   value takes the arguments of image_import, except that
+                   the timeout is called "wait_timeout". The image name
+                   defaults to the key. Images with "hashes" or converted
+                   to raw are streamed through glanceng.image_upload, in
+                   the same pool.
+    :param profile: Authentication profile
+    :param concurrency: Number of tasks waited on in parallel
+    :param timeout: Default time to wait for an import task to succeed
+    :param convert: Default of the convert argument of image_import
+    """
+    started = _timing_start(profile)
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    import_args = ('visibility', 'protected', 'location', 'import_from_format',
+                   'disk_format', 'container_format', 'tags')
+    upload_args = ('visibility', 'protected', 'disk_format',
+                   'container_format', 'tags', 'checksum', 'hashes')
+
+    plan = __salt__['glanceng.image_plan'](profile=profile,
+                                           images=images)[profile]
+    if 'result' in plan:
+        ret['result'] = False
+        ret['comment'] = plan['comment']
+        return _timing(ret, profile, started)
+    snapshot = _image_index(profile)
+
+    journal = __salt__['glanceng.import_journal_list'](profile=profile)
+    results = {}
+    pending = []
+    uploads = []
+    for key in sorted(images):
+        params = images[key] or {}
+        image_name = params.get('name', key)
+        sub_ret = {'name': image_name,
+                   'changes': {},
+                   'result': True,
+                   'comment': 'Image "{0}" already exists'.format(image_name)}
+        results[image_name] = sub_ret
+        found = snapshot.get(image_name, [])
+        if len(found) > 1:
+            sub_ret['result'] = None if __opts__['test'] else False
+            sub_ret['comment'] = 'Found more than one image with given name'
+            continue
+        elif found:
+            if image_name in journal and not __opts__['test']:
+                __salt__['glanceng.import_journal_remove'](image_name,
+                                                           profile=profile)
+            _apply_update(sub_ret, image_name, found[0], profile,
+                          **dict((attr, params[attr]) for attr in
+                                 ('visibility', 'protected', 'tags')
+                                 if attr in params))
+            if params.get('hashes') or params.get('checksum'):
+                sub_ret['comment'] += '\n'
+                _check_hashes(sub_ret, found[0], params.get('hashes'),
+                              profile, params.get('checksum'))
+            continue
+        source_format = _source_format(params.get('convert', convert),
+                                       params.get('import_from_format'),
+                                       params.get('disk_format'))
+        if params.get('hashes') or source_format:
+            uploads.append((image_name, params, source_format))
+        elif __opts__['test']:
+            sub_ret['result'] = None
+            if image_name in journal:
+                sub_ret['comment'] = ("glanceng.image_import would resume "
+                                      "waiting for task {0}".format(
+                                          journal[image_name]['task_id']))
             else:
-                timer -= 5
-                time.sleep(5)
-                existing_tasks = __salt__['glanceng.task_list'](profile)
-                if task_id not in existing_tasks:
-                    ret['result'] = False
-                    ret['comment'] += 'Created task {0} '.format(
-                        task_id) + ' vanished:\n' + msg
-                    return ret
-                else:
-                    task = existing_tasks[task_id]
-        if timer <= 0 and task['status'] != 'success':
+                sub_ret['comment'] = ("glanceng.image_import would create "
+                                      "an image from {0}".format(
+                                          params.get('location')))
+        else:
+            kwargs = dict((arg, params[arg]) for arg in import_args
+                          if arg in params)
+            try:
+                task = _resume_import(sub_ret, image_name, profile=profile,
+                                      location=params.get('location'),
+                                      checksum=params.get('checksum'))
+                if task is None:
+                    task = _submit_import(sub_ret, image_name,
+                                          profile=profile,
+                                          checksum=params.get('checksum'),
+                                          **kwargs)
+            except Exception as err:  # pylint: disable=broad-except
+                sub_ret['result'] = False
+                sub_ret['comment'] = 'Unable to create import task: ' \
+                    '{0}'.format(err)
+                continue
+            pending.append((sub_ret, image_name, task,
+                            params.get('checksum'),
+                            params.get('wait_timeout', timeout)))
+
+    if pending or uploads:
+        def _finish(args):
+            sub_ret, image_name, task, checksum, wait_timeout = args
+            try:
+                return _finish_import(sub_ret, image_name, task,
+                                      profile=profile, checksum=checksum,
+                                      timeout=wait_timeout)
+            except Exception as err:  # pylint: disable=broad-except
+                sub_ret['result'] = False
+                sub_ret['comment'] = 'Error waiting for task {0}: ' \
+                    '{1}'.format(task['id'], err)
+                return sub_ret
+
+        def _stream(args):
+            image_name, params, source_format = args
+            kwargs = dict((arg, params[arg]) for arg in upload_args
+                          if arg in params)
+            return _upload(image_name, params.get('location'),
+                           profile=profile, source_format=source_format,
+                           **kwargs)
+
+        pool = ThreadPool(max(1, min(int(concurrency),
+                                     len(pending) + len(uploads))))
+        try:
+            waits = pool.map_async(_finish, pending)
+            streams = pool.map_async(_stream, uploads)
+            waits.get()
+            for sub_ret in streams.get():
+                results[sub_ret['name']] = sub_ret
+        finally:
+            pool.close()
+            pool.join()
+
+    comments = []
+    for image_name in sorted(results):
+        sub_ret = results[image_name]
+        ret['changes'].update(sub_ret['changes'])
+        comments.append('{0}: {1}'.format(image_name,
+                                          sub_ret['comment'].strip()))
+        if sub_ret['result'] is False:
             ret['result'] = False
-            ret['comment'] = ('Task {0} did not reach state success before '
-                              'the timeout:\nLast status was '
-                              '"{1}".\n'.format(task_id, task['status']))
-            return ret
-
-        # The import task has successfully completed. Now, let's check that it
-        # created the image.
-        image, msg = _find_image(name, profile)
-        if not image:
+        elif sub_ret['result'] is None and ret['result'] is True:
+            ret['result'] = None
+    ret['comment'] = '\n'.join(comments)
+    log.debug('glanceng.images_imported will return: {0}'.format(ret))
+    return _timing(ret, profile, started)
+
+
+def _source_format(convert, import_from_format=None, disk_format=None):
+    '''
+    Returns the format to convert an image from to raw, or None if it is
+    uploaded as it is: conversion is off, the image is neither qcow2 nor
+    vmdk, or qemu-img is not installed on the minion.
+    '''
+    if not convert:
+        return None
+    for fmt in (import_from_format, disk_format):
+        if fmt in _CONVERTIBLE_FORMATS:
+            if __salt__['cmd.which']('qemu-img'):
+                return fmt
+            log.warning('Not converting {0} images to raw, qemu-img is not '
+                        'installed'.format(fmt))
+            return None
+    return None
+
+
+def _upload(name, source, profile=None, **kwargs):
+    '''
+    Uploads a missing image with glanceng.image_upload.
+    Returns a state return dict.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': 'Image "{0}" already exists'.format(name)}
+    image, msg = _find_image(name, profile)
+    if image:
+        if kwargs.get('hashes'):
+            ret['comment'] += '\n'
+            _check_hashes(ret, image, kwargs['hashes'], profile)
+        return ret
+    elif image is None and not source:
+        ret['result'] = False
+        ret['comment'] = 'No source to upload image {0} from'.format(name)
+        return ret
+    elif image is False:
+        ret['result'] = None if __opts__['test'] else False
+        ret['comment'] = msg
+        return ret
+    if __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'glanceng.image_upload would upload an image ' \
+            'from {0}'.format(source)
+        if kwargs.get('source_format'):
+            ret['comment'] += ', converted from {0} to raw'.format(
+                kwargs['source_format'])
+        return ret
+    try:
+        image = __salt__['glanceng.image_upload'](name, source,
+                                                  profile=profile, **kwargs)
+    except Exception as err:  # pylint: disable=broad-except
+        image = {'result': False, 'comment': str(err)}
+    if image.get('result') is False:
+        ret['result'] = False
+        ret['comment'] = image['comment']
+        return ret
+    _index_update(image, profile)
+    ret['changes'] = {name: {'old': None, 'new': image}}
+    ret['comment'] = 'Image {0} was uploaded from {1} ({2} bytes in ' \
+        '{3}s)'.format(image['id'], source, image['size'], image['seconds'])
+    return ret
+
+
+def image_uploaded(name, source, profile=None, visibility='public',
+                   protected=False, disk_format='raw',
+                   container_format='bare', tags=None, checksum=None,
+                   chunk_size=None, hashes=None):
+    """
+    Makes sure an image exists, streaming its data into Glance if not
+
+    Unlike image_import, the data is read by the minion from an http(s)
+    URL or a local file and sent to the Glance V2 upload API in chunks,
+    without being staged on local disk.
+
+    :param name: Name of the image
+    :param source: http(s) URL, file:// URL or path of the image data
+    :param profile: Authentication profile
+    :param visibility: Scope of image accessibility.
+                       Valid values: public, private, community, shared
+    :param protected: If true, image will not be deletable.
+    :param disk_format: Format of the disk
+    :param container_format: Format of the container
+    :param tags: List of strings related to the image
+    :param checksum: Expected MD5 checksum of the image data
+    :param chunk_size: Bytes read from the source and sent at a time
+    :param hashes: Expected md5, sha256 or sha512 digests of the image
+                   data. They are computed while uploading and recorded
+                   in the image properties; an existing image is checked
+                   against the recorded ones.
+    """
+    started = _timing_start(profile)
+    kwargs = {'visibility': visibility, 'protected': protected,
+              'disk_format': disk_format,
+              'container_format': container_format, 'tags': tags,
+              'checksum': checksum, 'hashes': hashes}
+    if chunk_size:
+        kwargs['chunk_size'] = chunk_size
+    ret = _upload(name, source, profile=profile, **kwargs)
+    return _timing(ret, profile, started)
+
+
+def images_uploaded(name, images, profile=None, concurrency=4,
+                    chunk_size=None):
+    """
+    Makes sure many images exist, uploading the missing ones in parallel
+
+    :param name: Name of the state
+    :param images: Dictionary of images keyed by name. Every value takes
+                   the arguments of image_uploaded; "name" overrides the
+                   key.
+    :param profile: Authentication profile
+    :param concurrency: Number of images uploaded at the same time
+    :param chunk_size: Bytes read from the sources and sent at a time
+    """
+    started = _timing_start(profile)
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    upload_args = ('visibility', 'protected', 'disk_format',
+                   'container_format', 'tags', 'checksum', 'chunk_size',
+                   'hashes')
+
+    try:
+        _image_index(profile)
+    except (kstone_Unauthorized, glance_Unauthorized) as err:
+        ret['result'] = False
+        ret['comment'] = 'Unauthorized: {0}'.format(err)
+        return _timing(ret, profile, started)
+
+    jobs = []
+    for key in sorted(images):
+        params = images[key] or {}
+        kwargs = dict((arg, params[arg]) for arg in upload_args
+                      if arg in params)
+        if chunk_size and 'chunk_size' not in kwargs:
+            kwargs['chunk_size'] = chunk_size
+        jobs.append((params.get('name', key), params.get('source'), kwargs))
+
+    def _run(job):
+        image_name, source, kwargs = job
+        return _upload(image_name, source, profile=profile, **kwargs)
+
+    pool = ThreadPool(max(1, min(int(concurrency), len(jobs) or 1)))
+    try:
+        results = pool.map(_run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    comments = []
+    for sub_ret in results:
+        ret['changes'].update(sub_ret['changes'])
+        comments.append('{0}: {1}'.format(sub_ret['name'],
+                                          sub_ret['comment'].strip()))
+        if sub_ret['result'] is False:
             ret['result'] = False
-            ret['comment'] = msg
+        elif sub_ret['result'] is None and ret['result'] is True:
+            ret['result'] = None
+    ret['comment'] = '\n'.join(comments)
+    return _timing(ret, profile, started)
+
+
+def images_cached(name, images=None, tags=None,
+                  endpoint='http://127.0.0.1:9292', profile=None,
+                  concurrency=2):
+    """
+    Makes sure hot images are in the image cache of this glance-api node
+
+    Uncached images selected by name or tag are queued through the cache
+    management API and read into the cache, "concurrency" at a time, with
+    glanceng.image_cache_prefetch. Apply it on every API node.
+
+    :param name: Name of the state
+    :param images: List of image names
+    :param tags: List of image tags
+    :param endpoint: URL of this node's glance-api
+    :param profile: Authentication profile
+    :param concurrency: Number of images read into the cache at a time
+    """
+    started = _timing_start(profile)
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    try:
+        status = __salt__['glanceng.image_cache_prefetch'](
+            images=images, tags=tags, endpoint=endpoint, profile=profile,
+            concurrency=concurrency, queue=not __opts__['test'],
+            prefetch=not __opts__['test'])
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['comment'] = 'Unable to prefetch images on {0}: {1}'.format(
+            endpoint, err)
+        return _timing(ret, profile, started)
+
+    comments = []
+    for key in ('cached', 'prefetched', 'queued', 'uncached', 'missing'):
+        if status[key]:
+            comments.append('{0}: {1}'.format(key.capitalize(),
+                                              ', '.join(status[key])))
+    for image_name, err in sorted(status['failed'].items()):
+        comments.append('Failed: {0}: {1}'.format(image_name, err))
+    if status['failed']:
+        ret['result'] = False
+    elif __opts__['test'] and status['uncached']:
+        ret['result'] = None
+        comments.insert(0, 'glanceng.images_cached would prefetch '
+                           '{0} image(s)'.format(len(status['uncached'])))
+    for key in ('prefetched', 'queued'):
+        if status[key]:
+            ret['changes'][key] = status[key]
+    ret['comment'] = '\n'.join(comments) or 'No image selected'
+    return _timing(ret, profile, started)
+
+
+def _replication_targets(targets):
+    '''
+    Returns {profile: {'concurrency': ..., 'bandwidth': ...}} for the
+    targets of images_replicated, given as such a dict or a list.
+    '''
+    if not isinstance(targets, dict):
+        targets = dict((target, {}) for target in targets or [])
+    return dict((target, {'concurrency': max(1, int(
+                              (limits or {}).get('concurrency', 2))),
+                          'bandwidth': (limits or {}).get('bandwidth')})
+                for target, limits in targets.items())
+
+
+def images_replicated(name, source, targets, images=None, tags=None,
+                      replace=False):
+    """
+    Makes sure images of one profile exist in other profiles too
+
+    Copies base images from one region (or cloud) to others, each a
+    glanceng profile. The active images of the source and of every target
+    are listed once and indexed by checksum and name. An image is only
+    copied to a target that has no active image with its checksum, e.g.
+    because it is missing or has changed at the source. Its data is
+    streamed from the source Glance straight into the target with
+    glanceng.image_replicate.
+
+    Transfers to the targets run in parallel, to each target at most
+    "concurrency" at a time and within its "bandwidth". Images are the
+    unit of resumption: replicas that were completed by an interrupted
+    run are found by their checksum and not copied again, and unfinished
+    ones are deleted and copied again.
+
+    :param name: Name of the state
+    :param source: Authentication profile to copy images from
+    :param targets: Authentication profiles to copy images to, as a list
+                    or as a dictionary of profiles with their limits,
+                    "concurrency" (2 by default) and "bandwidth" (bytes
+                    per second, unlimited by default)
+    :param images: List of image names to replicate
+    :param tags: List of tags an image needs to be replicated
+    :param replace: Delete the older images of the same name from a
+                    target once a changed image has been copied to it,
+                    unless they are protected
+    """
+    started = _timing_start()
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    targets = _replication_targets(targets)
+    try:
+        selected = [image for image in
+                    __salt__['glanceng.image_list'](profile=source,
+                                                    status='active')
+                    if (images is None or image['name'] in images) and
+                    set(tags or []).issubset(image.get('tags') or [])]
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['comment'] = 'Unable to list the images of {0}: {1}'.format(
+            source, err)
+        return _timing(ret, None, started)
+    comments = []
+    missing = sorted(set(images or []) -
+                     set(image['name'] for image in selected))
+    if missing:
+        ret['result'] = False
+        comments.append('Not found in {0}: {1}'.format(source,
+                                                        ', '.join(missing)))
+
+    # Transfers per target: (source image, older images of its name)
+    transfers = dict((target, []) for target in targets)
+    for target in sorted(targets):
+        try:
+            catalog = __salt__['glanceng.image_list'](profile=target)
+        except Exception as err:  # pylint: disable=broad-except
+            ret['result'] = False
+            comments.append('{0}: Unable to list images: {1}'.format(
+                target, err))
+            del transfers[target]
+            continue
+        by_checksum = {}
+        by_name = {}
+        for image in catalog:
+            if image.get('status') == 'active':
+                by_checksum.setdefault(image.get('checksum'), []).append(
+                    image)
+            by_name.setdefault(image.get('name'), []).append(image)
+        for image in selected:
+            if image['checksum'] in by_checksum:
+                continue
+            origin = '{0}:{1}'.format(source, image['id'])
+            older = []
+            for other in by_name.get(image['name'], []):
+                if other.get('status') == 'active':
+                    older.append(other)
+                elif other.get('glanceng_replicated_from') == origin:
+                    # Left behind by an interrupted transfer
+                    if not __opts__['test']:
+                        __salt__['glance.image_delete'](id=other['id'],
+                                                        profile=target)
+            transfers[target].append((image, older))
+
+    pending = sum(len(items) for items in transfers.values())
+    if __opts__['test']:
+        for target in sorted(transfers):
+            for image, older in transfers[target]:
+                comments.append('{0}: would copy {1} ({2} bytes){3}'.format(
+                    target, image['name'], image.get('size'),
+                    ', replacing {0} older image(s)'.format(len(older))
+                    if replace and older else ''))
+        if pending and ret['result']:
+            ret['result'] = None
+    elif pending:
+        def _copy(target, args):
+            image, older = args
+            try:
+                copy = __salt__['glanceng.image_replicate'](
+                    image['id'], source, profile=target,
+                    bandwidth=targets[target]['bandwidth'])
+            except Exception as err:  # pylint: disable=broad-except
+                copy = {'result': False, 'comment': str(err)}
+            if copy.get('result') is False or not replace:
+                return target, image, copy, []
+            removed = []
+            for other in older:
+                if other.get('protected'):
+                    continue
+                __salt__['glance.image_delete'](id=other['id'],
+                                                profile=target)
+                removed.append(other['id'])
+            return target, image, copy, removed
+
+        # One pool per target, so that every target has its own limit
+        pools = []
+        try:
+            for target in sorted(transfers):
+                if not transfers[target]:
+                    continue
+                pool = ThreadPool(min(targets[target]['concurrency'],
+                                      len(transfers[target])))
+                pools.append((pool, pool.map_async(
+                    lambda args, target=target: _copy(target, args),
+                    transfers[target])))
+            for _, result in pools:
+                for target, image, copy, removed in result.get():
+                    if copy.get('result') is False:
+                        ret['result'] = False
+                        comments.append('{0}: {1}'.format(
+                            target, copy.get('comment')))
+                        continue
+                    ret['changes'].setdefault(target, {})[image['name']] = {
+                        'new': copy['id'],
+                        'old': removed or None,
+                        'size': copy['size'],
+                        'seconds': copy['seconds']}
+                    comments.append('{0}: copied {1}'.format(target,
+                                                             image['name']))
+        finally:
+            for pool, _ in pools:
+                pool.close()
+                pool.join()
+    in_sync = len(selected) * len(transfers) - pending
+    comments.insert(0, '{0} image(s) in sync, {1} to copy'.format(
+        in_sync, pending))
+    ret['comment'] = '\n'.join(comments)
+    return _timing(ret, None, started)
+
+
+def _prune_selection(images, pattern=None, tags=None, owner=None,
+                     older_than=None, keep=None, group_by=None):
+    '''
+    Returns the images images_pruned would delete, newest first, and the
+    ones it keeps because they are among the keep newest matching ones of
+    their family. Images of the same name form a family, or images with
+    the same value of the group_by property (by name if they lack it).
+    Only active and killed images are considered, and only active ones
+    are kept. Protected images and images in use are not taken out here.
+    '''
+    matching = sorted((image for image in images
+                       if image.get('status') in _PRUNABLE_STATUSES and
+                       (pattern is None or fnmatch.fnmatchcase(
+                           image.get('name') or '', pattern)) and
+                       set(tags or []).issubset(image.get('tags') or []) and
+                       (owner is None or image.get('owner') == owner)),
+                      key=lambda image: image.get('created_at') or '',
+                      reverse=True)
+    families = {}
+    for image in matching:
+        if group_by and image.get(group_by) is not None:
+            family = (group_by, image[group_by])
         else:
-            ret['changes'][name]['new']['image_id'] = image['id']
-            ret['changes'][name]['new']['image_status'] = image['status']
-            ret['comment'] = ("Image {0} was successfully created by task "
-                              "{1}".format(image['id'], task_id))
-            if checksum:
-                if image['status'] == 'active':
-                    if 'checksum' not in image:
-                        # Refresh our info about the image
-                        image = __salt__['glance.image_show'](image['id'])
-                    if 'checksum' not in image:
-                        if not __opts__['test']:
-                            ret['result'] = False
-                        else:
-                            ret['result'] = None
-                        ret['comment'] += (
-                            "No checksum available for this image:\n"
-                            "Image has status '{0}'.".format(image['status']))
-                    elif image['checksum'] != checksum:
-                        if not __opts__['test']:
-                            ret['result'] = False
-                        else:
-                            ret['result'] = None
-                        ret['comment'] += ("'checksum' is {0}, should be "
-                                           "{1}.\n".format(image['checksum'],
-                                                           checksum))
-                    else:
-                        ret['comment'] += (
-                            "'checksum' is correct ({0}).\n".format(checksum))
-                elif image['status'] in ['saving', 'queued']:
-                    ret['comment'] += (
-                        "Checksum will not be verified as image has not "
-                        "reached 'status=active' yet.\n")
-        log.debug('glance.image_present will return: {0}'.format(ret))
-        return ret
+            family = ('name', image.get('name'))
+        families.setdefault(family, []).append(image)
+    kept = []
+    for family in families.values():
+        # Failed uploads don't count as versions to keep
+        kept.extend([image for image in family
+                     if image.get('status') == 'active'][:int(keep or 0)])
+    kept.sort(key=lambda image: image.get('created_at') or '', reverse=True)
+    selected = [image for image in matching if image not in kept]
+    if older_than is not None:
+        cutoff = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(
+            time.time() - float(older_than) * 86400))
+        selected = [image for image in selected
+                    if (image.get('created_at') or '') < cutoff]
+    return selected, kept
+
+
+def images_pruned(name, profile=None, pattern=None, tags=None, owner=None,
+                  older_than=None, keep=None, group_by=None,
+                  in_use='glanceng.images_in_use', concurrency=4):
+    """
+    Deletes old images according to a retention policy
+
+    Selects the images whose name matches pattern and that have all tags
+    and the owner given, keeps the "keep" newest of each family and
+    deletes the rest that are older than "older_than" days. Images of the
+    same name form a family, or with group_by images with the same value
+    of that property, e.g. os_version for versioned image names. Only
+    active and killed (failed) images are considered, so images an import
+    is still writing are left alone. Protected images and images reported
+    by the in_use check are never deleted. Deletes run "concurrency" at a
+    time. In test mode the images that would be
+    deleted and the bytes that would be reclaimed are reported.
+
+    At least one of pattern, tags or owner has to be given, older_than
+    alone would select every image of the cloud.
+
+    :param name: Name of the state
+    :param profile: Authentication profile
+    :param pattern: Shell style pattern of image names, e.g. "ubuntu-16.04-*"
+    :param tags: List of tags an image needs to be deleted
+    :param owner: ID of the project owning the images
+    :param older_than: Minimum age in days of the images to delete
+    :param keep: Number of the newest selected images to keep per family
+    :param group_by: Image property the families are formed by, the image
+                     name by default
+    :param in_use: Salt function taking a profile and returning the IDs of
+                   the images in use, glanceng.images_in_use (instances)
+                   by default; set to false to disable the check
+    :param concurrency: Number of images deleted at a time
+    """
+    started = _timing_start(profile)
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    if pattern is None and not tags and owner is None:
+        ret['result'] = False
+        ret['comment'] = 'One of pattern, tags or owner is required'
+        return _timing(ret, profile, started)
+    try:
+        images = __salt__['glanceng.image_list'](profile=profile)
+        used = set(__salt__[in_use](profile=profile)) if in_use else set()
+    except Exception as err:  # pylint: disable=broad-except
+        ret['result'] = False
+        ret['comment'] = 'Unable to select images: {0}'.format(err)
+        return _timing(ret, profile, started)
+
+    selected, kept = _prune_selection(images, pattern, tags, owner,
+                                      older_than, keep, group_by)
+    comments = []
+    doomed = []
+    for image in selected:
+        if image.get('protected'):
+            comments.append('Skipped {0} ({1}): protected'.format(
+                image.get('name'), image['id']))
+        elif image['id'] in used:
+            comments.append('Skipped {0} ({1}): in use'.format(
+                image.get('name'), image['id']))
+        else:
+            doomed.append(image)
+    size = sum(image.get('size') or 0 for image in doomed)
+
+    if not doomed:
+        comments.insert(0, 'No image to delete, {0} kept'.format(len(kept)))
+    elif __opts__['test']:
+        ret['result'] = None
+        comments.insert(0, 'glanceng.images_pruned would delete {0} '
+                           'image(s) and reclaim {1} bytes, {2} kept'.format(
+                               len(doomed), size, len(kept)))
+        comments.extend('Would delete {0} ({1}), {2} bytes, created '
+                        '{3}'.format(image.get('name'), image['id'],
+                                     image.get('size'),
+                                     image.get('created_at'))
+                        for image in doomed)
+    else:
+        def _delete(image):
+            try:
+                result = __salt__['glance.image_delete'](id=image['id'],
+                                                         profile=profile)
+            except Exception as err:  # pylint: disable=broad-except
+                return image, err
+            if isinstance(result, dict) and result.get('result') is False:
+                return image, result.get('comment')
+            return image, None
+
+        pool = ThreadPool(max(1, min(int(concurrency), len(doomed))))
+        try:
+            results = pool.map(_delete, doomed)
+        finally:
+            pool.close()
+            pool.join()
+        deleted = {}
+        reclaimed = 0
+        for image, err in results:
+            if err is not None:
+                ret['result'] = False
+                comments.append('Unable to delete {0} ({1}): {2}'.format(
+                    image.get('name'), image['id'], err))
+                continue
+            deleted[image['id']] = image.get('name')
+            reclaimed += image.get('size') or 0
+        comments.insert(0, 'Deleted {0} image(s), reclaimed {1} bytes, '
+                           '{2} kept'.format(len(deleted), reclaimed,
+                                             len(kept)))
+        if deleted:
+            ret['changes'] = {'deleted': deleted, 'bytes': reclaimed}
+    ret['comment'] = '\n'.join(comments)
+    return _timing(ret, profile, started)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Startup-time benchmark for the glance_policy grain
+==================================================
+
+Measures what _grains/glance_policy.py costs on a grain refresh against
+a generated policy file::
+
+    python tests/benchmarks/bench_glance_policy_grain.py --rules 500
+
+Reported cases:
+
+- import: loading the grain module
+- parse: first refresh, the policy file is parsed
+- warm: refresh in the same process, file unchanged
+- restart: refresh in a new process (cache read from the cachedir)
+- changed: refresh after the policy file was rewritten
+- loader: refresh through the Salt loader and keystone_policy, as done
+  for every refresh before the cache existed (needs salt and the
+  keystone formula's modules; skipped otherwise)
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_glanceng import ROOT, load_source, percentile
+
+GRAIN = os.path.join(ROOT, '_grains', 'glance_policy.py')
+
+
+def _write_policy(path, rules, salt=''):
+    policy = dict(('rule_{0}{1}'.format(i, salt), 'role:admin or role:r{0}'
+                   .format(i)) for i in range(rules))
+    with open(path, 'w') as fh_:
+        json.dump(policy, fh_, indent=4)
+
+
+def _measure(func, iterations, setup=None):
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        samples.append((time.time() - start) * 1000.0)
+    return samples
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='glance-policy-bench-')
+    policy = os.path.join(tmpdir, 'policy.json')
+    _write_policy(policy, args.rules)
+    results = []
+    state = {}
+
+    def load():
+        state['mod'] = load_source('glance_policy_bench', GRAIN)
+        state['mod'].__opts__ = {'cachedir': tmpdir}
+        state['mod'].POLICY_PATH = policy
+
+    def drop_caches():
+        state['mod']._CACHE.clear()
+        cache = os.path.join(tmpdir, state['mod'].CACHE_NAME)
+        if os.path.exists(cache):
+            os.unlink(cache)
+
+    def restart():
+        state['mod']._CACHE.clear()
+
+    def change():
+        state['counter'] = state.get('counter', 0) + 1
+        _write_policy(policy, args.rules, salt=state['counter'])
+
+    def refresh():
+        state['mod'].main()
+
+    try:
+        results.append(('import', _measure(load, args.iterations)))
+        results.append(('parse', _measure(refresh, args.iterations,
+                                          drop_caches)))
+        refresh()
+        results.append(('warm', _measure(refresh, args.iterations)))
+        results.append(('restart', _measure(refresh, args.iterations,
+                                            restart)))
+        results.append(('changed', _measure(refresh, args.iterations,
+                                            change)))
+        try:
+            results.append(('loader', _measure(
+                lambda: state['mod']._rules_from_module(policy),
+                args.iterations)))
+        except ImportError:
+            print('Skipping loader: salt is not available', file=sys.stderr)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rules', type=int, default=200,
+                        help='number of rules in the generated policy')
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    header = '{0:<10} {1:>10} {2:>10} {3:>10}'.format(
+        'case', 'p50 ms', 'p90 ms', 'max ms')
+    print(header)
+    print('-' * len(header))
+    for name, samples in run(args):
+        print('{0:<10} {1:>10.3f} {2:>10.3f} {3:>10.3f}'.format(
+            name, percentile(samples, 50), percentile(samples, 90),
+            max(samples)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
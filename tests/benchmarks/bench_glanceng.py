@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the glanceng execution and state modules
+========================================================
+
+Runs the hot paths of _modules/glanceng.py and _states/glanceng.py
+against the in-process fake Keystone/Glance of fake_openstack.py and
+reports, per operation, the API requests and bytes it cost and the
+latency percentiles::
+
+    python tests/benchmarks/bench_glanceng.py --images 2000 --tasks 5000
+
+Requires salt, python-glanceclient and python-keystoneclient. The state
+benchmarks also need salt.modules.glance, which the states call for
+image listings.
+
+Every iteration gets a fresh __context__, like a new state run. Module
+level caches (tokens, schemas) survive between iterations, as they do in
+a long running minion, unless --cold is given.
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from fake_openstack import FakeOpenStack
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+PROFILE = 'benchmark'
+
+
+def load_source(modname, path):
+    '''
+    Imports a python file as a module, like salt's loader does.
+    '''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(modname, path)
+    spec = importlib.util.spec_from_file_location(modname, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of a list of numbers.
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def _public_functions(mod, virtualname):
+    return dict(('{0}.{1}'.format(virtualname, attr), getattr(mod, attr))
+                for attr in dir(mod)
+                if not attr.startswith('_') and
+                callable(getattr(mod, attr)) and
+                getattr(getattr(mod, attr), '__module__', None) ==
+                mod.__name__)
+
+
+class Environment(object):
+    '''
+    Loads the formula's modules with the dunder dictionaries salt would
+    inject, pointed at a fake cloud.
+    '''
+
+    def __init__(self, cloud, cachedir, cold=False, poll_delay=0.01):
+        self.cloud = cloud
+        self.cold = cold
+        self.opts = {
+            'cachedir': cachedir,
+            'test': False,
+            PROFILE + ':keystone.user': 'admin',
+            PROFILE + ':keystone.password': 'secret',
+            PROFILE + ':keystone.tenant': 'admin',
+            PROFILE + ':keystone.auth_url': cloud.url + '/v2.0',
+            PROFILE + ':keystone.region': 'RegionOne',
+        }
+        self.salt = {
+            'config.get': lambda key, default=None:
+                self.opts.get(key, default),
+            'keystone.endpoint_get': lambda service, profile=None, **kw: {
+                'internalurl': cloud.url, 'publicurl': cloud.url,
+                'adminurl': cloud.url, 'service': service},
+        }
+        self.context = {}
+
+        self.module = self._load('_modules', 'glanceng', 'glanceng_mod')
+        self.salt.update(_public_functions(self.module, 'glanceng'))
+        self.states = None
+        try:
+            import salt.modules.glance as glance_core
+        except ImportError:
+            glance_core = None
+        if glance_core is not None:
+            self._inject(glance_core)
+            self.salt.update(_public_functions(glance_core, 'glance'))
+            self.states = self._load('_states', 'glanceng', 'glanceng_state')
+            self.states._POLL_INITIAL_DELAY = poll_delay
+            self.states._POLL_MAX_DELAY = poll_delay * 4
+
+    def _inject(self, mod):
+        mod.__salt__ = self.salt
+        mod.__opts__ = self.opts
+        mod.__context__ = self.context
+
+    def _load(self, directory, name, modname):
+        mod = load_source(modname, os.path.join(ROOT, directory,
+                                                name + '.py'))
+        self._inject(mod)
+        return mod
+
+    def new_run(self):
+        '''
+        Starts what salt would consider a new state run.
+        '''
+        self.context.clear()
+        if self.cold:
+            for attr in dir(self.module):
+                value = getattr(self.module, attr)
+                if attr.startswith('_') and attr.isupper() and \
+                        isinstance(value, dict):
+                    value.clear()
+            cache = os.path.join(self.opts['cachedir'], 'glanceng')
+            shutil.rmtree(cache, ignore_errors=True)
+
+
+def _op_task_list(env, i):
+    env.salt['glanceng.task_list'](profile=PROFILE)
+
+
+def _op_task_list_filtered(env, i):
+    env.salt['glanceng.task_list'](profile=PROFILE, status='processing',
+                                   limit=20)
+
+
+def _op_task_show(env, i):
+    task_id = random.choice(env.cloud.cloud.task_order)
+    env.salt['glanceng.task_show'](task_id, profile=PROFILE)
+
+
+def _op_owner_id(env, i):
+    name = env.cloud.cloud.images[
+        random.choice(env.cloud.cloud.image_order)]['name']
+    env.salt['glanceng.get_image_owner_id'](name, profile=PROFILE)
+
+
+def _op_owner_ids(env, i):
+    order = env.cloud.cloud.image_order
+    names = [env.cloud.cloud.images[image_id]['name']
+             for image_id in random.sample(order, min(10, len(order)))]
+    env.salt['glanceng.get_image_owner_ids'](names, profile=PROFILE)
+
+
+def _op_image_present(env, i):
+    name = env.cloud.cloud.images[
+        random.choice(env.cloud.cloud.image_order)]['name']
+    ret = env.states.image_present(name, profile=PROFILE)
+    assert ret['result'] is not False, ret
+
+
+def _op_image_import(env, i):
+    name = 'bench-import-{0}-{1}'.format(os.getpid(), time.time())
+    ret = env.states.image_import(
+        name, profile=PROFILE, location='http://example.com/bench.img',
+        timeout=30)
+    assert ret['result'] is not False, ret
+
+
+OPERATIONS = [
+    ('task_show', _op_task_show, False),
+    ('task_list', _op_task_list, False),
+    ('task_list(status,limit)', _op_task_list_filtered, False),
+    ('get_image_owner_id', _op_owner_id, False),
+    ('get_image_owner_ids(10)', _op_owner_ids, False),
+    ('state image_present', _op_image_present, True),
+    ('state image_import', _op_image_import, True),
+]
+
+
+def run(args):
+    results = []
+    task_states = args.task_states.split(',')
+    cachedir = tempfile.mkdtemp(prefix='glanceng-bench-')
+    try:
+        with FakeOpenStack(images=args.images, tasks=args.tasks,
+                           task_states=task_states) as cloud:
+            env = Environment(cloud, cachedir, cold=args.cold,
+                              poll_delay=args.poll_delay)
+            for name, func, needs_states in OPERATIONS:
+                if args.only and not any(o in name for o in args.only):
+                    continue
+                if needs_states and env.states is None:
+                    print('Skipping {0}: salt.modules.glance is not '
+                          'available'.format(name), file=sys.stderr)
+                    continue
+                # Warm up once, so that "warm" numbers don't include the
+                # first authentication of the process.
+                env.new_run()
+                func(env, -1)
+                cloud.stats.reset()
+                latencies = []
+                for i in range(args.iterations):
+                    env.new_run()
+                    start = time.time()
+                    func(env, i)
+                    latencies.append((time.time() - start) * 1000.0)
+                requests = cloud.stats.snapshot()
+                results.append({
+                    'operation': name,
+                    'iterations': args.iterations,
+                    'requests_per_op': sum(
+                        r['count'] for r in requests.values()) /
+                    float(args.iterations),
+                    'bytes_per_op': sum(
+                        r['bytes_in'] + r['bytes_out']
+                        for r in requests.values()) /
+                    float(args.iterations),
+                    'p50_ms': percentile(latencies, 50),
+                    'p90_ms': percentile(latencies, 90),
+                    'p99_ms': percentile(latencies, 99),
+                    'routes': requests,
+                })
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+    return results
+
+
+def report(results, verbose=False):
+    header = '{0:<26} {1:>10} {2:>12} {3:>9} {4:>9} {5:>9}'.format(
+        'operation', 'req/op', 'bytes/op', 'p50 ms', 'p90 ms', 'p99 ms')
+    print(header)
+    print('-' * len(header))
+    for res in results:
+        print('{operation:<26} {requests_per_op:>10.1f} '
+              '{bytes_per_op:>12.0f} {p50_ms:>9.1f} {p90_ms:>9.1f} '
+              '{p99_ms:>9.1f}'.format(**res))
+        if verbose:
+            for route, entry in sorted(res['routes'].items()):
+                print('    {0:<34} {1:>8.1f}'.format(
+                    route, entry['count'] / float(res['iterations'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--images', type=int, default=500,
+                        help='number of images to seed')
+    parser.add_argument('--tasks', type=int, default=1000,
+                        help='number of finished tasks to seed')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--task-states', default='pending,processing,success',
+                        help='states an import task walks through, one '
+                             'per poll')
+    parser.add_argument('--poll-delay', type=float, default=0.01,
+                        help='initial task poll delay used by the states')
+    parser.add_argument('--cold', action='store_true',
+                        help='drop module caches before every iteration')
+    parser.add_argument('--only', action='append',
+                        help='only run operations containing this string')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show requests per route')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    report(results, args.verbose)
+    if args.json:
+        with open(args.json, 'w') as fh_:
+            json.dump(results, fh_, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Load-time and per-call overhead of the glanceng execution module
+================================================================
+
+Measures the local cost of _modules/glanceng.py, without any API
+traffic::
+
+    python tests/benchmarks/bench_glanceng_overhead.py
+
+Reported cases:
+
+- import: loading the module, as the salt loader does on every minion
+- first use: importing glanceclient and keystoneclient on first call
+- task_show (info) / task_show (debug): one task_show call on a large
+  task with the remote call replaced by a canned response, with debug
+  logging disabled and enabled
+- task_list (info) / task_list (debug): the same for a 500 task listing
+
+Requires salt; the first use case also needs the client libraries.
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import logging
+import os
+import sys
+import time
+
+from bench_glanceng import ROOT, load_source, percentile
+
+MODULE = os.path.join(ROOT, '_modules', 'glanceng.py')
+TASK_KEYS = ['id', 'type', 'status', 'input', 'result', 'owner', 'message',
+             'expires_at', 'created_at', 'updated_at', 'self', 'schema']
+
+
+def _task(i):
+    return {'id': 'task-{0}'.format(i),
+            'type': 'import',
+            'status': 'success',
+            'input': {'import_from': 'http://example.com/{0}.img'.format(i),
+                      'import_from_format': 'qcow2',
+                      'image_properties': dict(
+                          ('property_{0}'.format(p), 'x' * 64)
+                          for p in range(50))},
+            'result': {'image_id': 'image-{0}'.format(i)},
+            'owner': 'owner',
+            'message': '',
+            'created_at': '2017-01-01T00:00:00Z',
+            'updated_at': '2017-01-01T00:00:00Z',
+            'unknown_key': 'filtered out'}
+
+
+def _measure(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        samples.append((time.time() - start) * 1000.0)
+    return samples
+
+
+def _load(counter=[0]):
+    counter[0] += 1
+    mod = load_source('glanceng_overhead_{0}'.format(counter[0]), MODULE)
+    mod.__opts__ = {}
+    mod.__salt__ = {}
+    mod.__context__ = {}
+    return mod
+
+
+def run(args):
+    results = [('import', _measure(_load, args.iterations))]
+
+    mod = _load()
+    if mod.HAS_GLANCE and mod.HAS_KEYSTONE:
+        start = time.time()
+        mod._glance()
+        mod._keystone()
+        results.append(('first use', [(time.time() - start) * 1000.0]))
+    else:
+        print('Skipping first use: client libraries are not available',
+              file=sys.stderr)
+
+    task = _task(0)
+    tasks = [_task(i) for i in range(500)]
+    mod._schema_keys = lambda name, profile=None: frozenset(TASK_KEYS)
+
+    def fake_api(profile, operation, *args, **kwargs):
+        if operation == 'tasks.get':
+            return task
+        return iter(tasks)
+    mod._api = fake_api
+
+    handler = logging.FileHandler(os.devnull)
+    mod.log.addHandler(handler)
+    mod.log.propagate = False
+    try:
+        for level_name, level in (('info', logging.INFO),
+                                  ('debug', logging.DEBUG)):
+            mod.log.setLevel(level)
+            results.append(('task_show ({0})'.format(level_name), _measure(
+                lambda: mod.task_show('task-0'), args.iterations)))
+            results.append(('task_list ({0})'.format(level_name), _measure(
+                lambda: mod.task_list(), args.iterations)))
+    finally:
+        mod.log.removeHandler(handler)
+        handler.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    header = '{0:<20} {1:>10} {2:>10} {3:>10}'.format(
+        'case', 'p50 ms', 'p90 ms', 'max ms')
+    print(header)
+    print('-' * len(header))
+    for name, samples in run(args):
+        print('{0:<20} {1:>10.3f} {2:>10.3f} {3:>10.3f}'.format(
+            name, percentile(samples, 50), percentile(samples, 90),
+            max(samples)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+'''
+In-process stand-in for the Keystone v2 and Glance v2 APIs
+===========================================================
+
+Just enough of both APIs for glanceclient and keystoneclient to talk to:
+token issuing, the service catalog, Glance versions, schemas, paginated
+image and task listings, image creation and import tasks.
+
+Import tasks walk through a configurable list of states, one step per
+GET of the task. When a task reaches "success" the image it imports is
+added to the catalog and named in the task result.
+
+Every request is counted per route together with the bytes received and
+sent, so that benchmarks can report the API cost of an operation.
+'''
+from __future__ import absolute_import, print_function
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import urlencode
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, urlencode
+
+TOKEN_TTL = 3600
+DEFAULT_LIMIT = 25
+
+IMAGE_PROPERTIES = ['id', 'name', 'status', 'visibility', 'protected',
+                    'checksum', 'owner', 'size', 'virtual_size',
+                    'disk_format', 'container_format', 'tags', 'min_disk',
+                    'min_ram', 'created_at', 'updated_at', 'file', 'self',
+                    'schema', 'direct_url', 'locations']
+TASK_PROPERTIES = ['id', 'type', 'status', 'input', 'result', 'owner',
+                   'message', 'expires_at', 'created_at', 'updated_at',
+                   'self', 'schema']
+
+
+def _isotime(epoch=None):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                         time.gmtime(time.time() if epoch is None else epoch))
+
+
+def _schema(name, properties):
+    # Properties without a type accept any value, which keeps warlock
+    # happy with nulls and lists alike.
+    return {'name': name,
+            'additionalProperties': {'type': 'string'},
+            'properties': dict((prop, {'description': prop})
+                               for prop in properties),
+            'links': []}
+
+
+def _list_schema(name, item):
+    return {'name': name,
+            'properties': {name: {'type': 'array', 'items': item},
+                           'first': {'type': 'string'},
+                           'next': {'type': 'string'},
+                           'schema': {'type': 'string'}},
+            'links': []}
+
+
+class Stats(object):
+    '''
+    Request counters keyed by route, e.g. "GET /v2/tasks/{id}".
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+
+    def record(self, route, bytes_in, bytes_out):
+        with self._lock:
+            entry = self.requests.setdefault(
+                route, {'count': 0, 'bytes_in': 0, 'bytes_out': 0})
+            entry['count'] += 1
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+
+    def snapshot(self):
+        with self._lock:
+            return dict((route, dict(entry))
+                        for route, entry in self.requests.items())
+
+
+class FakeCloud(object):
+    '''
+    The data behind the fake APIs.
+
+    :param task_states: States an import task goes through, one per GET
+                        of the task. The last one should be "success" or
+                        "failure".
+    '''
+
+    def __init__(self, task_states=('pending', 'processing', 'success'),
+                 owner='fake-tenant-id'):
+        self.lock = threading.RLock()
+        self.task_states = list(task_states)
+        self.owner = owner
+        self.images = {}
+        self.image_order = []
+        self.tasks = {}
+        self.task_order = []
+        self.task_steps = {}
+
+    def seed(self, images=0, tasks=0):
+        '''
+        Adds active images and finished import tasks with timestamps in
+        the past, oldest first.
+        '''
+        start = time.time() - 86400 * 30
+        for i in range(images):
+            self.add_image({'name': 'seed-image-{0:06d}'.format(i)},
+                           status='active', created=start + i)
+        for i in range(tasks):
+            task = self.add_task('import', {
+                'import_from': 'http://example.com/seed-{0}.img'.format(i),
+                'import_from_format': 'raw',
+                'image_properties': {'name': 'seed-task-{0}'.format(i)}},
+                created=start + i)
+            task['status'] = 'success'
+            self.task_steps[task['id']] = len(self.task_states)
+
+    def add_image(self, properties, status='queued', created=None):
+        with self.lock:
+            image_id = str(uuid.uuid4())
+            stamp = _isotime(created)
+            image = {'id': image_id,
+                     'name': None,
+                     'status': status,
+                     'visibility': 'public',
+                     'protected': False,
+                     'checksum': None,
+                     'owner': self.owner,
+                     'size': None,
+                     'virtual_size': None,
+                     'disk_format': 'raw',
+                     'container_format': 'bare',
+                     'tags': [],
+                     'min_disk': 0,
+                     'min_ram': 0,
+                     'created_at': stamp,
+                     'updated_at': stamp,
+                     'file': '/v2/images/{0}/file'.format(image_id),
+                     'self': '/v2/images/{0}'.format(image_id),
+                     'schema': '/v2/schemas/image'}
+            image.update(properties)
+            if status == 'active' and image['checksum'] is None:
+                image['checksum'] = hashlib.md5(
+                    image_id.encode('utf-8')).hexdigest()
+                image['size'] = 0
+            self.images[image_id] = image
+            self.image_order.append(image_id)
+            return image
+
+    def add_task(self, task_type, task_input, created=None):
+        with self.lock:
+            task_id = str(uuid.uuid4())
+            stamp = _isotime(created)
+            task = {'id': task_id,
+                    'type': task_type,
+                    'status': self.task_states[0],
+                    'input': task_input,
+                    'result': None,
+                    'owner': self.owner,
+                    'message': '',
+                    'created_at': stamp,
+                    'updated_at': stamp,
+                    'self': '/v2/tasks/{0}'.format(task_id),
+                    'schema': '/v2/schemas/task'}
+            self.tasks[task_id] = task
+            self.task_order.append(task_id)
+            self.task_steps[task_id] = 1
+            return task
+
+    def advance_task(self, task_id):
+        '''
+        Moves a task one step through task_states.
+        '''
+        with self.lock:
+            task = self.tasks[task_id]
+            step = self.task_steps[task_id]
+            if step >= len(self.task_states):
+                return task
+            task['status'] = self.task_states[step]
+            task['updated_at'] = _isotime()
+            self.task_steps[task_id] = step + 1
+            if task['status'] == 'success' and task['type'] == 'import':
+                props = dict(task['input'].get('image_properties', {}))
+                image = self.add_image(props, status='active')
+                task['result'] = {'image_id': image['id']}
+            elif task['status'] == 'failure':
+                task['message'] = 'Simulated import failure'
+            return task
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _paginate(items, query, key, base):
+    '''
+    Returns a page of items in the Glance v2 listing format.
+    '''
+    limit = int(query.get('limit', [DEFAULT_LIMIT])[0])
+    marker = query.get('marker', [None])[0]
+    start = 0
+    if marker:
+        ids = [item['id'] for item in items]
+        start = ids.index(marker) + 1 if marker in ids else len(items)
+    page = items[start:start + limit]
+    body = {key: page, 'first': base, 'schema': '/v2/schemas/' + key}
+    if start + limit < len(items) and page:
+        params = dict((k, v[0]) for k, v in query.items() if k != 'marker')
+        params['marker'] = page[-1]['id']
+        body['next'] = '{0}?{1}'.format(base, urlencode(sorted(params.items())))
+    return body
+
+
+def _sorted(items, query, default_key):
+    sort_key = query.get('sort_key', [default_key])[0]
+    reverse = query.get('sort_dir', ['desc'])[0] == 'desc'
+    return sorted(items, key=lambda item: (item.get(sort_key) or '',
+                                           item['id']), reverse=reverse)
+
+
+def make_handler(cloud, stats, base_url):
+    '''
+    Builds a request handler class bound to a cloud and its stats.
+    '''
+    routes = []
+
+    def route(method, pattern, name):
+        def decorator(func):
+            routes.append((method, re.compile('^' + pattern + '$'), name,
+                           func))
+            return func
+        return decorator
+
+    def token_body():
+        return {'access': {
+            'token': {'id': uuid.uuid4().hex,
+                      'issued_at': _isotime(),
+                      'expires': _isotime(time.time() + TOKEN_TTL),
+                      'tenant': {'id': cloud.owner, 'name': 'admin',
+                                 'enabled': True}},
+            'serviceCatalog': [
+                {'type': 'image', 'name': 'glance',
+                 'endpoints': [{'region': 'RegionOne',
+                                'publicURL': base_url,
+                                'internalURL': base_url,
+                                'adminURL': base_url}],
+                 'endpoints_links': []},
+                {'type': 'identity', 'name': 'keystone',
+                 'endpoints': [{'region': 'RegionOne',
+                                'publicURL': base_url + '/v2.0',
+                                'internalURL': base_url + '/v2.0',
+                                'adminURL': base_url + '/v2.0'}],
+                 'endpoints_links': []}],
+            'user': {'id': 'fake-user-id', 'name': 'admin',
+                     'roles': [{'name': 'admin'}], 'roles_links': []},
+            'metadata': {'is_admin': 0, 'roles': []}}}
+
+    @route('POST', '/v2.0/tokens', 'POST /v2.0/tokens')
+    def tokens(handler, match, query, body):
+        return 200, token_body()
+
+    @route('GET', '/v2.0/?', 'GET /v2.0')
+    def identity_version(handler, match, query, body):
+        return 200, {'version': {'id': 'v2.0', 'status': 'stable',
+                                 'links': [{'rel': 'self',
+                                            'href': base_url + '/v2.0/'}]}}
+
+    @route('GET', '/(versions)?', 'GET /versions')
+    def versions(handler, match, query, body):
+        return 200, {'versions': [
+            {'id': 'v2.3', 'status': 'CURRENT',
+             'links': [{'rel': 'self', 'href': base_url + '/v2/'}]},
+            {'id': 'v1.1', 'status': 'DEPRECATED',
+             'links': [{'rel': 'self', 'href': base_url + '/v1/'}]}]}
+
+    @route('GET', '/v2/schemas/(image|task|member)', 'GET /v2/schemas/{name}')
+    def schema(handler, match, query, body):
+        props = {'image': IMAGE_PROPERTIES, 'task': TASK_PROPERTIES,
+                 'member': ['image_id', 'member_id', 'status']}
+        return 200, _schema(match.group(1), props[match.group(1)])
+
+    @route('GET', '/v2/schemas/(images|tasks|members)',
+           'GET /v2/schemas/{names}')
+    def list_schema(handler, match, query, body):
+        name = match.group(1)
+        item = _schema(name[:-1], {'images': IMAGE_PROPERTIES,
+                                   'tasks': TASK_PROPERTIES,
+                                   'members': []}[name])
+        return 200, _list_schema(name, item)
+
+    @route('GET', '/v2/images', 'GET /v2/images')
+    def image_list(handler, match, query, body):
+        with cloud.lock:
+            images = [cloud.images[i] for i in cloud.image_order]
+        for attr in ('name', 'status', 'visibility', 'owner'):
+            if attr in query:
+                images = [i for i in images if i.get(attr) == query[attr][0]]
+        if 'tag' in query:
+            images = [i for i in images
+                      if set(query['tag']) <= set(i.get('tags') or [])]
+        images = _sorted(images, query, 'created_at')
+        return 200, _paginate(images, query, 'images', '/v2/images')
+
+    @route('POST', '/v2/images', 'POST /v2/images')
+    def image_create(handler, match, query, body):
+        return 201, cloud.add_image(body or {})
+
+    @route('GET', '/v2/images/([^/]+)', 'GET /v2/images/{id}')
+    def image_get(handler, match, query, body):
+        image = cloud.images.get(match.group(1))
+        if image is None:
+            return 404, {'message': 'Not found'}
+        return 200, image
+
+    @route('PATCH', '/v2/images/([^/]+)', 'PATCH /v2/images/{id}')
+    def image_update(handler, match, query, body):
+        with cloud.lock:
+            image = cloud.images.get(match.group(1))
+            if image is None:
+                return 404, {'message': 'Not found'}
+            for change in body or []:
+                attr = change['path'].lstrip('/')
+                if change['op'] == 'remove':
+                    image.pop(attr, None)
+                else:
+                    image[attr] = change.get('value')
+            image['updated_at'] = _isotime()
+        return 200, image
+
+    @route('DELETE', '/v2/images/([^/]+)', 'DELETE /v2/images/{id}')
+    def image_delete(handler, match, query, body):
+        with cloud.lock:
+            if cloud.images.pop(match.group(1), None) is None:
+                return 404, {'message': 'Not found'}
+            cloud.image_order.remove(match.group(1))
+        return 204, None
+
+    @route('GET', '/v2/tasks', 'GET /v2/tasks')
+    def task_list(handler, match, query, body):
+        with cloud.lock:
+            tasks = [cloud.tasks[t] for t in cloud.task_order]
+        for attr in ('status', 'type'):
+            if attr in query:
+                tasks = [t for t in tasks if t.get(attr) == query[attr][0]]
+        tasks = _sorted(tasks, query, 'created_at')
+        # Listings don't include input and result, like the real API.
+        tasks = [dict((k, v) for k, v in t.items()
+                      if k not in ('input', 'result')) for t in tasks]
+        return 200, _paginate(tasks, query, 'tasks', '/v2/tasks')
+
+    @route('POST', '/v2/tasks', 'POST /v2/tasks')
+    def task_create(handler, match, query, body):
+        return 201, cloud.add_task(body['type'], body.get('input', {}))
+
+    @route('GET', '/v2/tasks/([^/]+)', 'GET /v2/tasks/{id}')
+    def task_get(handler, match, query, body):
+        if match.group(1) not in cloud.tasks:
+            return 404, {'message': 'Not found'}
+        return 200, cloud.advance_task(match.group(1))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _dispatch(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            for method, pattern, name, func in routes:
+                match = pattern.match(parsed.path)
+                if method == self.command and match:
+                    break
+            else:
+                name = '{0} (unknown)'.format(self.command)
+                func = None
+            if func is None:
+                status, payload = 404, {'message': 'No route'}
+            else:
+                try:
+                    body = json.loads(raw.decode('utf-8')) if raw else None
+                except ValueError:
+                    body = None
+                status, payload = func(self, match, query, body)
+            out = b'' if payload is None else \
+                json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.send_header('X-Subject-Token', uuid.uuid4().hex)
+            self.end_headers()
+            self.wfile.write(out)
+            stats.record(name, len(raw), len(out))
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    return Handler
+
+
+class FakeOpenStack(object):
+    '''
+    Runs the fake Keystone and Glance APIs on a local port in a
+    background thread::
+
+        with FakeOpenStack(images=100, tasks=1000) as cloud:
+            print(cloud.url)
+    '''
+
+    def __init__(self, images=0, tasks=0, task_states=None):
+        self.cloud = FakeCloud(task_states or ('pending', 'processing',
+                                               'success'))
+        self.cloud.seed(images, tasks)
+        self.stats = Stats()
+        self.server = _Server(('127.0.0.1', 0), None)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.server.RequestHandlerClass = make_handler(self.cloud,
+                                                       self.stats, self.url)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
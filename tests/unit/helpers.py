@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+'''
+Loading the formula's salt modules for the unit tests
+'''
+from __future__ import absolute_import
+import os
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+def load_source(modname, path):
+    '''
+    Imports a python file as a module, like salt's loader does.
+    '''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(modname, path)
+    spec = importlib.util.spec_from_file_location(modname, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def load(directory, name, opts=None, salt=None, context=None, grains=None):
+    '''
+    Loads _<directory>/<name>.py with the dunder dictionaries salt would
+    inject.
+    '''
+    mod = load_source('{0}_{1}'.format(name, directory.strip('_')),
+                      os.path.join(ROOT, directory, name + '.py'))
+    mod.__opts__ = opts if opts is not None else {}
+    mod.__salt__ = salt if salt is not None else {}
+    mod.__context__ = context if context is not None else {}
+    mod.__grains__ = grains if grains is not None else {}
+    return mod
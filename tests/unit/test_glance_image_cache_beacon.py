@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the glance_image_cache beacon
+============================================
+
+The beacon watches a temporary directory laid out like the Glance image
+cache::
+
+    python -m unittest discover -s tests/unit
+'''
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from helpers import load
+
+
+class ImageCacheBeaconTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, 'incomplete'))
+        self.mod = load('_beacons', 'glance_image_cache')
+        self.config = [{'directory': self.tmpdir},
+                       {'max_size': 1000},
+                       {'high_watermark': 0.9},
+                       {'low_watermark': 0.75},
+                       {'repeat': 0}]
+        self.listed = []
+        listdir = os.listdir
+
+        def _listdir(path):
+            self.listed.append(path)
+            return listdir(path)
+        os.listdir = _listdir
+        self.addCleanup(setattr, os, 'listdir', listdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, size):
+        with open(os.path.join(self.tmpdir, name), 'wb') as fh_:
+            fh_.write(b'\0' * size)
+
+    def _tags(self):
+        return [event['tag'] for event in self.mod.beacon(self.config)]
+
+    def test_validate(self):
+        self.assertTrue(self.mod.validate(self.config)[0])
+        self.assertTrue(self.mod.validate({'max_size': 1000})[0])
+        self.assertFalse(self.mod.validate('max_size')[0])
+        self.assertFalse(self.mod.validate({})[0])
+        self.assertFalse(self.mod.validate({'max_size': 'big'})[0])
+        self.assertFalse(self.mod.validate({'max_size': 1000,
+                                            'high_watermark': 0.5,
+                                            'low_watermark': 0.75})[0])
+
+    def test_watermarks(self):
+        self._write('image-1', 500)
+        self.assertEqual(self._tags(), [])
+        self._write('image-2', 400)
+        events = self.mod.beacon(self.config)
+        self.assertEqual(events, [{'tag': 'high',
+                                   'directory': self.tmpdir,
+                                   'usage': 900,
+                                   'max_size': 1000,
+                                   'high_watermark': 900,
+                                   'low_watermark': 750}])
+        # Fired once while above the high watermark
+        self.assertEqual(self._tags(), [])
+        os.unlink(os.path.join(self.tmpdir, 'image-2'))
+        self._write('image-3', 300)
+        # Between the watermarks nothing changes
+        self.assertEqual(self._tags(), [])
+        os.unlink(os.path.join(self.tmpdir, 'image-3'))
+        self.assertEqual(self._tags(), ['low'])
+        self.assertEqual(self._tags(), [])
+
+    def test_repeat(self):
+        self.config[-1] = {'repeat': 1}
+        self._write('image-1', 950)
+        self.assertEqual(self._tags(), ['high'])
+        self.mod._STATE[self.tmpdir]['fired'] -= 1
+        self.assertEqual(self._tags(), ['high'])
+
+    def test_incremental_scan(self):
+        self._write('image-1', 100)
+        self.mod.beacon(self.config)
+        del self.listed[:]
+        self.mod.beacon(self.config)
+        # Only the files being written are listed again
+        self.assertEqual(self.listed,
+                         [os.path.join(self.tmpdir, 'incomplete')])
+        path = os.path.join(self.tmpdir, 'incomplete', 'image-2')
+        with open(path, 'wb') as fh_:
+            fh_.write(b'\0' * 500)
+            fh_.flush()
+            self.assertEqual(self._tags(), [])
+            fh_.write(b'\0' * 400)
+            fh_.flush()
+            self.assertEqual(self._tags(), ['high'])
+
+    def test_rescan(self):
+        self._write('image-1', 100)
+        self.mod.beacon(self.config)
+        self.mod._STATE[self.tmpdir]['scanned'] -= 3600
+        del self.listed[:]
+        self.mod.beacon(self.config)
+        self.assertIn(self.tmpdir, self.listed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the glance_notifications engine
+==============================================
+
+Runs the consumer against kombu's in-process ``memory://`` transport::
+
+    python -m unittest discover -s tests/unit
+
+Requires kombu.
+'''
+from __future__ import absolute_import
+import json
+import threading
+import unittest
+
+import kombu
+
+from helpers import load
+
+
+def _notification(event_type, payload, priority='INFO'):
+    return {'message_id': 'c6f8a2e4-2b4c-4c8e-9a53-1d3f7b5e9a10',
+            'publisher_id': 'image.ctl01',
+            'event_type': event_type,
+            'priority': priority,
+            'payload': payload,
+            'timestamp': '2017-06-01 10:00:00.000000'}
+
+
+def _envelope(notification):
+    # oslo.messaging messagingv2 driver
+    return {'oslo.version': '2.0',
+            'oslo.message': json.dumps(notification)}
+
+
+class EventTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load('_engines', 'glance_notifications')
+
+    def test_envelope(self):
+        notification = _notification('task.success',
+                                     {'id': 'task1', 'status': 'success'})
+        for body in (_envelope(notification), notification,
+                     json.dumps(_envelope(notification)).encode('utf-8')):
+            tag, data = self.mod._event(body)
+            self.assertEqual(tag, 'glance/task/task1/success')
+            self.assertEqual(data, {
+                'event_type': 'task.success',
+                'publisher_id': 'image.ctl01',
+                'timestamp': '2017-06-01 10:00:00.000000',
+                'priority': 'INFO',
+                'payload': {'id': 'task1', 'status': 'success'}})
+
+    def test_member(self):
+        tag, _ = self.mod._event(_envelope(_notification(
+            'image.member.create', {'image_id': 'image1',
+                                    'member_id': 'project1'})))
+        self.assertEqual(tag, 'glance/image/image1/member.create')
+
+    def test_filtered(self):
+        self.assertIsNone(self.mod._event(_envelope(_notification(
+            'compute.instance.create.end', {'id': 'server1'}))))
+        self.assertIsNone(self.mod._event(_envelope(_notification(
+            'image.activate', {'id': 'image1'})), events=['task.']))
+        self.assertIsNone(self.mod._event(_envelope(_notification(
+            'image.activate', {}))))
+
+
+class ConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load('_engines', 'glance_notifications')
+        self.connection = kombu.Connection(
+            'memory://', transport_options={'polling_interval': 0.01})
+        self.queues = self.mod._queues('openstack', ['notifications'],
+                                       'salt-glance-notifications.test')
+        # Bind the queue before anything is published, as the engine does
+        # before Glance sends anything
+        for queue in self.queues:
+            queue(self.connection.default_channel).declare()
+
+    def tearDown(self):
+        self.connection.release()
+
+    def _publish(self, body, priority='info'):
+        exchange = kombu.Exchange('openstack', type='topic', durable=False)
+        producer = self.connection.Producer(serializer='json')
+        producer.publish(body, exchange=exchange,
+                         routing_key='notifications.{0}'.format(priority),
+                         declare=[exchange])
+
+    def test_consume(self):
+        fired = []
+        consumer = None
+
+        def fire(tag, data):
+            fired.append((tag, data))
+            if len(fired) == 2:
+                consumer.should_stop = True
+
+        consumer = self.mod._Consumer(self.connection, self.queues, fire)
+        self._publish(_envelope(_notification(
+            'compute.instance.create.end', {'id': 'server1'})))
+        self._publish('not json')
+        self._publish(_envelope(_notification(
+            'task.success', {'id': 'task1', 'status': 'success'})))
+        self._publish(_envelope(_notification(
+            'image.activate', {'id': 'image1', 'status': 'active'},
+            priority='ERROR')), priority='error')
+
+        thread = threading.Thread(target=consumer.run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        consumer.should_stop = True
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([tag for tag, _ in fired],
+                         ['glance/task/task1/success',
+                          'glance/image/image1/activate'])
+        self.assertEqual(fired[0][1]['payload'],
+                         {'id': 'task1', 'status': 'success'})
+        self.assertEqual(fired[1][1]['event_type'], 'image.activate')
+        self.assertEqual(fired[1][1]['priority'], 'ERROR')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the glance_policy grain
+======================================
+
+The grain reads a policy file in a temporary directory::
+
+    python -m unittest discover -s tests/unit
+'''
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from helpers import load
+
+
+class PolicyGrainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.policy = os.path.join(self.tmpdir, 'policy.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self):
+        mod = load('_grains', 'glance_policy',
+                   opts={'cachedir': self.tmpdir})
+        mod.POLICY_PATH = self.policy
+        return mod
+
+    def _write(self, rules, keep_mtime=False):
+        stat = os.stat(self.policy) if keep_mtime else None
+        with open(self.policy, 'w') as fh_:
+            json.dump(rules, fh_)
+        if stat is not None:
+            os.utime(self.policy, (stat.st_atime, stat.st_mtime))
+
+    def test_missing(self):
+        self.assertEqual(self._load().main(), {})
+
+    def test_cached_until_changed(self):
+        mod = self._load()
+        self._write({'get_image': ''})
+        self.assertEqual(mod.main(), {'glance_policy': {'get_image': ''}})
+        # Same mtime, size and inode: the file is not read again
+        self._write({'get_imagX': ''}, keep_mtime=True)
+        self.assertEqual(mod.main(), {'glance_policy': {'get_image': ''}})
+        self._write({'get_image': 'role:admin'})
+        self.assertEqual(mod.main(),
+                         {'glance_policy': {'get_image': 'role:admin'}})
+
+    def test_cache_file(self):
+        self._write({'get_image': ''})
+        self._load().main()
+        self._write({'get_imagX': ''}, keep_mtime=True)
+        # A new process starts from the parsed policy in the cachedir
+        self.assertEqual(self._load().main(),
+                         {'glance_policy': {'get_image': ''}})
+        os.utime(self.policy, (0, 0))
+        self.assertEqual(self._load().main(),
+                         {'glance_policy': {'get_imagX': ''}})
+        with open(os.path.join(self.tmpdir, 'glance_policy_grain.json')) \
+                as fh_:
+            self.assertEqual(json.load(fh_)['rules'], {'get_imagX': ''})
+
+
+if __name__ == '__main__':
+    unittest.main()
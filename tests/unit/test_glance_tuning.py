@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the glance_tuning execution module
+=================================================
+
+::
+
+    python -m unittest discover -s tests/unit
+'''
+from __future__ import absolute_import
+import unittest
+
+from helpers import load
+
+
+class AutotuneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load('_modules', 'glance_tuning',
+                        grains={'num_cpus': 16, 'mem_total': 4096})
+
+    def test_workers(self):
+        # (4096 - 1024) // 300 workers fit in memory
+        self.assertEqual(self.mod.autotune()['workers'], 10)
+        self.assertEqual(self.mod.autotune(mem_total=64000)['workers'], 16)
+        self.assertEqual(self.mod.autotune(mem_total=1024)['workers'], 1)
+        self.assertEqual(self.mod.autotune(cpus=2)['workers'], 2)
+        self.mod.__grains__ = {}
+        self.assertEqual(self.mod.autotune()['workers'], 1)
+
+    def test_budget(self):
+        ret = self.mod.autotune(db_connection_budget=2000, nodes=3)
+        self.assertEqual(ret, {'workers': 10,
+                               'max_pool_size': 11,
+                               'max_overflow': 22,
+                               'executor_thread_pool_size': 33,
+                               'rpc_conn_pool_size': 30,
+                               'cpus': 16,
+                               'mem_total': 4096,
+                               'processes': 60,
+                               'db_connections': 1980})
+        self.assertLessEqual(ret['db_connections'], 2000)
+
+    def test_small_budget(self):
+        ret = self.mod.autotune(db_connection_budget=100, nodes=3)
+        self.assertEqual((ret['max_pool_size'], ret['max_overflow']), (1, 1))
+        self.assertEqual(ret['executor_thread_pool_size'], 8)
+        self.assertEqual(ret['rpc_conn_pool_size'], 8)
+
+    def test_no_budget(self):
+        ret = self.mod.autotune()
+        self.assertEqual((ret['max_pool_size'], ret['max_overflow']),
+                         (10, 30))
+        self.assertEqual(ret['executor_thread_pool_size'], 40)
+        self.assertEqual(ret['rpc_conn_pool_size'], 30)
+
+    def test_fixed_values(self):
+        ret = self.mod.autotune(workers=4, max_pool_size=5,
+                                max_overflow='AUTO',
+                                executor_thread_pool_size=12,
+                                db_connection_budget=480)
+        # 480 connections for 2 services of 4 workers
+        self.assertEqual(ret['processes'], 8)
+        self.assertEqual((ret['workers'], ret['max_pool_size'],
+                          ret['max_overflow']), (4, 5, 40))
+        self.assertEqual(ret['executor_thread_pool_size'], 12)
+        self.assertEqual(ret['rpc_conn_pool_size'], 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1144 @@
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the glanceng execution and state modules
+=======================================================
+
+The modules are loaded like salt's loader would, with the Glance API
+calls (_api, _auth) and the salt functions they use replaced by
+in-memory fakes::
+
+    python -m unittest discover -s tests/unit
+
+Requires salt.
+'''
+from __future__ import absolute_import
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from helpers import load
+
+
+class FakeGlance(object):
+    '''
+    Images of one profile, served through _api and _auth. Like Glance, it
+    refuses to delete protected images.
+    '''
+
+    def __init__(self):
+        self.images = {}
+        self.data = {}
+        self.calls = []
+
+    def api(self, profile, operation, *args, **kwargs):
+        self.calls.append((profile, operation))
+        if operation == 'images.create':
+            image = dict(kwargs, id='image-{0}'.format(len(self.calls)),
+                         status='queued', checksum=None)
+            self.images[image['id']] = image
+            return dict(image)
+        if operation == 'images.list':
+            filters = kwargs.get('filters') or {}
+            return iter([dict(image) for image in self.images.values()
+                         if all(image.get(key) == value
+                                for key, value in filters.items())])
+        if operation == 'images.get':
+            return dict(self.images[args[0]])
+        if operation == 'images.data':
+            data = self.data[args[0]]
+            return iter([data[i:i + 65536]
+                         for i in range(0, len(data), 65536)])
+        if operation == 'images.update':
+            self.images[args[0]].update(kwargs)
+            return dict(self.images[args[0]])
+        if operation == 'images.delete':
+            if self.images[args[0]].get('protected'):
+                raise Exception('403 Forbidden: image is protected')
+            del self.images[args[0]]
+            return None
+        raise NotImplementedError(operation)
+
+    def auth(self, profile=None, api_version=2):
+        fake = self
+
+        class Images(object):
+            @staticmethod
+            def upload(image_id, reader, image_size=None):
+                data = b''.join(iter(reader))
+                fake.data[image_id] = data
+                fake.images[image_id].update(
+                    status='active', size=len(data),
+                    checksum=hashlib.md5(data).hexdigest())
+
+        class Client(object):
+            images = Images
+        return Client
+
+
+class ImageUploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'image.raw')
+        self.data = b'glance' * 100000
+        with open(self.source, 'wb') as fh_:
+            fh_.write(self.data)
+        self.glance = FakeGlance()
+        self.mod = load('_modules', 'glanceng',
+                        opts={'cachedir': self.tmpdir})
+        self.mod._api = self.glance.api
+        self.mod._auth = self.glance.auth
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_protected_upload(self):
+        ret = self.mod.image_upload(
+            'cirros', self.source, protected=True,
+            hashes={'sha256': hashlib.sha256(self.data).hexdigest()})
+        self.assertNotIn('result', ret)
+        image = self.glance.images[ret['id']]
+        self.assertTrue(image['protected'])
+        self.assertEqual(image['glanceng_sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+
+    def test_protected_upload_mismatch(self):
+        ret = self.mod.image_upload('cirros', self.source, protected=True,
+                                    hashes={'sha256': '0' * 64})
+        self.assertIs(ret['result'], False)
+        self.assertIn('sha256', ret['comment'])
+        # The partial image was never protected and is gone
+        self.assertEqual(self.glance.images, {})
+
+    def test_http_source(self):
+        server = ImageServer(self.data)
+        self.addCleanup(server.close)
+        sha512 = hashlib.sha512(self.data).hexdigest()
+        ret = self.mod.image_upload('cirros', server.url, chunk_size=4096,
+                                    checksum=hashlib.md5(
+                                        self.data).hexdigest(),
+                                    hashes={'sha512': sha512})
+        self.assertNotIn('result', ret)
+        self.assertEqual(self.glance.data[ret['id']], self.data)
+        self.assertEqual(self.glance.images[ret['id']]['glanceng_sha512'],
+                         sha512)
+        # Streamed straight into Glance, nothing is staged on disk
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['glanceng', 'image.raw'])
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'glanceng')),
+                         ['stats.json'])
+        ret = self.mod.image_upload('ubuntu', server.url,
+                                    hashes={'sha512': '0' * 128})
+        self.assertIs(ret['result'], False)
+        self.assertEqual([image['name']
+                          for image in self.glance.images.values()],
+                         ['cirros'])
+
+
+class OwnerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.glance = FakeGlance()
+        for name, owner in (('cirros', 'tenant-a'), ('ubuntu', 'tenant-b')):
+            image = self.glance.api(None, 'images.create', name=name)
+            self.glance.images[image['id']]['owner'] = owner
+        self.ttl = 60
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _mine_run(self):
+        # Every Mine run loads the module in a new process
+        mod = load('_modules', 'glanceng', opts={'cachedir': self.tmpdir},
+                   salt={'config.get': lambda key, default=None:
+                         self.ttl if key.endswith('owner_cache_ttl')
+                         else default})
+        mod._api = self.glance.api
+        return mod
+
+    def _listings(self):
+        return len([call for call in self.glance.calls
+                    if call[1] == 'images.list'])
+
+    def test_second_run_within_ttl(self):
+        self.assertEqual(self._mine_run().get_image_owner_ids(
+            ['cirros', 'ubuntu', 'missing']),
+            {'cirros': 'tenant-a', 'ubuntu': 'tenant-b', 'missing': []})
+        self.assertEqual(self._listings(), 1)
+        self.assertEqual(self._mine_run().get_image_owner_ids(
+            ['cirros', 'missing']), {'cirros': 'tenant-a', 'missing': []})
+        self.assertEqual(self._mine_run().get_image_owner_id('ubuntu'),
+                         'tenant-b')
+        self.assertEqual(self._listings(), 1)
+
+    def test_expired(self):
+        self._mine_run().get_image_owner_ids(['cirros'])
+        self.ttl = 0
+        self._mine_run().get_image_owner_ids(['cirros'])
+        self.assertEqual(self._listings(), 2)
+
+    def test_hits_keep_their_age(self):
+        self._mine_run().get_image_owner_ids(['cirros'])
+        resolved = self._mine_run()._read_cache_file('owners.json')
+        time.sleep(0.01)
+        self._mine_run().get_image_owner_ids(['cirros', 'ubuntu'])
+        stored = self._mine_run()._read_cache_file('owners.json')['']
+        self.assertEqual(stored['cirros'], resolved['']['cirros'])
+        self.assertGreater(stored['ubuntu'][1], stored['cirros'][1])
+
+
+class TimingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = {}
+        self.states = load('_states', 'glanceng', salt={
+            'glanceng.stats': lambda profile=None: dict(
+                (name, dict((op, dict(entry)) for op, entry in ops.items()))
+                for name, ops in self.stats.items()
+                if profile is None or name == profile)})
+
+    def _call(self, profile, operation, seconds):
+        entry = self.stats.setdefault(profile, {}).setdefault(
+            operation, {'count': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+
+    def test_two_profiles(self):
+        self._call('region_one', 'images.data', 1.0)
+        started = self.states._timing_start()
+        self._call('region_one', 'images.data', 2.0)
+        self._call('region_two', 'images.create', 0.5)
+        self._call('region_two', 'images.upload', 3.0)
+        self._call('region_three', 'images.create', 0.25)
+        self._call('region_three', 'images.upload', 1.0)
+        ret = self.states._timing({}, None, started)
+        self.assertEqual(ret['timing']['calls'], {
+            'images.data': {'count': 1, 'seconds': 2.0},
+            'images.create': {'count': 2, 'seconds': 0.75},
+            'images.upload': {'count': 2, 'seconds': 4.0}})
+        self.assertEqual(ret['timing']['api'], 6.75)
+
+class PruneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.images = [
+            self._image('a3', 'ubuntu-16.04-20170901', '2017-09-01', '16.04'),
+            self._image('a2', 'ubuntu-16.04-20170801', '2017-08-01', '16.04'),
+            self._image('a1', 'ubuntu-16.04-20170701', '2017-07-01', '16.04'),
+            self._image('b2', 'ubuntu-18.04-20170901', '2017-09-02', '18.04'),
+            self._image('b1', 'ubuntu-18.04-20170801', '2017-08-02', '18.04'),
+            self._image('c2', 'cirros', '2017-09-03'),
+            self._image('c1', 'cirros', '2017-08-03'),
+            self._image('k1', 'ubuntu-16.04-20170902', '2017-09-02', '16.04',
+                        status='killed'),
+            self._image('q1', 'ubuntu-16.04-20170903', '2017-09-03', '16.04',
+                        status='queued')]
+        self.states = load('_states', 'glanceng', opts={'test': True},
+                           salt={'glanceng.image_list':
+                                 lambda profile=None: self.images,
+                                 'glanceng.stats': lambda profile=None: {}})
+
+    def _image(self, image_id, name, created, os_version=None,
+               status='active'):
+        image = {'id': image_id, 'name': name, 'status': status,
+                 'created_at': created + 'T00:00:00Z', 'tags': ['ubuntu'],
+                 'owner': 'admin'}
+        if os_version:
+            image['os_version'] = os_version
+        return image
+
+    def _ids(self, images):
+        return [image['id'] for image in images]
+
+    def test_keep_per_name(self):
+        selected, kept = self.states._prune_selection(self.images,
+                                                      pattern='cirros',
+                                                      keep=1)
+        self.assertEqual(self._ids(kept), ['c2'])
+        self.assertEqual(self._ids(selected), ['c1'])
+
+    def test_keep_per_group_by(self):
+        selected, kept = self.states._prune_selection(
+            self.images, pattern='ubuntu-*', keep=2, group_by='os_version')
+        self.assertEqual(self._ids(kept), ['b2', 'a3', 'b1', 'a2'])
+        # Failed uploads take no keep slot, queued images are left alone
+        self.assertEqual(self._ids(selected), ['k1', 'a1'])
+
+    def test_group_by_falls_back_to_name(self):
+        selected, kept = self.states._prune_selection(
+            self.images, tags=['ubuntu'], keep=1, group_by='os_version')
+        self.assertEqual(self._ids(kept), ['c2', 'b2', 'a3'])
+        self.assertEqual(self._ids(selected), ['k1', 'c1', 'b1', 'a2', 'a1'])
+
+    def test_older_than(self):
+        selected, kept = self.states._prune_selection(
+            self.images, pattern='ubuntu-16.04-*', keep=1,
+            group_by='os_version', older_than=0)
+        self.assertEqual(self._ids(kept), ['a3'])
+        self.assertEqual(self._ids(selected), ['k1', 'a2', 'a1'])
+        selected, kept = self.states._prune_selection(
+            self.images, pattern='ubuntu-16.04-*', older_than=36500)
+        self.assertEqual(selected, [])
+
+    def test_older_than_needs_selector(self):
+        ret = self.states.images_pruned('everything', older_than=30,
+                                        in_use=False)
+        self.assertFalse(ret['result'])
+        ret = self.states.images_pruned('ubuntu', owner='admin',
+                                        older_than=0, keep=1,
+                                        group_by='os_version',
+                                        in_use=False)
+        self.assertIsNone(ret['result'])
+        self.assertIn('would delete 5 image(s)', ret['comment'])
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.glance = FakeGlance()
+        for image_id, name, extra in (
+                ('1', 'cirros', {'visibility': 'public', 'protected': False,
+                                 'tags': ['cirros'], 'checksum': 'a' * 32,
+                                 'glanceng_sha256': 'b' * 64}),
+                ('2', 'ubuntu', {'visibility': 'private', 'protected': True,
+                                 'tags': ['ubuntu', 'lts']}),
+                ('3', 'fedora', {}),
+                ('4', 'fedora', {})):
+            self.glance.images[image_id] = dict(extra, id=image_id,
+                                                name=name, status='active')
+        self.pillar = {'admin': {'image': {
+            'cirros': {'visibility': 'public', 'checksum': 'a' * 32},
+            'ubuntu': {'tags': ['ubuntu']},
+            'fedora': {},
+            'debian': {'location': 'http://images/debian.img'}}}}
+        self.opts = {'cachedir': self.tmpdir, 'test': False}
+        context = {}
+        self.mod = load('_modules', 'glanceng', opts=self.opts,
+                        context=context, salt={
+                            'pillar.get': lambda key, default=None:
+                            self.pillar})
+        self.mod._api = self.glance.api
+        salt = dict(('glanceng.' + func, getattr(self.mod, func))
+                    for func in ('image_plan', 'image_update',
+                                 'image_verified_hashes', 'import_journal_get',
+                                 'import_journal_list',
+                                 'import_journal_remove'))
+        salt['glanceng.stats'] = lambda profile=None: {}
+        self.states = load('_states', 'glanceng', opts=self.opts, salt=salt,
+                           context=context)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _listings(self):
+        return self.glance.calls.count(('admin', 'images.list'))
+
+    def test_plan_image(self):
+        image = self.glance.images['1']
+        self.assertEqual(self.mod._plan_image({}, image), ({}, {}))
+        changes, mismatch = self.mod._plan_image(
+            {'visibility': 'private', 'protected': False,
+             'tags': ['cirros', 'tiny'], 'checksum': 'c' * 32,
+             'hashes': {'sha256': 'b' * 64, 'sha512': 'd' * 128}}, image)
+        self.assertEqual(changes, {
+            'visibility': {'old': 'public', 'new': 'private'},
+            'tags': {'old': ['cirros'], 'new': ['cirros', 'tiny']}})
+        # Digests that were never recorded can't mismatch
+        self.assertEqual(mismatch, {'md5': {'old': 'a' * 32,
+                                            'new': 'c' * 32}})
+
+    def test_image_plan(self):
+        plan = self.mod.image_plan('admin')['admin']
+        self.assertEqual(plan['create'], {
+            'debian': {'location': 'http://images/debian.img'}})
+        self.assertEqual(plan['update'], {})
+        self.assertEqual(plan['mismatch'], {})
+        self.assertEqual(plan['duplicate'], {'fedora': ['3', '4']})
+        self.assertEqual(sorted(plan['unchanged']), ['cirros', 'ubuntu'])
+        self.pillar['admin']['image']['cirros']['hashes'] = {
+            'sha256': 'e' * 64}
+        self.pillar['admin']['image']['ubuntu']['protected'] = False
+        plan = self.mod.image_plan('admin')['admin']
+        self.assertEqual(plan['update'], {'ubuntu': {
+            'id': '2', 'changes': {'protected': {'old': True,
+                                                 'new': False}}}})
+        self.assertEqual(plan['mismatch'], {'cirros': {
+            'id': '1', 'hashes': {'sha256': {'old': 'b' * 64,
+                                             'new': 'e' * 64}}}})
+        self.assertEqual(self._listings(), 2)
+
+    def test_import_uses_state_arguments(self):
+        # The pillar wants cirros public, the state asks for private
+        ret = self.states.image_import('cirros', profile='admin',
+                                       visibility='private', tags=['tiny'])
+        self.assertTrue(ret['result'])
+        self.assertEqual(ret['changes']['cirros']['visibility'],
+                         {'old': 'public', 'new': 'private'})
+        self.assertEqual(self.glance.images['1']['visibility'], 'private')
+        self.assertEqual(self.glance.images['1']['tags'], ['cirros', 'tiny'])
+        # Arguments that are not given are left alone
+        ret = self.states.image_import('ubuntu', profile='admin')
+        self.assertEqual(ret['changes'], {})
+        self.assertTrue(self.glance.images['2']['protected'])
+
+    def test_import_checks_hashes(self):
+        ret = self.states.image_import('cirros', profile='admin',
+                                       hashes={'sha256': 'e' * 64})
+        self.assertIs(ret['result'], False)
+        self.assertIn('"sha256" is {0}, should be {1}'.format(
+            'b' * 64, 'e' * 64), ret['comment'])
+        ret = self.states.images_imported('images', profile='admin', images={
+            'cirros': {'checksum': 'c' * 32}})
+        self.assertIs(ret['result'], False)
+        self.assertIn('"md5" is {0}, should be {1}'.format(
+            'a' * 32, 'c' * 32), ret['comment'])
+
+    def test_test_mode_lists_once(self):
+        self.opts['test'] = True
+        for name, kwargs in (('cirros', {'visibility': 'private'}),
+                             ('ubuntu', {}),
+                             ('debian', {'location': 'http://images/x.img'}),
+                             ('fedora', {})):
+            self.states.image_import(name, profile='admin', **kwargs)
+        ret = self.states.images_imported('images', profile='admin',
+                                          images=self.pillar['admin']['image'])
+        self.assertIsNone(ret['result'])
+        # One listing for the image_import states, one for images_imported
+        self.assertEqual(self._listings(), 2)
+        self.assertNotIn(('admin', 'images.update'), self.glance.calls)
+        self.assertEqual(self.glance.images['1']['visibility'], 'public')
+
+
+class ImportJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.glance = FakeGlance()
+        self.tasks = {}
+        self.finish = False
+        self.opts = {'cachedir': self.tmpdir, 'test': False}
+        self.mod = load('_modules', 'glanceng', opts=self.opts)
+        self.mod._api = self.glance.api
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _task_create(self, task_type, profile=None, input_params=None):
+        task = {'id': 'task-{0}'.format(len(self.tasks) + 1),
+                'status': 'pending', 'input': input_params}
+        self.tasks[task['id']] = task
+        return dict(task)
+
+    def _task_show(self, task_id, profile=None):
+        task = self.tasks[task_id]
+        if self.finish and task['status'] == 'pending':
+            properties = task['input']['image_properties']
+            image = dict(properties, id='image-' + task_id, status='active',
+                         checksum='a' * 32)
+            self.glance.images[image['id']] = image
+            task.update(status='success', result={'image_id': image['id']})
+        return dict(task)
+
+    def _run(self, location='http://images/cirros.img'):
+        # Every run has a __context__ of its own
+        context = {}
+        self.mod.__context__ = context
+        salt = dict(('glanceng.' + func, getattr(self.mod, func))
+                    for func in ('image_plan', 'import_journal_get',
+                                 'import_journal_list', 'import_journal_add',
+                                 'import_journal_remove'))
+        salt.update({
+            'glanceng.stats': lambda profile=None: {},
+            'glanceng.task_create': self._task_create,
+            'glanceng.task_show': self._task_show,
+            'glance.image_show': lambda id, profile=None: dict(
+                self.glance.images[id])})
+        states = load('_states', 'glanceng', opts=self.opts, salt=salt,
+                      context=context)
+        states._POLL_INITIAL_DELAY = 0.01
+        return states.images_imported('images', profile='admin', images={
+            'cirros': {'location': location, 'wait_timeout': 0.5}})
+
+    def test_resume(self):
+        ret = self._run()
+        self.assertIs(ret['result'], False)
+        self.assertEqual(self.mod.import_journal_get('cirros', 'admin')[
+            'task_id'], 'task-1')
+        self.finish = True
+        ret = self._run()
+        self.assertTrue(ret['result'])
+        self.assertEqual(sorted(self.tasks), ['task-1'])
+        self.assertTrue(ret['changes']['cirros']['new']['resumed'])
+        self.assertEqual(ret['changes']['cirros']['new']['image_id'],
+                         'image-task-1')
+        self.assertEqual(self.mod.import_journal_list('admin'), {})
+
+    def test_changed_location(self):
+        self._run()
+        self.finish = True
+        ret = self._run('http://images/cirros-0.4.img')
+        self.assertTrue(ret['result'])
+        self.assertNotIn('resumed', ret['changes']['cirros']['new'])
+        self.assertEqual(ret['changes']['cirros']['new']['image_id'],
+                         'image-task-2')
+        self.assertEqual(self.mod.import_journal_list('admin'), {})
+
+
+class TaskIterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.consumed = 0
+        # Newest first, as Glance sorts tasks by default
+        self.tasks = [{'id': 'task-{0}'.format(i), 'type': 'import',
+                       'status': 'success', 'input': {'large': 'x' * 10},
+                       'updated_at': '2017-06-{0:02d}T00:00:00Z'.format(
+                           30 - i)}
+                      for i in range(20)]
+        self.mod = load('_modules', 'glanceng')
+        self.mod._api = self._api
+        self.mod._schema_keys = lambda name, profile=None: frozenset(
+            ('id', 'type', 'status', 'updated_at'))
+
+    def _api(self, profile, operation, **kwargs):
+        self.calls.append((operation, kwargs))
+
+        def tasks():
+            for task in self.tasks:
+                self.consumed += 1
+                yield dict(task)
+        return tasks()
+
+    def test_filters(self):
+        tasks = list(self.mod.task_iter(status='success', task_type='import',
+                                        marker='task-2', sort_key='id',
+                                        sort_dir='asc', page_size=50))
+        self.assertEqual(self.calls, [('tasks.list', {
+            'filters': {'status': 'success', 'type': 'import',
+                        'marker': 'task-2', 'sort_key': 'id',
+                        'sort_dir': 'asc'},
+            'page_size': 50})])
+        self.assertEqual(len(tasks), 20)
+        # Properties outside the task schema are dropped
+        self.assertEqual(sorted(tasks[0]),
+                         ['id', 'status', 'type', 'updated_at'])
+
+    def test_limit(self):
+        tasks = list(self.mod.task_iter(limit=3, page_size=100))
+        self.assertEqual([task['id'] for task in tasks],
+                         ['task-0', 'task-1', 'task-2'])
+        self.assertEqual(self.calls[0][1]['page_size'], 3)
+        self.assertEqual(self.consumed, 3)
+
+    def test_since(self):
+        tasks = self.mod.task_list(since='2017-06-25T00:00:00Z')
+        self.assertEqual(len(tasks), 6)
+        self.assertEqual(self.consumed, 20)
+        self.consumed = 0
+        tasks = self.mod.task_list(since='2017-06-25T00:00:00Z',
+                                   sort_key='updated_at')
+        self.assertEqual(len(tasks), 6)
+        # Newest first, the first older task ends the listing
+        self.assertEqual(self.consumed, 7)
+
+
+class ImageServer(object):
+    '''
+    HTTP server of one image in a thread. It answers range requests unless
+    ranges is False, and stops writing a response after cut bytes.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = True
+        self.cut = None
+        self.served = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(server.data)))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+
+            def do_GET(self):
+                data = server.data
+                header = self.headers.get('Range')
+                if header and server.ranges:
+                    start, end = header.split('=')[1].split('-')
+                    data = data[int(start):int(end) + 1]
+                    self.send_response(206)
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if server.cut is not None:
+                    data = data[:server.cut]
+                self.wfile.write(data)
+                server.served += len(data)
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/image.img'.format(
+            self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ImageFetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'image.img')
+        self.data = os.urandom(300000)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.server = ImageServer(self.data)
+        self.mod = load('_modules', 'glanceng')
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _fetch(self, **kwargs):
+        return self.mod.image_fetch(self.server.url, self.dest,
+                                    checksum=self.md5, connections=4,
+                                    segment_size=50000, chunk_size=4096,
+                                    timeout=10, **kwargs)
+
+    def _fetched(self):
+        with open(self.dest, 'rb') as fh_:
+            return fh_.read()
+
+    def test_ranged(self):
+        ret = self._fetch()
+        self.assertNotIn('result', ret)
+        self.assertTrue(ret['ranged'])
+        self.assertEqual((ret['size'], ret['checksum']),
+                         (len(self.data), self.md5))
+        self.assertEqual(self._fetched(), self.data)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['image.img'])
+
+    def test_resume(self):
+        self.server.cut = 4 * 4096
+        ret = self._fetch()
+        self.assertIs(ret['result'], False)
+        with open(self.dest + '.resume') as fh_:
+            segments = json.load(fh_)['segments']
+        self.assertEqual([offset - start for start, end, offset in segments],
+                         [4 * 4096] * 6)
+        self.server.cut = None
+        self.server.served = 0
+        ret = self._fetch()
+        self.assertNotIn('result', ret)
+        self.assertEqual(ret['resumed_bytes'], 6 * 4 * 4096)
+        self.assertEqual(self.server.served, len(self.data) - 6 * 4 * 4096)
+        self.assertEqual(ret['checksum'], self.md5)
+        self.assertEqual(self._fetched(), self.data)
+        self.assertFalse(os.path.exists(self.dest + '.resume'))
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        ret = self._fetch()
+        self.assertNotIn('result', ret)
+        self.assertFalse(ret['ranged'])
+        self.assertEqual(ret['checksum'], self.md5)
+        self.assertEqual(self._fetched(), self.data)
+
+    def test_checksum_mismatch(self):
+        ret = self.mod.image_fetch(self.server.url, self.dest,
+                                   checksum='0' * 32)
+        self.assertIs(ret['result'], False)
+        self.assertIn(self.md5, ret['comment'])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_hashes(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        ret = self._fetch(hashes={'sha256': sha256})
+        self.assertEqual(ret['hashes'], {'md5': self.md5, 'sha256': sha256})
+        ret = self._fetch(hashes={'SHA512': '0' * 128})
+        self.assertIs(ret['result'], False)
+        self.assertIn('sha512 checksum', ret['comment'])
+        self.assertEqual(os.listdir(self.tmpdir), ['image.img'])
+
+
+class ConvertTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.urandom(100000)
+        self.source = os.path.join(self.tmpdir, 'image.qcow2')
+        with open(self.source, 'wb') as fh_:
+            fh_.write(self.data)
+        self.converted = []
+        self.mod = load('_modules', 'glanceng',
+                        opts={'cachedir': self.tmpdir},
+                        salt={'cmd.which': lambda cmd: '/usr/bin/' + cmd,
+                              'cmd.run_all': self._qemu_img})
+        self.opened = []
+        open_source = self.mod._open_source
+
+        def _open_source(source, *args, **kwargs):
+            self.opened.append(source)
+            return open_source(source, *args, **kwargs)
+        self.mod._open_source = _open_source
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _qemu_img(self, cmd, python_shell=False):
+        # "Converts" by copying, which is all the tests need
+        self.converted.append(cmd)
+        shutil.copy(cmd[-2], cmd[-1])
+        return {'retcode': 0}
+
+    def _expected(self, *algos):
+        return dict((algo, hashlib.new(algo, self.data).hexdigest())
+                    for algo in algos)
+
+    def test_sparse_chunks(self):
+        path = os.path.join(self.tmpdir, 'sparse.raw')
+        with open(path, 'wb') as fh_:
+            fh_.truncate(10 * 65536)
+            fh_.seek(3 * 65536 + 100)
+            fh_.write(self.data)
+        with open(path, 'rb') as fh_:
+            expected = fh_.read()
+            chunks = list(self.mod._sparse_chunks(fh_, len(expected), 4096))
+        self.assertEqual(b''.join(chunks), expected)
+        self.assertTrue(all(0 < len(chunk) <= 4096 for chunk in chunks))
+
+    def test_local(self):
+        expected = self._expected('sha256')
+        raw, digests, cleanup = self.mod._convert_source(
+            'file://' + self.source, 'qcow2', expected)
+        self.assertEqual(digests, self._expected('md5', 'sha256'))
+        self.assertEqual(self.converted[0][:7],
+                         ['/usr/bin/qemu-img', 'convert', '-f', 'qcow2', '-O',
+                          'raw', '-S'])
+        with open(raw, 'rb') as fh_:
+            self.assertEqual(fh_.read(), self.data)
+        cleanup()
+        self.assertFalse(os.path.exists(raw))
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_local_mismatch(self):
+        self.assertRaises(self.mod._HashMismatch, self.mod._convert_source,
+                          self.source, 'qcow2', {'sha256': '0' * 64})
+        self.assertEqual(self.converted, [])
+        self.assertEqual(os.listdir(self.mod._cache_file('convert')), [])
+
+    def test_http(self):
+        server = ImageServer(self.data)
+        self.addCleanup(server.close)
+        raw, digests, cleanup = self.mod._convert_source(
+            server.url, 'qcow2', self._expected('sha512'))
+        self.assertEqual(digests, self._expected('md5', 'sha512'))
+        # The download is hashed on the way, and not read again
+        self.assertEqual(self.opened, [])
+        self.assertEqual(server.served, len(self.data))
+        with open(raw, 'rb') as fh_:
+            self.assertEqual(fh_.read(), self.data)
+        cleanup()
+        self.assertEqual(os.listdir(self.mod._cache_file('convert')), [])
+
+    def test_http_mismatch(self):
+        server = ImageServer(self.data)
+        self.addCleanup(server.close)
+        self.assertRaises(self.mod._ConvertError, self.mod._convert_source,
+                          server.url, 'qcow2', {'md5': '0' * 32})
+        self.assertEqual(self.converted, [])
+
+
+class SchemaCacheTestCase(unittest.TestCase):
+
+    class Property(object):
+        def __init__(self, name):
+            self.name = name
+            self.description = name.title()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.version = 'v2.5'
+        self.properties = ['id', 'name', 'status']
+        self.calls = []
+        self.mod = self._load()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self):
+        mod = load('_modules', 'glanceng', opts={'cachedir': self.tmpdir},
+                   salt={'config.get': lambda key, default=None: default})
+        mod._api = self._api
+        mod._auth_info = lambda profile=None: ('http://glance:9292', {})
+        return mod
+
+    def _api(self, profile, operation, *args):
+        self.calls.append(operation)
+        if operation == 'http_client.get':
+            return None, {'versions': [{'id': self.version,
+                                        'status': 'CURRENT'},
+                                       {'id': 'v1.1', 'status': 'SUPPORTED'}]}
+        schema = type('Schema', (object,), {})()
+        schema.properties = [self.Property(name)
+                             for name in self.properties]
+        return schema
+
+    def _fetches(self):
+        return self.calls.count('schemas.get')
+
+    def test_memory(self):
+        self.assertEqual(self.mod._schema_keys('task'),
+                         frozenset(self.properties))
+        self.mod._schema_keys('task')
+        self.assertEqual(self._fetches(), 1)
+        self.assertEqual(self.calls.count('http_client.get'), 1)
+
+    def test_disk(self):
+        self.mod._schema_keys('task')
+        self.assertEqual(self._load()._schema_keys('task'),
+                         frozenset(self.properties))
+        self.assertEqual(self._fetches(), 1)
+
+    def test_upgrade(self):
+        self.mod._schema_keys('task')
+        self.version = 'v2.6'
+        self.properties.append('message')
+        # The version is looked up again once its memo expired
+        self.mod._API_VERSIONS['http://glance:9292'][1] -= \
+            self.mod._API_VERSION_TTL
+        self.assertIn('message', self.mod._schema_keys('task'))
+        self.assertEqual(self._fetches(), 2)
+        self.version = 'v2.7'
+        self.properties.append('owner')
+        self.assertIn('owner', self._load()._schema_keys('task'))
+        self.assertEqual(self._fetches(), 3)
+
+
+class ReplicationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clouds = dict((profile, FakeGlance())
+                           for profile in ('one', 'two', 'three'))
+        self.cirros = self._add('one', 'cirros', b'cirros' * 20000)
+        self.ubuntu = self._add('one', 'ubuntu', b'ubuntu' * 30000,
+                                tags=['lts'])
+        self._add('one', 'fedora', b'fedora', status='queued')
+        self.opts = {'test': False}
+        self.mod = load('_modules', 'glanceng')
+        self.mod._api = self._api
+        self.mod._auth = lambda profile=None, api_version=2: \
+            self.clouds[profile].auth()
+        self.states = load('_states', 'glanceng', opts=self.opts, salt={
+            'glanceng.image_list': self.mod.image_list,
+            'glanceng.image_replicate': self.mod.image_replicate,
+            'glance.image_delete': lambda id, profile=None: self._api(
+                profile, 'images.delete', id),
+            'glanceng.stats': lambda profile=None: {}})
+
+    def _api(self, profile, operation, *args, **kwargs):
+        return self.clouds[profile].api(profile, operation, *args, **kwargs)
+
+    def _add(self, profile, name, data, **extra):
+        glance = self.clouds[profile]
+        image = dict({'id': '{0}-{1}'.format(profile, len(glance.images)),
+                      'name': name, 'status': 'active', 'size': len(data),
+                      'checksum': hashlib.md5(data).hexdigest(),
+                      'visibility': 'public', 'tags': []}, **extra)
+        glance.images[image['id']] = image
+        glance.data[image['id']] = data
+        return image
+
+    def _names(self, profile):
+        return sorted((image['name'], image['checksum'])
+                      for image in self.clouds[profile].images.values()
+                      if image['status'] == 'active')
+
+    def test_replicate(self):
+        # A copy under another name is found by its checksum
+        self._add('three', 'cirros-0.3.5', self.clouds['one'].data[
+            self.cirros['id']])
+        ret = self.states.images_replicated('base', 'one', ['two', 'three'])
+        self.assertTrue(ret['result'])
+        self.assertEqual(sorted(ret['changes']['two']), ['cirros', 'ubuntu'])
+        self.assertEqual(sorted(ret['changes']['three']), ['ubuntu'])
+        self.assertEqual(self._names('two'), self._names('one'))
+        replica = [image for image in self.clouds['two'].images.values()
+                   if image['name'] == 'ubuntu'][0]
+        self.assertEqual(replica['tags'], ['lts'])
+        self.assertEqual(replica['glanceng_replicated_from'],
+                         'one:' + self.ubuntu['id'])
+        ret = self.states.images_replicated('base', 'one', ['two', 'three'])
+        self.assertEqual(ret['changes'], {})
+        self.assertTrue(ret['comment'].startswith(
+            '4 image(s) in sync, 0 to copy'))
+
+    def test_replace(self):
+        old = self._add('two', 'cirros', b'cirros-0.3.4')
+        kept = self._add('two', 'cirros', b'cirros-0.3.3', protected=True)
+        partial = self._add('two', 'cirros', b'', status='queued',
+                            glanceng_replicated_from='one:' +
+                            self.cirros['id'])
+        ret = self.states.images_replicated('base', 'one', ['two'],
+                                            images=['cirros', 'debian'],
+                                            replace=True)
+        self.assertIs(ret['result'], False)
+        self.assertIn('Not found in one: debian', ret['comment'])
+        self.assertEqual(ret['changes']['two']['cirros']['old'], [old['id']])
+        images = self.clouds['two'].images
+        self.assertNotIn(old['id'], images)
+        self.assertNotIn(partial['id'], images)
+        self.assertIn(kept['id'], images)
+
+    def test_test_mode(self):
+        self.opts['test'] = True
+        ret = self.states.images_replicated('base', 'one', {'two': {}},
+                                            tags=['lts'])
+        self.assertIsNone(ret['result'])
+        self.assertIn('two: would copy ubuntu', ret['comment'])
+        self.assertEqual(self.clouds['two'].images, {})
+
+
+class CachePrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.images = [
+            {'id': 'i1', 'name': 'cirros', 'status': 'active', 'tags': []},
+            {'id': 'i2', 'name': 'ubuntu', 'status': 'active',
+             'tags': ['hot']},
+            {'id': 'i3', 'name': 'fedora', 'status': 'active',
+             'tags': ['hot']},
+            {'id': 'i4', 'name': 'centos', 'status': 'active',
+             'tags': ['hot']},
+            {'id': 'i5', 'name': 'debian', 'status': 'active', 'tags': []}]
+        self.cached = set(['i1'])
+        self.queued = set(['i2'])
+        self.broken = set(['i4'])
+        self.reading = 0
+        self.most = 0
+        self.lock = threading.Lock()
+        self.mod = load('_modules', 'glanceng', opts={'id': 'ctl01'})
+        self.mod._api = lambda profile, operation, **kwargs: iter(
+            self.images)
+        self.mod._node_api = self._node_api
+
+    def _node_api(self, profile, endpoint, operation, *args):
+        if operation == 'http_client.get':
+            if args[0] == '/v1/cached_images':
+                return None, {'cached_images': [{'image_id': image_id}
+                                                 for image_id in self.cached]}
+            return None, {'queued_images': sorted(self.queued)}
+        if operation == 'http_client.put':
+            self.queued.add(args[0].rsplit('/', 1)[1])
+            return None, {}
+        if operation == 'images.data':
+            return self._read(args[0])
+        raise NotImplementedError(operation)
+
+    def _read(self, image_id):
+        with self.lock:
+            self.reading += 1
+            self.most = max(self.most, self.reading)
+        try:
+            time.sleep(0.05)
+            if image_id in self.broken:
+                raise Exception('500 Internal Server Error')
+            yield b'data'
+            self.queued.discard(image_id)
+            self.cached.add(image_id)
+        finally:
+            with self.lock:
+                self.reading -= 1
+
+    def test_prefetch(self):
+        ret = self.mod.image_cache_prefetch(images=['cirros', 'alpine'],
+                                            tags=['hot'], concurrency=2)
+        self.assertEqual(ret['node'], 'ctl01')
+        self.assertEqual(ret['cached'], ['cirros'])
+        self.assertEqual(ret['prefetched'], ['fedora', 'ubuntu'])
+        self.assertEqual(ret['queued'], [])
+        self.assertEqual(list(ret['failed']), ['centos'])
+        self.assertEqual(ret['missing'], ['alpine'])
+        self.assertEqual(self.most, 2)
+        self.assertNotIn('i5', self.cached | self.queued)
+
+    def test_queue_only(self):
+        ret = self.mod.image_cache_prefetch(tags=['hot'], prefetch=False)
+        self.assertEqual(ret['queued'], ['centos', 'fedora', 'ubuntu'])
+        self.assertEqual(ret['prefetched'], [])
+        self.assertEqual(self.most, 0)
+
+    def test_report_only(self):
+        ret = self.mod.image_cache_prefetch(tags=['hot'], queue=False)
+        self.assertEqual(ret['uncached'], ['centos', 'fedora'])
+        self.assertEqual(ret['prefetched'], ['ubuntu'])
+        self.assertEqual(self.queued, set())
+
+
+class CacheStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import sqlite3
+        self.tmpdir = tempfile.mkdtemp()
+        now = time.time()
+        conn = sqlite3.connect(os.path.join(self.tmpdir, 'cache.db'))
+        conn.execute('CREATE TABLE cached_images (image_id TEXT, '
+                     'last_accessed REAL, last_modified REAL, size INTEGER, '
+                     'hits INTEGER, checksum TEXT)')
+        for image_id, size, hits, idle in (('a', 100, 50, 10),
+                                           ('b', 200, 30, 100),
+                                           ('c', 300, 20, 200000),
+                                           ('d', 400, 0, 300000)):
+            conn.execute('INSERT INTO cached_images VALUES (?, ?, ?, ?, ?, '
+                         'NULL)', (image_id, now - idle, now - 400000, size,
+                                   hits))
+        conn.commit()
+        conn.close()
+        self.mod = load('_modules', 'glanceng', opts={'id': 'ctl01'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stats(self):
+        ret = self.mod.image_cache_stats(self.tmpdir, points=2)
+        self.assertEqual([image['id'] for image in ret.pop('images')],
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(ret, {
+            'node': 'ctl01',
+            'directory': self.tmpdir,
+            'count': 4,
+            'size': 1000,
+            'hits': 100,
+            'working_set': 300,
+            'lru_curve': [{'size': 300, 'hit_rate': 0.8},
+                          {'size': 1000, 'hit_rate': 1.0}],
+            'projected_hit_rate': {'250': 0.5, '500': 0.8, '750': 1.0,
+                                   '1000': 1.0}})
+
+    def test_sizes(self):
+        ret = self.mod.image_cache_stats(self.tmpdir, sizes=[50, 100],
+                                         window=50, images=False)
+        self.assertNotIn('images', ret)
+        self.assertEqual(ret['working_set'], 100)
+        self.assertEqual(ret['projected_hit_rate'], {'50': 0.0, '100': 0.5})
+        self.assertEqual(len(ret['lru_curve']), 4)
+
+    def test_missing_db(self):
+        self.assertRaises(self.mod.SaltInvocationError,
+                          self.mod.image_cache_stats,
+                          self.tmpdir, db='missing.db')
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'missing.db')))
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mod = load('_modules', 'glanceng',
+                        opts={'cachedir': self.tmpdir},
+                        salt={'config.get': lambda key, default=None:
+                              default})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _job(self, calls):
+        # A job of a minion with multiprocessing, which exits without
+        # reading its statistics
+        def run():
+            self.mod._STATS_FLUSHED['at'] = time.time()
+            for profile, operation, seconds in calls:
+                self.mod._record(profile, operation, seconds)
+        process = multiprocessing.Process(target=run)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+    def test_counters_add_up_over_jobs(self):
+        self._job([('region_one', 'tasks.get', 0.5),
+                   ('region_one', 'tasks.get', 1.5)])
+        self._job([('region_one', 'tasks.get', 1.0),
+                   (None, 'auth', 0.25)])
+        data = self.mod.stats()
+        self.assertEqual(data['region_one']['tasks.get']['count'], 3)
+        self.assertEqual(data['region_one']['tasks.get']['seconds'], 3.0)
+        self.assertEqual(data['region_one']['tasks.get']['max'], 1.5)
+        self.assertEqual(data['default']['auth']['count'], 1)
+
+    def test_reset(self):
+        self._job([('region_one', 'tasks.get', 0.5),
+                   ('region_two', 'tasks.get', 0.5)])
+        self.assertIn('region_one',
+                      self.mod.stats(profile='region_one', reset=True))
+        self.assertEqual(sorted(self.mod.stats()), ['region_two'])
+        self.mod.stats(reset=True)
+        self.assertEqual(self.mod.stats(), {})
+
+    def test_http_counters_add_up_over_jobs(self):
+        class Pool(object):
+            num_requests = 0
+            num_connections = 0
+        pool = Pool()
+
+        class PoolManager(object):
+            connection_pool_kw = {'maxsize': 10}
+            pools = {'glance': pool}
+
+        class Adapter(object):
+            poolmanager = PoolManager()
+
+        class Session(object):
+            adapters = {'http://': Adapter()}
+        self.mod._SESSIONS[('region_one', 'http://glance')] = Session()
+        for requests, connections in ((5, 1), (9, 2)):
+            pool.num_requests = requests
+            pool.num_connections = connections
+            self.mod._flush_stats()
+        self.assertEqual(self.mod.http_stats(), {'region_one': {
+            'http://glance': {'requests': 9, 'connections': 2,
+                              'reused': 7, 'pool_size': 10}}})
+        # The same counts in the session of another job's process
+        self.mod._HTTP_FLUSHED.clear()
+        self.assertEqual(self.mod.http_stats()['region_one'][
+            'http://glance']['requests'], 18)
+
+    def test_pooled_session_has_no_token(self):
+        import requests
+        own = requests.Session()
+        own.headers['X-Auth-Token'] = 'revoked'
+
+        class HTTPClient(object):
+            session = own
+
+        class Client(object):
+            http_client = HTTPClient()
+        client = self.mod._pooled(Client(), 'region_one', 'http://glance')
+        self.assertNotIn('X-Auth-Token', client.http_client.session.headers)
+        self.assertIn('User-Agent', client.http_client.session.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()